@@ -1,12 +1,29 @@
 # built-in
-import os, asyncio, tempfile
-from pathlib import Path
-from typing import Optional
+import os, asyncio, tempfile, logging, fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, AsyncIterator, Tuple
 import hashlib
 # pip
-from aiofiles.os import scandir
 from pydantic import BaseModel
 
+DEFAULT_WALK_CONCURRENCY = 16
+DEFAULT_WALK_BATCH_SIZE = 256
+
+def _list_dir(directory:str) -> Tuple[list[str], list[str]]:
+    """
+    Names of the subdirectories and files of `directory`. Symlinked directories are not followed.
+    """
+    dirs = []
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.is_file():
+                files.append(entry.name)
+    return dirs, files
+
 async def walk(directory):
     """
     Asynchronous version of os.walk using aiofiles.
@@ -24,18 +41,63 @@ async def walk(directory):
 
     while stack:
         current_dir = stack.pop()
-        dirs = []
-        files = []
-
-        entries = await scandir(current_dir)
-        for entry in entries:
-            if entry.is_dir():
-                dirs.append(entry.name)
-                stack.append(Path(current_dir) / entry.name)
-            elif entry.is_file():
-                files.append(entry.name)
-
+        dirs, files = await asyncio.to_thread(_list_dir, current_dir)
+        stack.extend( os.path.join(current_dir, name) for name in dirs )
         yield current_dir, dirs, files
+
+async def walk_files(directory:str, concurrency:int=DEFAULT_WALK_CONCURRENCY, ext:Optional[str|Tuple[str, ...]]=None, 
+                     name_pattern:Optional[str]=None, max_depth:Optional[int]=None, 
+                     batch_size:int=DEFAULT_WALK_BATCH_SIZE) -> AsyncIterator[list[str]]:
+    """
+    Walks `directory` listing up to `concurrency` directories at a time on a thread pool and yields the
+    paths of the files found in batches of up to `batch_size`, as soon as a batch is full or the walk is done.
+    
+    Directories are listed in no particular order, so on network shares the round-trips of many directories 
+    overlap. Subdirectories that cannot be listed are skipped with a warning, an error listing `directory` is raised.
+    
+    Args:
+        ext: Only files ending with this extension or one of these extensions.
+        name_pattern: Only files whose name matches this shell-style pattern, e.g. "IM_*".
+        max_depth: Only descend this many levels below `directory`, 0 lists `directory` only.
+    """
+    concurrency = max(1, concurrency)
+    pending = deque([ (directory, 0) ])
+    running:dict[asyncio.Future, Tuple[str, int]] = {}
+    batch = []
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="walk")
+    try:
+        while pending or running:
+            while pending and len(running) < concurrency:
+                current_dir, depth = pending.popleft()
+                running[loop.run_in_executor(pool, _list_dir, current_dir)] = (current_dir, depth)
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                current_dir, depth = running.pop(future)
+                try:
+                    dirs, files = future.result()
+                except OSError as e:
+                    if current_dir == directory:
+                        raise
+                    logging.warning(f'Could not list {current_dir}: {e}')
+                    continue
+                if max_depth is None or depth < max_depth:
+                    pending.extend( (os.path.join(current_dir, name), depth + 1) for name in dirs )
+                for name in files:
+                    if ext is not None and not name.endswith(ext):
+                        continue
+                    if name_pattern is not None and not fnmatch.fnmatch(name, name_pattern):
+                        continue
+                    batch.append( os.path.join(current_dir, name) )
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        if batch:
+            yield batch
+    finally:
+        for future in running:
+            future.cancel()
+        pool.shutdown(wait=False, cancel_futures=True)
         
 def hash_array(data: bytes, algorithm: str = "sha256") -> str:
     hash_func = hashlib.new(algorithm)
@@ -45,23 +107,24 @@ def hash_array(data: bytes, algorithm: str = "sha256") -> str:
 async def async_hash_array(data: bytes, algorithm: str = "sha256"):
     return await asyncio.to_thread(hash_array, data, algorithm)
 
-async def find_files_with_ext(dir:str, ext:Optional[str]=None) -> list[str]:
+async def find_files_with_ext(dir:str, ext:Optional[str]=None, concurrency:int=DEFAULT_WALK_CONCURRENCY, 
+                              max_depth:Optional[int]=None) -> list[str]:
     """
     Find files in a directory with an optional extension filter.
     
     Args:
         dir (str): The directory to search.
         ext (str): The file extension to filter by.
+        concurrency (int): The number of directories listed at a time.
+        max_depth (int): The number of levels to descend, all by default.
         
     Returns:
-        list: The list of file paths found.
+        list: The sorted list of file paths found.
     """
     files = []
-    async for root, _, filenames in walk(dir):
-        for filename in filenames:
-            if ext is None or filename.endswith(ext):
-                files.append( os.path.join(root, filename) )
-    return files
+    async for batch in walk_files(dir, concurrency=concurrency, ext=ext, max_depth=max_depth):
+        files.extend(batch)
+    return sorted(files)
 
 async def create_temp_folder() -> "str":
     # Use tempfile.TemporaryDirectory for safe temporary folder creation
@@ -0,0 +1,305 @@
+# built-in imports
+from typing import Tuple, Optional, Callable, Awaitable, Any
+from dataclasses import dataclass, field, asdict
+import os, sys, time, json, asyncio, tempfile, tracemalloc, platform, argparse, shutil, logging, socket, subprocess
+import urllib.request, urllib.error, urllib.parse
+from importlib import metadata
+
+# pip
+import numpy as np
+import pydicom, pydicom.uid
+from pydicom.dataset import Dataset, FileMetaDataset
+
+# append current path to sys.path
+parent_path = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+if not parent_path in sys.path:
+    sys.path.insert( 0, parent_path )
+
+# local
+import dicom, image_3d_tools
+
+@dataclass
+class PhantomSpec:
+    """
+    A synthetic series: a cuboid or ellipsoid rotated by `angles_deg` (z, y, x Euler angles in index space)
+    on a constant background. `half_extents` are the half lengths of the object along its own axes
+    as fractions of the smallest dimension of `shape` (slices, rows, cols); they have to be distinct
+    for the principal axes to be well defined.
+    """
+    name:str
+    shape:Tuple[int, int, int]            = (64, 128, 128)
+    dtype:str                             = "uint16"
+    kind:str                              = "cuboid"
+    angles_deg:Tuple[float, float, float] = (20., 10., 5.)
+    half_extents:Tuple[float, float, float] = (0.4, 0.25, 0.12)
+    foreground:int                        = 2000
+    background:int                        = 100
+    pixel_spacing:Tuple[float, float]     = (0.8, 0.8)
+    slice_thickness:float                 = 1.5
+
+@dataclass
+class StageResult:
+    seconds:float
+    peak_bytes:int
+
+@dataclass
+class CaseResult:
+    spec:PhantomSpec
+    stages:dict[str, StageResult] = field(default_factory=dict)
+    matrix:Optional[list[list[float]]] = None
+    ground_truth:Optional[list[list[float]]] = None
+    axis_error_deg:Optional[float] = None
+    passed:Optional[bool] = None
+
+DEFAULT_CASES = [
+    PhantomSpec("cuboid_uint16"),
+    PhantomSpec("ellipsoid_int16", dtype="int16", kind="ellipsoid", angles_deg=(-30., 15., 40.), foreground=1000, background=-1000),
+    PhantomSpec("cuboid_uint8_thin", shape=(24, 160, 160), dtype="uint8", angles_deg=(45., 5., 0.), half_extents=(0.45, 0.3, 0.1), foreground=200, background=10),
+]
+DEFAULT_MAX_AXIS_ERROR_DEG = 2.0
+DEFAULT_STARTUP_TIMEOUT = 120.
+
+def rotation_matrix(angles_deg:Tuple[float, float, float]) -> np.ndarray:
+    """
+    Rotation of the phantom's axes in index space (z, y, x), composed of rotations about z, y and x.
+    The columns are the axes of the object.
+    """
+    matrix = np.eye(3)
+    for axis, angle in enumerate(np.radians(angles_deg)):
+        i, j = [ k for k in range(3) if k != axis ]
+        rotation = np.eye(3)
+        rotation[i, i], rotation[i, j] = np.cos(angle), -np.sin(angle)
+        rotation[j, i], rotation[j, j] = np.sin(angle), np.cos(angle)
+        matrix = matrix @ rotation
+    return matrix
+
+def ground_truth_axes(spec:PhantomSpec) -> np.ndarray:
+    """
+    The axes of the phantom, one per row, ordered by decreasing extent as the aligner orders them.
+    """
+    axes = rotation_matrix(spec.angles_deg).T
+    return axes[ np.argsort(spec.half_extents)[::-1] ]
+
+def phantom_slice(spec:PhantomSpec, index:int) -> np.ndarray:
+    rows, cols = spec.shape[1:]
+    center = (np.array(spec.shape) - 1) / 2
+    half_extents = np.array(spec.half_extents) * min(spec.shape)
+    y, x = np.meshgrid( np.arange(rows) - center[1], np.arange(cols) - center[2], indexing="ij" )
+    points = np.stack( [np.full_like(y, index - center[0]), y, x], axis=-1 )
+    local = points @ rotation_matrix(spec.angles_deg) / half_extents
+    if spec.kind == "cuboid":
+        inside = np.all( np.abs(local) <= 1, axis=-1 )
+    elif spec.kind == "ellipsoid":
+        inside = np.sum( local**2, axis=-1 ) <= 1
+    else:
+        raise ValueError(f"Unknown phantom kind {spec.kind}")
+    return np.where( inside, spec.foreground, spec.background ).astype(spec.dtype)
+
+def write_phantom_series(spec:PhantomSpec, folder:str) -> None:
+    """
+    Writes the phantom as a CT series with one file per slice, generated slice by slice.
+    """
+    os.makedirs(folder, exist_ok=True)
+    dtype = np.dtype(spec.dtype)
+    study_uid, series_uid, frame_uid = pydicom.uid.generate_uid(), pydicom.uid.generate_uid(), pydicom.uid.generate_uid()
+    for index in range(spec.shape[0]):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = study_uid, series_uid, frame_uid
+        ds.Modality = "CT"
+        ds.SeriesNumber = 1
+        ds.SeriesDescription = spec.name
+        ds.InstanceNumber = index + 1
+        ds.ImagePositionPatient = [0, 0, index * spec.slice_thickness]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = list(spec.pixel_spacing)
+        ds.SliceThickness = spec.slice_thickness
+        ds.Rows, ds.Columns = spec.shape[1:]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = ds.BitsStored = dtype.itemsize * 8
+        ds.HighBit = ds.BitsStored - 1
+        ds.PixelRepresentation = 1 if dtype.kind == "i" else 0
+        ds.PixelData = phantom_slice(spec, index).tobytes()
+        ds.save_as( os.path.join(folder, f"{index:05d}.dcm"), enforce_file_format=True )
+
+async def _measure(stages:dict[str, StageResult], name:str, fn:Callable[[], Awaitable[Any]|Any]) -> Any:
+    """
+    Runs `fn` and records its wall time and the peak of memory allocated during it (as seen by tracemalloc,
+    which includes numpy's buffers). Coroutine results are awaited.
+    """
+    tracemalloc.reset_peak()
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    result = fn()
+    if asyncio.iscoroutine(result):
+        result = await result
+    seconds = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    stages[name] = StageResult(seconds=seconds, peak_bytes=max(0, peak_bytes - start_bytes))
+    logging.info(f"{name}: {seconds:.3f}s, peak {stages[name].peak_bytes / 1024**2:.1f} MiB")
+    return result
+
+async def run_case(spec:PhantomSpec, work_dir:str, max_axis_error_deg:float=DEFAULT_MAX_AXIS_ERROR_DEG) -> CaseResult:
+    """
+    Generates the phantom series in `work_dir` and runs the stages of /align on it, measuring each of them.
+    """
+    input_folder = os.path.join(work_dir, spec.name, "input")
+    output_folder = os.path.join(work_dir, spec.name, "output")
+    await asyncio.to_thread(write_phantom_series, spec, input_folder)
+
+    result = CaseResult(spec=spec)
+    stages = result.stages
+    series_data_set = await _measure(stages, "parse_dir", lambda: dicom.parse_dir(input_folder))
+    dcm_series = await _measure(stages, "create_dicom_series", lambda: dicom.create_dicom_series(series_data_set, 0))
+    volume = dcm_series.volume
+    threshold_value = await _measure(stages, "threshold", lambda: asyncio.to_thread(image_3d_tools.otsu_threshold, volume))
+    component = await _measure(stages, "largest_component", lambda: asyncio.to_thread(image_3d_tools.largest_component, volume, threshold_value))
+    corners, matrix = await _measure(stages, "calculate_rotated_bounding_box",
+                                     lambda: asyncio.to_thread(image_3d_tools.calculate_rotated_bounding_box, volume, threshold_value, component=component))
+    bounds = image_3d_tools.foreground_bounds(corners, matrix, margin=image_3d_tools.DEFAULT_CROP_MARGIN)
+    transformed = await _measure(stages, "transform_image", lambda: asyncio.to_thread(image_3d_tools.transform_image, volume, matrix, bounds=bounds))
+    trimmed = await _measure(stages, "trim_image", lambda: asyncio.to_thread(image_3d_tools.trim_image, transformed))
+    template = dcm_series.datasets[0]
+    await _measure(stages, "write_series", lambda: dicom.create_dcm_series_from_volume(template, trimmed, output_folder))
+
+    ground_truth = ground_truth_axes(spec)
+    result.matrix = matrix.tolist()
+    result.ground_truth = ground_truth.tolist()
+    result.axis_error_deg = image_3d_tools.axis_error_deg(matrix, ground_truth)
+    result.passed = result.axis_error_deg <= max_axis_error_deg
+    return result
+
+def _request(url:str, body:Optional[dict]=None, timeout:float=DEFAULT_STARTUP_TIMEOUT) -> dict|str:
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"} if data else {})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        body = response.read()
+    return json.loads(body) if response.headers.get_content_type() == "application/json" else body.decode()
+
+def time_to_first_request(input_folder:str, work_dir:str, warm_up:bool=False, timeout:float=DEFAULT_STARTUP_TIMEOUT) -> dict:
+    """
+    Starts the service in a new process, non-interactive and with its index and caches in `work_dir`,
+    and measures the time until it answers the first request and how long a first /align of `input_folder` takes.
+    With `warm_up`, the align is sent once the warm-up is reported done in /metrics.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    os.makedirs(work_dir, exist_ok=True)
+    env = dict(os.environ, HOST="127.0.0.1", PORT=str(port), DEV="false", NON_INTERACTIVE="true", LOG_LEVEL="warning",
+               WARM_UP=str(warm_up).lower())
+    base_url = f"http://127.0.0.1:{port}"
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    
+    first_response = None
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, main_py], cwd=work_dir, env=env, stdin=subprocess.DEVNULL)
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Service exited with code {process.returncode}")
+            try:
+                metrics = _request(f"{base_url}/metrics", timeout=1.)
+                if first_response is None:
+                    first_response = time.perf_counter() - start
+                if not warm_up or 'stage="warm_up"' in metrics:
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError(f"Service not ready within {timeout}s")
+            time.sleep(0.01)
+        ready = time.perf_counter() - start
+        
+        series_data_set = _request(f"{base_url}/parse_dir?" + urllib.parse.urlencode({"directory": input_folder}), timeout=timeout)
+        align_start = time.perf_counter()
+        _request(f"{base_url}/align", { **series_data_set, "series_index": 0, "series_description_suffix": "_benchmark", "use_result_cache": False }, 
+                 timeout=timeout)
+        first_align = time.perf_counter() - align_start
+    finally:
+        process.terminate()
+        process.wait()
+    logging.info(f"first response after {first_response:.3f}s, ready after {ready:.3f}s, first align {first_align:.3f}s (warm-up {warm_up})")
+    return { "warm_up": warm_up, "first_response_seconds": first_response, "ready_seconds": ready, "first_align_seconds": first_align }
+
+def _versions() -> dict[str, Optional[str]]:
+    versions = { "python": platform.python_version() }
+    for package in ("mi_py_dcm_aligner", "numpy", "scipy", "pydicom", "scikit-image"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+async def run_benchmark(cases:list[PhantomSpec], work_dir:Optional[str]=None, repeat:int=1,
+                        max_axis_error_deg:float=DEFAULT_MAX_AXIS_ERROR_DEG, startup:bool=True) -> dict:
+    """
+    Runs all `cases` `repeat` times and returns a JSON-serializable report. Per stage, the fastest run is reported.
+    With `startup`, the time to the first request of a new service process, without and with warm-up, is added 
+    using the series of the first case.
+    """
+    temp_dir = None if work_dir else tempfile.mkdtemp(prefix="dcm_aligner_benchmark_")
+    work_dir = work_dir or temp_dir
+    # imports the numeric libraries, so they are not timed in the first stages
+    image_3d_tools.warm_up()
+    tracemalloc.start()
+    try:
+        results = []
+        for spec in cases:
+            runs = []
+            for _ in range(repeat):
+                shutil.rmtree( os.path.join(work_dir, spec.name), ignore_errors=True )
+                runs.append( await run_case(spec, work_dir, max_axis_error_deg) )
+            best = runs[0]
+            for stage in best.stages:
+                best.stages[stage] = min( (run.stages[stage] for run in runs), key=lambda s: s.seconds )
+            results.append( asdict(best) )
+        startup_results = []
+        if startup and cases:
+            input_folder = os.path.join(work_dir, cases[0].name, "input")
+            for warm_up in (False, True):
+                startup_results.append( await asyncio.to_thread(time_to_first_request, input_folder, os.path.join(work_dir, f"startup_{warm_up}"), warm_up) )
+    finally:
+        tracemalloc.stop()
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return { "versions": _versions(), "cpu_count": os.cpu_count(), "repeat": repeat, "cases": results, "startup": startup_results }
+
+def main(argv:Optional[list[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Times the alignment stages on synthetic phantom series.")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--work-dir", help="folder for the generated series, a temporary folder by default")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--max-axis-error-deg", type=float, default=DEFAULT_MAX_AXIS_ERROR_DEG)
+    parser.add_argument("--shape", type=int, nargs=3, metavar=("SLICES", "ROWS", "COLS"), help="run a single phantom of this shape")
+    parser.add_argument("--dtype", default="uint16", choices=["uint8", "uint16", "int16"])
+    parser.add_argument("--kind", default="cuboid", choices=["cuboid", "ellipsoid"])
+    parser.add_argument("--angles-deg", type=float, nargs=3, default=(20., 10., 5.))
+    parser.add_argument("--skip-startup", action="store_true", help="do not measure the time to the first request of a new service process")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if args.shape:
+        cases = [ PhantomSpec(f"{args.kind}_{args.dtype}", shape=tuple(args.shape), dtype=args.dtype, kind=args.kind, angles_deg=tuple(args.angles_deg)) ]
+    else:
+        cases = DEFAULT_CASES
+    report = asyncio.run( run_benchmark(cases, args.work_dir, args.repeat, args.max_axis_error_deg, startup=not args.skip_startup) )
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0 if all( case["passed"] for case in report["cases"] ) else 1
+
+if __name__ == "__main__":
+    sys.exit( main() )
@@ -0,0 +1,244 @@
+# built-in
+from typing import Optional, Dict, Any
+from dataclasses import dataclass
+import logging, asyncio
+
+# pip
+import httpx
+from pydantic import BaseModel
+
+DEFAULT_HEALTH_INTERVAL = 5.
+DEFAULT_HEALTH_TIMEOUT = 2.
+DEFAULT_REQUEST_TIMEOUT = 600.
+DEFAULT_RETRIES = 2
+DEFAULT_MIN_FREE_MEMORY_BYTES = 512 * 1024**2
+# a worker with the series cached is preferred over one with up to this much less load (requests per CPU)
+DEFAULT_CACHE_AFFINITY = 1.
+# responses of a worker that is down or overloaded, the request is sent to another worker
+FAILOVER_STATUS_CODES = (502, 503, 504)
+
+class WorkerHealth(BaseModel):
+    """
+    State of an instance as reported by /health, used by the coordinator to route requests.
+    """
+    status:str                              = "ok"
+    active_requests:int                     = 0
+    cpu_count:int                           = 1
+    memory_available_bytes:Optional[int]    = None
+    cached_series:list[str]                 = []
+    workers:Optional[int]                   = None # healthy workers of a coordinator
+
+class WorkerInfo(BaseModel):
+    url:str
+    healthy:bool                    = False
+    in_flight:int                   = 0
+    failures:int                    = 0
+    health:Optional[WorkerHealth]   = None
+
+class NoWorkerAvailableError(Exception):
+    pass
+
+class WorkerRequestError(Exception):
+    """
+    A worker rejected or failed a request, e.g. with 404 for an unknown series, or did not answer it in time. 
+    Not retried on another worker.
+    """
+    def __init__( self, status_code:int, detail:Any ):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+@dataclass
+class _Worker:
+    url:str
+    health:Optional[WorkerHealth] = None
+    healthy:bool = False
+    in_flight:int = 0
+    failures:int = 0
+
+    def load( self ) -> float:
+        # the reported load lags behind, requests sent since the last health check are counted here
+        active = max(self.in_flight, self.health.active_requests if self.health is not None else 0)
+        cpu_count = self.health.cpu_count if self.health is not None else 1
+        return active / max(1, cpu_count)
+
+    def info( self ) -> WorkerInfo:
+        return WorkerInfo(url=self.url, healthy=self.healthy, in_flight=self.in_flight, failures=self.failures, health=self.health)
+
+class Coordinator:
+    """
+    Routes requests to a pool of worker instances of this service over HTTP.
+
+    The /health of every worker is polled every `health_interval` seconds. A request goes to a healthy worker
+    with at least `min_free_memory` bytes available and the least load, where workers that have the series 
+    volume cached count `cache_affinity` requests per CPU less. If a worker cannot be connected to or answers 
+    with 502, 503 or 504, it is marked unhealthy until its next successful health check and the request is sent 
+    to another worker, at most `retries` times. Other errors are raised as WorkerRequestError: the worker may 
+    have started the request, which must not run twice, e.g. on a read timeout.
+
+    Usage:
+        await coordinator.start()
+        result = await coordinator.post("/align", payload, series_uid)
+    """
+    def __init__( self, worker_urls:Optional[list[str]]=None, health_interval:float=DEFAULT_HEALTH_INTERVAL,
+                 request_timeout:float=DEFAULT_REQUEST_TIMEOUT, retries:int=DEFAULT_RETRIES,
+                 min_free_memory:int=DEFAULT_MIN_FREE_MEMORY_BYTES, cache_affinity:float=DEFAULT_CACHE_AFFINITY ):
+        self.health_interval = health_interval
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.min_free_memory = min_free_memory
+        self.cache_affinity = cache_affinity
+        self._workers:Dict[str, _Worker] = {}
+        self._client:Optional[httpx.AsyncClient] = None
+        self._health_task:Optional[asyncio.Task] = None
+        # health checks of newly registered workers, referenced until done so they are not garbage collected
+        self._check_tasks:set[asyncio.Task] = set()
+        for url in worker_urls or []:
+            self.register(url)
+
+    def register( self, url:str ) -> WorkerInfo:
+        url = url.rstrip("/")
+        if url not in self._workers:
+            logging.info(f'Registered worker {url}')
+            self._workers[url] = _Worker(url)
+            if self._client is not None:
+                task = asyncio.create_task(self._check(self._workers[url]))
+                self._check_tasks.add(task)
+                task.add_done_callback(self._check_tasks.discard)
+        return self._workers[url].info()
+
+    def unregister( self, url:str ) -> None:
+        if self._workers.pop(url.rstrip("/"), None) is not None:
+            logging.info(f'Unregistered worker {url}')
+
+    def workers( self ) -> list[WorkerInfo]:
+        return [ worker.info() for worker in self._workers.values() ]
+
+    def healthy_workers( self ) -> int:
+        return sum( worker.healthy for worker in self._workers.values() )
+
+    async def start( self ) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.request_timeout)
+            await self.refresh()
+            self._health_task = asyncio.create_task(self._poll_health())
+
+    async def stop( self ) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for task in list(self._check_tasks):
+            task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def refresh( self ) -> None:
+        await asyncio.gather( *( self._check(worker) for worker in list(self._workers.values()) ) )
+
+    async def _poll_health( self ) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.refresh()
+
+    async def _check( self, worker:_Worker ) -> None:
+        try:
+            response = await self._client.get(f"{worker.url}/health", timeout=DEFAULT_HEALTH_TIMEOUT)
+            response.raise_for_status()
+            worker.health = WorkerHealth.model_validate(response.json())
+            if not worker.healthy:
+                logging.info(f'Worker {worker.url} is healthy')
+            worker.healthy = worker.health.status == "ok"
+        except (httpx.HTTPError, ValueError) as e:
+            if worker.healthy:
+                logging.warning(f'Worker {worker.url} is unhealthy: {e!r}')
+            worker.healthy = False
+
+    def _select( self, series_uid:Optional[str], exclude:set[str] ) -> _Worker:
+        candidates = [ worker for url, worker in self._workers.items() if worker.healthy and url not in exclude ]
+        if not candidates:
+            raise NoWorkerAvailableError("No healthy worker available")
+
+        def has_headroom( worker:_Worker ) -> bool:
+            available = worker.health.memory_available_bytes if worker.health is not None else None
+            return available is None or available >= self.min_free_memory
+
+        # workers short of memory are only used if all of them are
+        candidates = [ worker for worker in candidates if has_headroom(worker) ] or candidates
+        def rank( worker:_Worker ) -> tuple:
+            cached = series_uid is not None and worker.health is not None and series_uid in worker.health.cached_series
+            available = worker.health.memory_available_bytes if worker.health is not None else None
+            return ( worker.load() - (self.cache_affinity if cached else 0.), not cached, -(available or 0) )
+        return min(candidates, key=rank)
+
+    async def post( self, path:str, payload:dict, series_uid:Optional[str]=None ) -> Any:
+        """
+        Posts `payload` to `path` of the selected worker and returns the decoded JSON response.
+        `series_uid` is the series the request works on, for routing to a worker that has it cached.
+        """
+        if self._client is None:
+            raise NoWorkerAvailableError("Coordinator is not started")
+        tried = set()
+        last_error = None
+        for _ in range(self.retries + 1):
+            try:
+                worker = self._select(series_uid, tried)
+            except NoWorkerAvailableError:
+                if last_error is not None:
+                    raise NoWorkerAvailableError(f"No worker succeeded, last error: {last_error}")
+                raise
+            tried.add(worker.url)
+            worker.in_flight += 1
+            try:
+                response = await self._client.post(f"{worker.url}{path}", json=payload)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                # the request has not been sent
+                last_error = repr(e)
+                self._failed(worker, last_error)
+                continue
+            except httpx.TimeoutException as e:
+                raise WorkerRequestError(504, f"Worker {worker.url} did not answer in time: {e!r}")
+            except httpx.HTTPError as e:
+                raise WorkerRequestError(502, f"Request to worker {worker.url} failed: {e!r}")
+            finally:
+                worker.in_flight -= 1
+
+            if response.status_code in FAILOVER_STATUS_CODES:
+                last_error = f"{response.status_code} {response.text}"
+                self._failed(worker, last_error)
+                continue
+            if response.status_code >= 400:
+                try:
+                    detail = response.json().get("detail", response.text)
+                except ValueError:
+                    detail = response.text
+                raise WorkerRequestError(response.status_code, detail)
+
+            worker.failures = 0
+            if series_uid is not None and worker.health is not None and series_uid not in worker.health.cached_series:
+                # the worker has loaded the series now, until the next health check tells otherwise
+                worker.health.cached_series.append(series_uid)
+            logging.debug(f'{path} done by worker {worker.url}')
+            return response.json()
+        raise NoWorkerAvailableError(f"No worker succeeded, last error: {last_error}")
+
+    def _failed( self, worker:_Worker, error:str ) -> None:
+        logging.warning(f'Request to worker {worker.url} failed, trying another one: {error}')
+        worker.failures += 1
+        worker.healthy = False
+
+async def register_with_coordinator( coordinator_url:str, worker_url:str, attempts:int=30, interval:float=2. ) -> None:
+    """
+    Registers this instance as `worker_url` at the coordinator, retrying while the coordinator is not up.
+    """
+    async with httpx.AsyncClient(timeout=DEFAULT_HEALTH_TIMEOUT) as client:
+        for _ in range(attempts):
+            try:
+                response = await client.post(f"{coordinator_url.rstrip('/')}/workers", params={"url": worker_url})
+                response.raise_for_status()
+                logging.info(f'Registered at coordinator {coordinator_url} as {worker_url}')
+                return
+            except httpx.HTTPError as e:
+                logging.debug(f'Could not register at coordinator {coordinator_url}: {e!r}')
+            await asyncio.sleep(interval)
+    logging.warning(f'Could not register at coordinator {coordinator_url}')
@@ -0,0 +1,78 @@
+# built-in
+from typing import Optional, Tuple
+from collections import OrderedDict
+import logging, time, uuid
+
+# local
+from dicom import DcmSeriesDataSet
+
+DEFAULT_DATASET_TTL_SECONDS = 3600.
+DEFAULT_MAX_DATASETS = 64
+
+class UnknownHandleError(KeyError):
+    pass
+
+class SeriesNotFoundError(LookupError):
+    pass
+
+class DatasetHandles:
+    """
+    Parsed data sets kept server side under a random handle, so requests can refer to a data set
+    instead of sending its file lists again.
+
+    A handle expires `ttl` seconds after it was last used. At most `max_entries` data sets are kept,
+    the least recently used are dropped first.
+    """
+    def __init__( self, ttl:float=DEFAULT_DATASET_TTL_SECONDS, max_entries:int=DEFAULT_MAX_DATASETS ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries:OrderedDict[str, Tuple[DcmSeriesDataSet, float]] = OrderedDict()
+
+    def _purge( self, now:float ) -> None:
+        for handle in [ handle for handle, (_, expires) in self._entries.items() if expires <= now ]:
+            logging.debug(f"Data set handle {handle} expired")
+            del self._entries[handle]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def register( self, series_data_set:DcmSeriesDataSet ) -> str:
+        """
+        Registers `series_data_set`, sets its handle and returns it.
+        """
+        now = time.monotonic()
+        handle = uuid.uuid4().hex
+        series_data_set.handle = handle
+        self._entries[handle] = (series_data_set, now + self.ttl)
+        self._purge(now)
+        return handle
+
+    def get( self, handle:str ) -> DcmSeriesDataSet:
+        now = time.monotonic()
+        self._purge(now)
+        if handle not in self._entries:
+            raise UnknownHandleError(f"Unknown or expired data set handle {handle}")
+        series_data_set, _ = self._entries[handle]
+        self._entries[handle] = (series_data_set, now + self.ttl)
+        self._entries.move_to_end(handle)
+        return series_data_set
+
+    def resolve( self, series_data_set:DcmSeriesDataSet, series_index:Optional[int]=None, series_uid:Optional[str]=None ) -> Tuple[DcmSeriesDataSet, int]:
+        """
+        The registered data set if `series_data_set` carries a handle, else `series_data_set` itself,
+        and the index of the series selected by `series_uid` or `series_index`.
+        """
+        if series_data_set.handle != None:
+            series_data_set = self.get(series_data_set.handle)
+        return series_data_set, select_series(series_data_set, series_index, series_uid)
+
+def select_series( series_data_set:DcmSeriesDataSet, series_index:Optional[int]=None, series_uid:Optional[str]=None ) -> int:
+    """
+    Index of the series given by `series_uid` or, without uid, by `series_index`.
+    """
+    if series_uid != None:
+        series_index = series_data_set.get_series_index(series_uid)
+        if series_index is None:
+            raise SeriesNotFoundError(f"Unknown series {series_uid}")
+    if series_index is None or not 0 <= series_index < len(series_data_set.uids):
+        raise SeriesNotFoundError(f"Invalid series index {series_index}")
+    return series_index
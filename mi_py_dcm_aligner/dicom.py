@@ -1,38 +1,90 @@
 # built-in
-from typing import Optional, Callable, Tuple, Dict
-import logging, pydicom, os, asyncio, datetime
+from typing import Optional, Callable, Tuple, Dict, AsyncIterator
+import logging, pydicom, os, asyncio, datetime, copy
 
 # pip
 import aiofiles.os
 import pydicom
 from pydicom.errors import InvalidDicomError
 from pydicom.filebase import DicomBytesIO
-from pydantic import BaseModel
+from pydicom.pixels.utils import pixel_dtype
+from pydantic import BaseModel, PrivateAttr
 from dataclasses import dataclass
-import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from PIL import Image
 import pydicom, pydicom.uid
 
 # local
 import aiofiles_ext
+import image_3d_tools
 
 PixelSpacing = Tuple[float, float]|None
 
+DEFAULT_CRAWL_CONCURRENCY = 16
+DEFAULT_HEADER_PREFIX_SIZE = 16 * 1024
+# the 128 byte preamble and the "DICM" prefix, a shorter read cannot be recognized as a DICOM file
+MIN_HEADER_PREFIX_SIZE = 132
+
+# lossless output transfer syntaxes by name
+OUTPUT_TRANSFER_SYNTAXES = {
+    "explicit": pydicom.uid.ExplicitVRLittleEndian,
+    "deflated": pydicom.uid.DeflatedExplicitVRLittleEndian,
+    "rle": pydicom.uid.RLELossless,
+    "jpeg-ls": pydicom.uid.JPEGLSLossless,
+    "jpeg2000": pydicom.uid.JPEG2000Lossless,
+}
+
 class DcmSeriesDataSet(BaseModel):
     uids:list[str|None]=[]
     files:list[ list[str] ]=[]
     descriptions:list[str|None]=[]
     slice_thicknesses:list[float|None]=[]
     pixel_spacings:list[PixelSpacing]=[]
+    # server side handle of a parsed data set, see dataset_handles
+    handle:Optional[str]=None
+    _uid_to_idx:Dict[str|None, int] = PrivateAttr(default_factory=dict)
+    
+    def get_series_index( self, series_uid:str|None ) -> Optional[int]:
+        # rebuild the lookup if the lists were filled directly, e.g. by validation of a request body
+        if len(self._uid_to_idx) != len(self.uids):
+            self._uid_to_idx = { uid: idx for idx, uid in enumerate(self.uids) }
+        return self._uid_to_idx.get(series_uid)
+    
+    def add_file( self, file_path:str, series_uid:str|None, description:str|None, pixel_spacing:PixelSpacing, slice_thickness:float|None ) -> int:
+        series_idx = self.get_series_index(series_uid)
+        if series_idx is None:
+            self.uids.append(series_uid)
+            self.descriptions.append(description)
+            self.pixel_spacings.append(pixel_spacing)
+            self.slice_thicknesses.append(slice_thickness)
+            self.files.append([])
+            series_idx = len(self.uids) - 1
+            self._uid_to_idx[series_uid] = series_idx
+        self.files[series_idx].append(file_path)
+        return series_idx
+    
+    def single_series( self, series_idx:int ) -> "DcmSeriesDataSet":
+        # a data set with only the series `series_idx`, without handle
+        return DcmSeriesDataSet( uids=[self.uids[series_idx]], files=[self.files[series_idx]], descriptions=[self.descriptions[series_idx]],
+                                 slice_thicknesses=[self.slice_thicknesses[series_idx]], pixel_spacings=[self.pixel_spacings[series_idx]] )
 
 @dataclass
 class DicomSeries:
     files:list[str] # sorted!!!
-    datasets:Dict[str, pydicom.Dataset]
+    datasets:list[pydicom.Dataset]
     volume:Optional[np.ndarray]
     slice_thickness:float|None=None
     pixel_spacing:PixelSpacing=None
+    slice_step:int=1 # only every slice_step-th slice is loaded
+    scratch:Optional[image_3d_tools.ScratchSpace]=None # holds the volume if it is out-of-core, closed by the owner
+
+@dataclass
+class CrawledFile:
+    file_path:str
+    size:int
+    mtime_ns:int
+    dataset:Optional[pydicom.Dataset] # None if the file is not a DICOM file or unchanged
+    changed:bool=True
     
 async def load_dcm( file_path:str, stop_before_pixels:bool=False ) -> pydicom.Dataset:
     async with aiofiles.open(file_path, mode="rb") as f:
@@ -41,6 +93,119 @@ async def load_dcm( file_path:str, stop_before_pixels:bool=False ) -> pydicom.Da
         dataset = pydicom.dcmread(DicomBytesIO(data), stop_before_pixels=stop_before_pixels)
         return dataset   
     
+def read_dcm_header( file_path:str, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE ) -> Tuple[pydicom.Dataset, os.stat_result]:
+    """
+    Reads the header of a DICOM file without touching the pixel data.
+    
+    Only the first `prefix_size` bytes, at least MIN_HEADER_PREFIX_SIZE, are read. If the header turns out to be longer, 
+    the read is doubled until the parser stops in front of the pixel data or the whole file is read.
+    
+    Raises:
+        InvalidDicomError: If the file is not a DICOM file.
+    """
+    with open(file_path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        data = f.read( max(prefix_size, MIN_HEADER_PREFIX_SIZE) )
+        while True:
+            complete = len(data) >= stat.st_size
+            buffer = DicomBytesIO(data)
+            try:
+                dataset = pydicom.dcmread(buffer, stop_before_pixels=True)
+                # the parser stopped in front of the pixel data, so the header is complete
+                if complete or buffer.tell() < len(data):
+                    return dataset, stat
+            except InvalidDicomError:
+                raise
+            except Exception:
+                # a prefix that ends within an element may not be parseable
+                if complete:
+                    raise
+            data += f.read(len(data))
+
+async def load_dcm_header( file_path:str, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE ) -> pydicom.Dataset:
+    dataset, _ = await asyncio.to_thread(read_dcm_header, file_path, prefix_size)
+    return dataset
+    
+def get_series_info( dataset:pydicom.Dataset ) -> Tuple[str, str, PixelSpacing, float|None]:
+    # study_uid = ds.get("StudyInstanceUID")
+    series_uid = dataset.get("SeriesInstanceUID", "")
+    series_description = dataset.get("SeriesDescription", "")
+    pixel_spacing = dataset.get("PixelSpacing", None)
+    if pixel_spacing != None:                    
+        pixel_spacing = tuple(map(float, pixel_spacing))
+    slice_thickness = dataset.get("SliceThickness", None)
+    if slice_thickness != None:
+        slice_thickness = float(slice_thickness)
+    return series_uid, series_description, pixel_spacing, slice_thickness
+
+def _crawl_file( file_path:str, prefix_size:int, known:Optional[Dict[str, Tuple[int, int]]] ) -> Optional[CrawledFile]:
+    try:
+        if known is not None and file_path in known:
+            stat = os.stat(file_path)
+            if known[file_path] == (stat.st_size, stat.st_mtime_ns):
+                return CrawledFile(file_path=file_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns, dataset=None, changed=False)
+        dataset, stat = read_dcm_header(file_path, prefix_size)
+    except InvalidDicomError:
+        # Skip non-DICOM files
+        stat = os.stat(file_path)
+        dataset = None
+    except Exception as e:
+        # Handle other exceptions (e.g., permission issues)
+        logging.warning(f"Error processing file {file_path}: {e}")
+        return None
+    return CrawledFile(file_path=file_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns, dataset=dataset)
+
+async def crawl_dcm_headers( directory:str, concurrency:int=DEFAULT_CRAWL_CONCURRENCY, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE, 
+                            known:Optional[Dict[str, Tuple[int, int]]]=None, 
+                            walk_concurrency:int=aiofiles_ext.DEFAULT_WALK_CONCURRENCY ) -> AsyncIterator[CrawledFile]:
+    """
+    Walks a directory and reads the DICOM headers of all files with a pool of `concurrency` workers.
+    
+    Listing the directories, `walk_concurrency` at a time, overlaps with parsing the headers. Files are yielded in the order their 
+    headers have been read, i.e. not necessarily in directory order. Files that could not be read are skipped.
+    
+    Args:
+        known: Optional (size, mtime_ns) fingerprints by file path. Files whose fingerprint did not change
+            are not read and yielded with `changed=False`.
+    """
+    concurrency = max(1, concurrency)
+    paths:asyncio.Queue[str|None] = asyncio.Queue(maxsize=concurrency * 4)
+    results:asyncio.Queue[CrawledFile|None] = asyncio.Queue()
+    
+    async def produce():
+        try:
+            async for batch in aiofiles_ext.walk_files(directory, concurrency=walk_concurrency):
+                for file_path in batch:
+                    await paths.put(file_path)
+        finally:
+            for _ in range(concurrency):
+                await paths.put(None)
+            
+    async def work():
+        try:
+            while (file_path := await paths.get()) is not None:
+                crawled_file = await asyncio.to_thread(_crawl_file, file_path, prefix_size, known)
+                if crawled_file is not None:
+                    await results.put(crawled_file)
+        finally:
+            await results.put(None)
+    
+    producer = asyncio.create_task(produce())
+    workers = [ asyncio.create_task(work()) for _ in range(concurrency) ]
+    try:
+        running = len(workers)
+        while running > 0:
+            crawled_file = await results.get()
+            if crawled_file is None:
+                running -= 1
+            else:
+                yield crawled_file
+        # raise errors of the directory walk
+        await producer
+    finally:
+        for task in [producer, *workers]:
+            task.cancel()
+    
 async def async_save_as(dataset: pydicom.Dataset, filename: str, enforce_file_format:bool=True):
     # Write the dataset to a DicomBytesIO stream
     with DicomBytesIO() as buffer:
@@ -51,146 +216,358 @@ async def async_save_as(dataset: pydicom.Dataset, filename: str, enforce_file_fo
         async with aiofiles.open(filename, 'wb') as f:
             await f.write(buffer.read())
             
-async def parse_dir( directory:str ) -> DcmSeriesDataSet:             
+async def parse_dir( directory:str, concurrency:int=DEFAULT_CRAWL_CONCURRENCY, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE, 
+                     walk_concurrency:int=aiofiles_ext.DEFAULT_WALK_CONCURRENCY ) -> DcmSeriesDataSet:             
     series_data_set = DcmSeriesDataSet()
     # directory = args.dir
     
     logging.info(f'Starting parsing of dicoms in {directory}')
-    async for root, _, files in aiofiles_ext.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            try:
-                # Try to read the file as a DICOM file (skip pixel data)
-                dataset = await load_dcm(file_path, stop_before_pixels=True)
-                logging.debug(f'Found DICOM file "{file_path}"')
-                # study_uid = ds.get("StudyInstanceUID")
-                series_uid = dataset.get("SeriesInstanceUID", "")
-                series_description = dataset.get("SeriesDescription", "")
-                pixel_spacing = dataset.get("PixelSpacing", None)
-                if pixel_spacing != None:                    
-                    pixel_spacing = tuple(map(float, pixel_spacing))
-                    
-                slice_thickness = dataset.get("SliceThickness", None)
-                                        
-                if not series_uid in series_data_set.uids:
-                    series_data_set.uids.append(series_uid)
-                    series_data_set.descriptions.append(series_description)
-                    series_data_set.pixel_spacings.append(pixel_spacing)
-                    series_data_set.slice_thicknesses.append(slice_thickness)
-                    series_data_set.files.append([])
-                    series_idx = len(series_data_set.uids) - 1
-                else:
-                    series_idx = series_data_set.uids.index(series_uid)
-                series_data_set.files[series_idx].append(file_path)
-                
-            except InvalidDicomError:
-                # Skip non-DICOM files
-                pass
-            except Exception as e:
-                # Handle other exceptions (e.g., permission issues)
-                logging.warning(f"Error processing file {file_path}: {e}")
+    async for crawled_file in crawl_dcm_headers(directory, concurrency=concurrency, prefix_size=prefix_size, walk_concurrency=walk_concurrency):
+        dataset = crawled_file.dataset
+        if dataset is None:
+            continue
+        file_path = crawled_file.file_path
+        logging.debug(f'Found DICOM file "{file_path}"')
+        series_data_set.add_file(file_path, *get_series_info(dataset))
+    
+    # the workers finish in arbitrary order
+    for files in series_data_set.files:
+        files.sort()
                 
     return series_data_set
 
-async def create_dicom_series( series_data_set:DcmSeriesDataSet, idx:int ) -> DicomSeries:
+def _read_dcm( file_path:str ) -> pydicom.Dataset:
+    with open(file_path, "rb") as f:
+        return pydicom.dcmread(f)
+
+def _sort_key( dataset:pydicom.Dataset ):
     # use instance number and alternatively image position patient z to sort the files
-    files = series_data_set.files[idx]
-    file_to_dataset = { file: await load_dcm(file, stop_before_pixels=True) for file in files }
-    file_to_dataset = dict( sorted( file_to_dataset.items(), key=lambda x: (x[1].get("InstanceNumber", 0), x[1].get("ImagePositionPatient", [0, 0, 0])[2]) ) )
+    return (dataset.get("InstanceNumber", 0), dataset.get("ImagePositionPatient", [0, 0, 0])[2])
+
+def _get_rescale( dataset:pydicom.Dataset ) -> Tuple[float, float]:
+    slope = dataset.get("RescaleSlope", None)
+    intercept = dataset.get("RescaleIntercept", None)
+    return float(1 if slope is None else slope), float(0 if intercept is None else intercept)
+
+def _volume_dtype( stored_dtype:np.dtype, rescales:list[Tuple[float, float]] ) -> np.dtype:
+    # the same pixel types a modality LUT would produce: stored type, a wider integer type or float
+    if all( rescale == (1.0, 0.0) for rescale in rescales ):
+        return stored_dtype
+    if all( slope.is_integer() and intercept.is_integer() for slope, intercept in rescales ):
+        scalar_types = [ np.min_scalar_type(int(value)) for rescale in rescales for value in rescale ]
+        return np.result_type(stored_dtype, np.int16, *scalar_types)
+    return np.dtype(np.float32)
+
+def _read_sorted_headers( pool:ThreadPoolExecutor, files:list[str] ) -> Tuple[list[str], list[pydicom.Dataset]]:
+    headers = pool.map(lambda file: read_dcm_header(file)[0], files)
+    sorted_headers = sorted( zip(files, headers), key=lambda x: _sort_key(x[1]) )
+    return [ file for file, _ in sorted_headers ], [ header for _, header in sorted_headers ]
+
+def load_volume_sync( files:list[str], max_workers:Optional[int]=None, slice_step:int=1, scratch:Optional[image_3d_tools.ScratchSpace]=None, 
+                      memory_budget:Optional[int]=None ) -> Tuple[list[str], list[pydicom.Dataset], np.ndarray]:
+    """
+    Loads a series into one preallocated (slices, rows, cols) array.
+    
+    The headers are read without pixel data on a thread pool for sorting and allocating, then the files are 
+    read in batches and every slice is decoded into the array right away, so only the slices in flight are held 
+    encoded. Rescale slope and intercept are applied. The pixel data is dropped from the returned datasets, 
+    the headers are kept.
+    
+    With `slice_step` > 1 the pixel data is read for every `slice_step`-th slice only.
+    
+    With a `scratch` space, the volume is decoded into a memory-mapped scratch file instead of RAM.
+    With a `memory_budget`, the batches are small enough for the slices in flight to stay within it.
     
-    files = list( file_to_dataset.keys() )
+    Returns:
+        The sorted (selected) files, their datasets and the volume.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        files, headers = _read_sorted_headers(pool, files)
+        files, headers = files[::slice_step], headers[::slice_step]
+        rescales = [ _get_rescale(header) for header in headers ]
+        
+        # the first header gives the shape and the stored type
+        shape = (len(files), headers[0].Rows, headers[0].Columns)
+        stored_dtype = pixel_dtype(headers[0])
+        dtype = _volume_dtype(stored_dtype, rescales)
+        volume = image_3d_tools.allocate( shape, dtype, scratch )
+        
+        def decode( idx:int ) -> pydicom.Dataset:
+            dataset = _read_dcm(files[idx])
+            slope, intercept = rescales[idx]
+            pixels = dataset.pixel_array
+            if (slope, intercept) == (1.0, 0.0):
+                volume[idx] = pixels
+            else:
+                np.multiply(pixels, slope, out=volume[idx], casting="unsafe")
+                volume[idx] += np.asarray(intercept).astype(dtype)
+            del dataset.PixelData
+            return dataset
+        
+        # a slice in flight holds the encoded, the decoded and the rescaled pixels
+        slice_bytes = 3 * shape[1] * shape[2] * max(volume.itemsize, stored_dtype.itemsize)
+        batch_size = image_3d_tools.workers_for_budget(slice_bytes, memory_budget, max_workers)
+        datasets = []
+        for start in range(0, len(files), batch_size):
+            datasets.extend( pool.map(decode, range(start, min(start + batch_size, len(files)))) )
+    return files, datasets, volume
+
+async def create_dicom_series( series_data_set:DcmSeriesDataSet, idx:int, max_workers:Optional[int]=None, slice_step:int=1, 
+                               scratch:Optional[image_3d_tools.ScratchSpace]=None, memory_budget:Optional[int]=None ) -> DicomSeries:
     slice_thickness = series_data_set.slice_thicknesses[idx]
     pixel_spacing = series_data_set.pixel_spacings[idx]
     
-    def load_volume_sync( sorted_series_files:list[str] ) -> np.ndarray:            
-        reader = sitk.ImageSeriesReader()
-        reader.SetFileNames(sorted_series_files)
-        # Load the image and convert to numpy array
-        image = reader.Execute()
-        volume = sitk.GetArrayFromImage(image)  # Shape: (slices, height, width)
-        return volume    
-    
     loop = asyncio.get_event_loop()
-    volume:np.ndarray = await loop.run_in_executor(None, load_volume_sync, files)
-    return DicomSeries(files=files, datasets=list(file_to_dataset.values()), volume=volume, slice_thickness=slice_thickness, pixel_spacing=pixel_spacing)
+    files, datasets, volume = await loop.run_in_executor(None, load_volume_sync, series_data_set.files[idx], max_workers, slice_step, scratch, memory_budget)
+    return DicomSeries(files=files, datasets=datasets, volume=volume, slice_thickness=slice_thickness, pixel_spacing=pixel_spacing, 
+                       slice_step=slice_step, scratch=scratch)
 
+def _pixel_encoding( volume:np.ndarray, template:pydicom.Dataset ) -> Tuple[np.dtype, Optional[Tuple[float, float]]]:
+    """
+    Chooses the stored pixel type and the rescale (slope, intercept) for writing `volume`.
+    
+    Integer volumes of at most 16 bit are stored as they are if the template has no rescale. Otherwise the
+    template's rescale is kept if the stored values fit into 16 bit, else a new rescale onto the uint16 range is used.
+    Returns None as rescale if the values are stored without rescaling.
+    """
+    slope, intercept = _get_rescale(template)
+    if volume.dtype in (np.uint8, np.uint16, np.int16) and (slope, intercept) == (1.0, 0.0):
+        return volume.dtype, None
+    
+    min_value = min( float(volume[z0:z0+16].min()) for z0 in range(0, volume.shape[0], 16) )
+    max_value = max( float(volume[z0:z0+16].max()) for z0 in range(0, volume.shape[0], 16) )
+    stored_min, stored_max = sorted( ((min_value - intercept) / slope, (max_value - intercept) / slope) )
+    for dtype in (np.uint16, np.int16):
+        if np.iinfo(dtype).min <= round(stored_min) and round(stored_max) <= np.iinfo(dtype).max:
+            return np.dtype(dtype), (slope, intercept)
+    
+    slope = (max_value - min_value) / np.iinfo(np.uint16).max or 1.0
+    return np.dtype(np.uint16), (slope, min_value)
 
-async def create_dcm_series_from_pngs( template:str|pydicom.Dataset, png_folder:str, output_folder:str, per_instance_cb:Callable[[int,pydicom.Dataset], None]|None=None) -> str:
+def _stored_pixels( pixels:np.ndarray, dtype:np.dtype, rescale:Optional[Tuple[float, float]] ) -> np.ndarray:
+    if rescale is None:
+        return pixels.astype(dtype, copy=False)
+    slope, intercept = rescale
+    if (slope, intercept) == (1.0, 0.0) and np.issubdtype(pixels.dtype, np.integer):
+        return pixels.astype(dtype)
+    return np.rint( (pixels - intercept) / slope ).astype(dtype)
+
+def _compile_template( template:pydicom.Dataset, stored_dtype:np.dtype, rescale:Optional[Tuple[float, float]], rows:int, columns:int ) -> Dict:
     """
-    Creates a DICOM series from PNG slices.
+    Prepares the elements shared by all instances of a new series: the template header plus the image pixel module.
+    """
+    ds = pydicom.Dataset()
+    for key, value in template.items():
+        ds[key] = value
+    if "PixelData" in ds:
+        del ds.PixelData
+    ds.Modality = "CT"  # Other            
+
+    # Add required DICOM attributes        
+    ds.SOPClassUID = pydicom.uid.CTImageStorage
+    ds.ImageType = ["ORIGINAL", "PRIMARY"]
+    now = datetime.datetime.now()
+    ds.ContentDate = now.strftime('%Y%m%d')
+    ds.ContentTime = now.strftime('%H%M%S')
+    ds.SoftwareVersions = "1.0"
+    ds.Rows, ds.Columns = rows, columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 8 * stored_dtype.itemsize
+    ds.BitsStored = 8 * stored_dtype.itemsize
+    ds.HighBit = 8 * stored_dtype.itemsize - 1
+    ds.PixelRepresentation = 1 if np.issubdtype(stored_dtype, np.signedinteger) else 0
+    if rescale != None:
+        ds.RescaleSlope = f"{rescale[0]:.10g}"
+        ds.RescaleIntercept = f"{rescale[1]:.10g}"
+    return { tag: ds[tag] for tag in ds.keys() }
+
+def output_transfer_syntax( name:str ) -> pydicom.uid.UID:
+    """
+    UID of one of the OUTPUT_TRANSFER_SYNTAXES. Raises ValueError if it is unknown or its encoder is not installed.
+    """
+    if name not in OUTPUT_TRANSFER_SYNTAXES:
+        raise ValueError(f"Unknown transfer syntax {name}, expected one of {', '.join(OUTPUT_TRANSFER_SYNTAXES)}")
+    uid = OUTPUT_TRANSFER_SYNTAXES[name]
+    if not uid.is_compressed:
+        return uid
+    from pydicom.pixels import get_encoder
+    encoder = get_encoder(uid)
+    if not encoder.is_available:
+        raise ValueError(f"No encoder for {uid.name} installed: {'; '.join(encoder.missing_dependencies)}")
+    return uid
+
+def _create_file_meta( sop_instance_uid:str, transfer_syntax_uid:str=pydicom.uid.ExplicitVRLittleEndian ) -> pydicom.dataset.FileMetaDataset:
+    fileMeta = pydicom.dataset.FileMetaDataset()
+    # fileMeta.MediaStorageSOPClassUID = pydicom._storage_sopclass_uids.SecondaryCaptureImageStorage 
+    # ds.Modality = "OT"  # Other
+    # TODO
+    fileMeta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage        
+    fileMeta.MediaStorageSOPInstanceUID = sop_instance_uid
+    fileMeta.TransferSyntaxUID = transfer_syntax_uid
+    return fileMeta
+
+def write_series_sync( compiled_template:Dict, volume:np.ndarray, stored_dtype:np.dtype, rescale:Optional[Tuple[float, float]], 
+                       output_folder:str, per_instance_cb:Callable[[int,pydicom.Dataset], None]|None=None, max_workers:Optional[int]=None,
+                       transfer_syntax_uid:str=pydicom.uid.ExplicitVRLittleEndian ) -> None:
+    """
+    Writes one instance per slice of `volume` on a thread pool, using the shared elements from _compile_template.
+    Only the per-instance elements (SOPInstanceUID, InstanceNumber, PixelData and whatever `per_instance_cb` sets)
+    are patched. `per_instance_cb` is called from the worker threads.
+    
+    Compressed transfer syntaxes are encoded in the worker threads as well, deflate is applied by pydicom when writing.
+    """
+    compressed = pydicom.uid.UID(transfer_syntax_uid).is_compressed
+    def write_instance( i:int ):
+        # elements are copied so per-instance changes do not leak into the shared template
+        ds = pydicom.Dataset({ tag: copy.copy(element) for tag, element in compiled_template.items() })
+        ds.preamble=b"\0" * 128
+        ds.file_meta = _create_file_meta( pydicom.uid.generate_uid(), transfer_syntax_uid )
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        # Set slice-specific attributes
+        ds.InstanceNumber = i + 1
+        pixels = _stored_pixels(volume[i], stored_dtype, rescale)
+        if compressed:
+            ds.compress(transfer_syntax_uid, np.ascontiguousarray(pixels), generate_instance_uid=False)
+        else:
+            ds.PixelData = pixels.tobytes()
+        
+        if per_instance_cb != None:
+            per_instance_cb( i, ds )
+            
+        # Save the DICOM file
+        output_path = os.path.join(output_folder, f'{ds.SOPInstanceUID}.dcm')
+        pydicom.dcmwrite(output_path, ds, enforce_file_format=False)
+    
+    pydicom.dataset.validate_file_meta(_create_file_meta(pydicom.uid.generate_uid()), enforce_standard=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list( pool.map(write_instance, range(volume.shape[0])) )
+
+async def create_dcm_series_from_volume( template:str|pydicom.Dataset, volume:np.ndarray, output_folder:str, 
+                                        per_instance_cb:Callable[[int,pydicom.Dataset], None]|None=None, max_workers:Optional[int]=None,
+                                        transfer_syntax_uid:str=pydicom.uid.ExplicitVRLittleEndian ) -> str:
+    """
+    Creates a DICOM series from a (slices, rows, cols) volume, one instance per slice.
+    
+    The volume holds modality values (i.e. rescale already applied, as loaded by create_dicom_series).
+    The pixel type is preserved where DICOM allows it, other types are stored with rescale slope and intercept.
+    The shared header is prepared once, the instances are serialized and written concurrently on `max_workers` threads.
 
     Args:
-        png_folder (str): Path to the folder containing PNG images.
-        output_folder (str): Path to the folder where DICOM files will be saved.
+        template (str|pydicom.Dataset): Dataset or path of a DICOM file whose header is copied into every instance.
+        volume (np.ndarray): The pixel data.
+        output_folder (str): Path to the folder where the series folder will be created.
+        per_instance_cb: Called with the slice index and the dataset of every instance before it is written, from a worker thread.
+        transfer_syntax_uid: Transfer syntax of the instances, see OUTPUT_TRANSFER_SYNTAXES for the lossless ones.
+    Returns:
+        The folder of the new series.
     """
     if type(template) == str:
         template = await load_dcm(template, stop_before_pixels=True)
     else:
         template = template
-    # Load PNG files and sort them by filename to ensure correct slice order
-    png_folder = png_folder
-    png_files = sorted([f for f in await aiofiles.os.listdir(png_folder) if f.endswith('.png')])
-
-    if not png_files:
-        raise ValueError("No PNG files found in the specified folder.")
+        
+    if volume.ndim != 3 or volume.shape[0] == 0:
+        raise ValueError(f"Expected a non-empty (slices, rows, cols) volume, got shape {volume.shape}.")
+    stored_dtype, rescale = await asyncio.to_thread(_pixel_encoding, volume, template)
 
-    template.SeriesNumber = template.SeriesNumber + 1
+    template.SeriesNumber = template.get("SeriesNumber", 0) + 1
     template.SeriesInstanceUID = pydicom.uid.generate_uid()
     
     output_folder = output_folder + "/" + template.SeriesInstanceUID
     
     await aiofiles.os.makedirs(output_folder, exist_ok=True)
     
-    for i, png_file in enumerate(png_files):
-        # Load the image and convert to grayscale (if needed)
-        img_path = os.path.join(png_folder, png_file)
-        img = Image.open(img_path)
-        logging.debug(f'found image with mode "{img.mode}" in {img_path}')
-        pixel_array = np.array(img, dtype=np.uint16)  # Convert to 16-bit (DICOM standard)
-        
-        fileMeta = pydicom.Dataset()
-        # fileMeta.MediaStorageSOPClassUID = pydicom._storage_sopclass_uids.SecondaryCaptureImageStorage 
-        # ds.Modality = "OT"  # Other
-        # TODO
-        fileMeta.MediaStorageSOPClassUID = pydicom.uid.CTImageStorage        
-        fileMeta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
-        fileMeta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
-        #ds = FileDataset("", {},file_meta = fileMeta,preamble="\0"*128)
-        ds = pydicom.Dataset()
-        for key, value in template.items():
-            ds[key] = value
-        #ds = FileDataset("", {}, file_meta=fileMeta)
-        ds.preamble=b"\0" * 128
-        ds.file_meta = fileMeta
-        ds.Modality = "CT"  # Other            
-
-        # Add required DICOM attributes        
-        ds.SOPInstanceUID = fileMeta.MediaStorageSOPInstanceUID#pydicom.uid.generate_uid()
-        ds.SOPClassUID = fileMeta.MediaStorageSOPClassUID
-        ds.ImageType = ["ORIGINAL", "PRIMARY"]
-        ds.ContentDate = datetime.datetime.now().strftime('%Y%m%d')
-        ds.ContentTime = datetime.datetime.now().strftime('%H%M%S')
-        ds.SoftwareVersions = "1.0"
-        ds.Rows, ds.Columns = pixel_array.shape
-        ds.SamplesPerPixel = 1
-        ds.PhotometricInterpretation = "MONOCHROME2"
-        ds.BitsAllocated = 16
-        ds.BitsStored = 16
-        ds.HighBit = 15
-        ds.PixelRepresentation = 0  # Unsigned integers
-        ds.PixelData = pixel_array.tobytes()
-        # Set slice-specific attributes
+    compiled_template = _compile_template(template, stored_dtype, rescale, volume.shape[1], volume.shape[2])
+    await asyncio.to_thread(write_series_sync, compiled_template, volume, stored_dtype, rescale, output_folder, per_instance_cb, max_workers, transfer_syntax_uid)
+
+    logging.debug(f"DICOM series created successfully in folder: {output_folder}")
+    return output_folder
+
+def _ds( values ) -> list[pydicom.valuerep.DSfloat]:
+    # decimal strings are limited to 16 characters
+    return [ pydicom.valuerep.DSfloat(float(value), auto_format=True) for value in values ]
+
+def write_series_geometry_sync( files:list[str], orientation:np.ndarray, first_position:np.ndarray, slice_offset:np.ndarray, 
+                                output_folder:str, series_instance_uid:str, series_number:int,
+                                per_instance_cb:Callable[[int,pydicom.Dataset], None]|None=None, max_workers:Optional[int]=None ) -> None:
+    """
+    Copies the slices of a series into a new series with the given geometry, slice i at first_position + i * slice_offset.
+    The pixel data is copied as it is, in its original transfer syntax. `per_instance_cb` is called from the worker threads.
+    """
+    frame_of_reference_uid = pydicom.uid.generate_uid()
+    normal = np.cross(orientation[:3], orientation[3:])
+    
+    def write_instance( i:int, file:str ):
+        ds = pydicom.dcmread(file)
+        ds.SeriesInstanceUID = series_instance_uid
+        ds.SeriesNumber = series_number
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.SOPInstanceUID = pydicom.uid.generate_uid()
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
         ds.InstanceNumber = i + 1
-                
+        position = first_position + i * slice_offset
+        ds.ImageOrientationPatient = _ds(orientation)
+        ds.ImagePositionPatient = _ds(position)
+        if "SliceLocation" in ds:
+            ds.SliceLocation = _ds([position @ normal])[0]
+        
         if per_instance_cb != None:
             per_instance_cb( i, ds )
-
-        # Save the DICOM file
-        #hash = await aiofiles_ext.async_hash_array(pixel_array)
+        
         output_path = os.path.join(output_folder, f'{ds.SOPInstanceUID}.dcm')
-        pydicom.dataset.validate_file_meta(ds.file_meta, enforce_standard=True)
-        # ds.save_as(output_path, enforce_file_format=False)
-        await async_save_as(ds, output_path, enforce_file_format=False)
+        pydicom.dcmwrite(output_path, ds, enforce_file_format=False)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        files, _ = _read_sorted_headers(pool, files)
+        list( pool.map(write_instance, range(len(files)), files) )
 
-    logging.debug(f"DICOM series created successfully in folder: {output_folder}")
-    return output_folder
\ No newline at end of file
+async def create_dcm_series_with_geometry( files:list[str], orientation:np.ndarray, first_position:np.ndarray, slice_offset:np.ndarray, output_folder:str, 
+                                          per_instance_cb:Callable[[int,pydicom.Dataset], None]|None=None, max_workers:Optional[int]=None ) -> str:
+    """
+    Creates a copy of the series of `files` that only differs in its geometry, e.g. from image_3d_tools.aligned_slice_geometry,
+    instead of resampling the volume. The files are sorted like create_dicom_series sorts them.
+    
+    Returns:
+        The folder of the new series.
+    """
+    if len(files) == 0:
+        raise ValueError("Expected at least one file")
+    template = await load_dcm_header(files[0])
+    series_instance_uid = pydicom.uid.generate_uid()
+    series_number = template.get("SeriesNumber", 0) + 1
+    
+    output_folder = output_folder + "/" + series_instance_uid
+    await aiofiles.os.makedirs(output_folder, exist_ok=True)
+    await asyncio.to_thread(write_series_geometry_sync, files, orientation, first_position, slice_offset, output_folder, 
+                            series_instance_uid, series_number, per_instance_cb, max_workers)
+    
+    logging.debug(f"DICOM series with aligned geometry created in folder: {output_folder}")
+    return output_folder
+
+async def create_dcm_series_from_pngs( template:str|pydicom.Dataset, png_folder:str, output_folder:str, per_instance_cb:Callable[[int,pydicom.Dataset], None]|None=None) -> str:
+    """
+    Creates a DICOM series from PNG slices.
+
+    Args:
+        png_folder (str): Path to the folder containing PNG images.
+        output_folder (str): Path to the folder where DICOM files will be saved.
+    """
+    # Load PNG files and sort them by filename to ensure correct slice order
+    png_files = sorted([f for f in await aiofiles.os.listdir(png_folder) if f.endswith('.png')])
+
+    if not png_files:
+        raise ValueError("No PNG files found in the specified folder.")
+    
+    def load_pngs_sync() -> np.ndarray:
+        from PIL import Image
+        slices = []
+        for png_file in png_files:
+            img_path = os.path.join(png_folder, png_file)
+            img = Image.open(img_path)
+            logging.debug(f'found image with mode "{img.mode}" in {img_path}')
+            slices.append( np.array(img, dtype=np.uint16) )  # Convert to 16-bit (DICOM standard)
+        return np.stack(slices)
+    
+    volume = await asyncio.to_thread(load_pngs_sync)
+    return await create_dcm_series_from_volume(template, volume, output_folder, per_instance_cb=per_instance_cb)
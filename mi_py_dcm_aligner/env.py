@@ -1,6 +1,5 @@
-import os, aiofiles.os, asyncio
+import os, sys, aiofiles.os, asyncio
 # pip
-import aioconsole
 from dotenv import load_dotenv
 from aiofiles import open as aio_open
 
@@ -11,12 +10,37 @@ async def get_or_ask_for_param(param_name, default=None, value_type=str):
 def get_or_ask_and_wait_for_param(param_name, default=None, value_type=str):
     return asyncio.run(_get_or_ask_for_param(param_name, default, value_type))
 
+def get_param(param_name, default=None, value_type=str):
+    """
+    Get a parameter from the environment or the .env file without asking the user.
+    Safe to call from within a running event loop.
+    """
+    global _dot_env_loaded
+    if not _dot_env_loaded:
+        load_dotenv(".env", override=True)
+        _dot_env_loaded = True
+        
+    value = os.getenv(param_name)
+    if value is None:
+        return default
+    return value_type(value)
+
+def is_interactive():
+    """
+    False if NON_INTERACTIVE is set to true or stdin is not a terminal, e.g. in containers or under a process manager.
+    Missing parameters then take their default instead of being asked for.
+    """
+    if os.getenv("NON_INTERACTIVE", "false").lower() == "true":
+        return False
+    return sys.stdin is not None and sys.stdin.isatty()
+
 # private vars
 _dot_env_loaded = False
 
 async def _get_or_ask_for_param(param_name, default=None, value_type=str):
     """
-    Get a parameter from the environment. If not found, ask the user for it.
+    Get a parameter from the environment. If not found, ask the user for it, 
+    or take the default if not is_interactive().
     Args:
         param_name (str): The name of the environment variable.
         default: The default value if the variable is not found.
@@ -30,8 +54,11 @@ async def _get_or_ask_for_param(param_name, default=None, value_type=str):
         _dot_env_loaded = True
         
     value = os.getenv(param_name)
-    if value is None:
+    if value is None and not is_interactive():
+        value = default if default is None else value_type(default)
+    elif value is None:
         # Ask the user for input if not in .env
+        import aioconsole
         user_input = await aioconsole.ainput(f"Enter value for {param_name} (default: {default}): ") or default
         try:
             value = value_type(user_input)
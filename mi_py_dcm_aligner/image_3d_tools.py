@@ -1,6 +1,8 @@
 # built-in
-from typing import Tuple
-import logging, pydicom, os, asyncio
+from typing import Tuple, Optional, Iterator
+import logging, pydicom, os, asyncio, tempfile, shutil, mmap
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 # pip
 import aiofiles.os
@@ -9,40 +11,300 @@ import pydicom
 from pydicom.errors import InvalidDicomError
 from pydicom.filebase import DicomBytesIO
 from pydantic import BaseModel
-import SimpleITK as sitk
 import numpy as np
-from skimage.filters import threshold_otsu
-from sklearn.decomposition import PCA
-from scipy.ndimage import affine_transform
-from PIL import Image
+# scipy, scikit-image and PIL are imported by the functions using them, they are the bulk of the startup time
 
 # local
 from aiofiles_ext import walk, create_temp_folder
 
+DEFAULT_SLAB_SIZE = 16
+DEFAULT_TILE_BYTES = 64 * 1024**2
+DEFAULT_CROP_MARGIN = 2.0
+DEFAULT_COMPONENT_FACTOR = 2
+# upper bound of the working memory per voxel of a slab: mask, projections and int64 histogram indices
+_SLAB_BYTES_PER_VOXEL = 16
+
+class ScratchSpace:
+    """
+    Scratch files of memory-mapped arrays, in a folder of their own below `scratch_dir`.
+    
+    release() and close() close the memory maps before removing the files, so the files are removed right away
+    on every platform, including Windows where a mapped file cannot be deleted. Arrays and views of them
+    must not be used after they have been released.
+    
+    Usage:
+        with ScratchSpace(scratch_dir) as scratch:
+            volume = allocate(shape, dtype, scratch)
+    """
+    def __init__(self, scratch_dir:Optional[str]=None):
+        self.scratch_dir = scratch_dir
+        self.path:Optional[str] = None
+        self._arrays:list[np.memmap] = []
+    
+    def __getstate__(self) -> dict:
+        # a copy in a worker process releases the arrays it allocates itself
+        return { "scratch_dir": self.scratch_dir, "path": self.path, "_arrays": [] }
+    
+    def __enter__(self) -> "ScratchSpace":
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+    
+    def allocate(self, shape:Tuple[int, ...], dtype) -> np.memmap:
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix="dcm_aligner_", dir=self.scratch_dir)
+        fd, path = tempfile.mkstemp(suffix=".raw", dir=self.path)
+        os.close(fd)
+        array = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+        self._arrays.append(array)
+        return array
+    
+    def release(self, array:np.ndarray) -> None:
+        """
+        Closes and removes the scratch file of `array`, if it has been allocated here.
+        """
+        for idx, allocated in enumerate(self._arrays):
+            if allocated is array:
+                del self._arrays[idx]
+                _close_memmap(array)
+                return
+    
+    def close(self) -> None:
+        while self._arrays:
+            _close_memmap( self._arrays.pop() )
+        if self.path is not None:
+            shutil.rmtree(self.path, onerror=lambda _, path, e: logging.warning(f'Could not remove scratch file {path}: {e[1]}'))
+            self.path = None
+
+def _close_memmap(array:np.memmap) -> None:
+    if isinstance(array.base, mmap.mmap):
+        array.base.close()
+    try:
+        os.remove(array.filename)
+    except OSError as e:
+        logging.warning(f'Could not remove scratch file {array.filename}: {e}')
+
+def allocate(shape:Tuple[int, ...], dtype, scratch:Optional[ScratchSpace]=None) -> np.ndarray:
+    """
+    Allocates an uninitialized array, in RAM or, with a `scratch` space, as np.memmap backed by a scratch file.
+    """
+    if scratch is None or int(np.prod(shape)) == 0:
+        return np.empty(shape, dtype=dtype)
+    return scratch.allocate(shape, dtype)
+
+def workers_for_budget(bytes_per_worker:int, memory_budget:Optional[int], max_workers:Optional[int]=None) -> int:
+    """
+    Number of threads that may each hold `bytes_per_worker` within `memory_budget` bytes, at least 1.
+    """
+    workers = max_workers or os.cpu_count() or 1
+    if memory_budget is None:
+        return workers
+    return max(1, min(workers, memory_budget // max(1, bytes_per_worker)))
+
+def slab_size_for_budget(shape:Tuple[int, ...], memory_budget:Optional[int]) -> int:
+    """
+    Number of slices along axis 0 of which the slab-wise stages may process at once within `memory_budget` bytes.
+    """
+    if memory_budget is None:
+        return DEFAULT_SLAB_SIZE
+    return max(1, memory_budget // max(1, shape[1] * shape[2] * _SLAB_BYTES_PER_VOXEL))
+
 def threshold(volume:np.ndarray, threshold_value: float = None, binary_value:int=1) -> Tuple[np.ndarray, float]:
         # Apply Otsu's threshold to create a binary volume
         binary_image = np.zeros_like(volume, dtype=np.uint8)
         if threshold_value == None:
-            threshold_value = threshold_otsu(volume)
-            logging.debug(f'Otsu threshold:{threshold_value}')
+            threshold_value = otsu_threshold(volume)
         
         binary_image[volume > threshold_value] = binary_value
             
         return binary_image, float(threshold_value)
     
-def calculate_rotated_bounding_box(binary_volume:np.ndarray) -> Tuple[np.ndarray, np.ndarray]: 
-    points = np.argwhere(binary_volume)
+def _iter_slabs(volume:np.ndarray, slab_size:int) -> Iterator[Tuple[int, np.ndarray]]:
+    # yields the first slice index and the view of every slab along axis 0
+    for z0 in range(0, volume.shape[0], slab_size):
+        yield z0, volume[z0:z0+slab_size]
 
-    # Apply PCA to find the principal components (axes)
-    pca = PCA(n_components=3)
-    pca.fit(points)
+@dataclass
+class ComponentMask:
+    """
+    Mask of a connected component, computed on a grid downsampled by `factor` along all axes.
+    """
+    mask:np.ndarray
+    factor:int
+    
+    def slab(self, z0:int, shape:Tuple[int, int, int]) -> np.ndarray:
+        # the mask upsampled to the full resolution slab of `shape` starting at slice z0
+        factor = self.factor
+        low = self.mask[z0 // factor:(z0 + shape[0] - 1) // factor + 1]
+        high = low.repeat(factor, axis=0).repeat(factor, axis=1).repeat(factor, axis=2)
+        start = z0 - (z0 // factor) * factor
+        return high[start:start + shape[0], :shape[1], :shape[2]]
+    
+    def scaled(self, ratio:int, margin:int=0) -> "ComponentMask":
+        # the mask for a volume sampled `ratio` times finer, e.g. the next pyramid level, grown by `margin` blocks
+        mask = self.mask
+        if margin > 0:
+            from scipy.ndimage import binary_dilation
+            mask = binary_dilation(mask, iterations=margin)
+        return ComponentMask(mask, self.factor * ratio)
+
+class ComponentNotFoundError(ValueError):
+    pass
 
-    # Project points to PCA space
-    transformed_points = pca.transform(points)
+def _iter_foreground_slabs(volume:np.ndarray, threshold_value:Optional[float]=None, slab_size:int=DEFAULT_SLAB_SIZE, 
+                           component:Optional[ComponentMask]=None) -> Iterator[Tuple[int, np.ndarray]]:
+    for z0, slab in _iter_slabs(volume, slab_size):
+        mask = (slab > threshold_value) if threshold_value is not None else (slab != 0)
+        if component is not None:
+            mask &= component.slab(z0, mask.shape)
+        yield z0, mask
 
-    # Find the axis-aligned bounding box in the PCA space
-    min_point = np.min(transformed_points, axis=0)
-    max_point = np.max(transformed_points, axis=0)
+def largest_component(volume:np.ndarray, threshold_value:Optional[float]=None, factor:int=DEFAULT_COMPONENT_FACTOR, 
+                      connectivity:int=1, min_size:int=0, slab_size:int=DEFAULT_SLAB_SIZE, within:Optional[ComponentMask]=None) -> ComponentMask:
+    """
+    The largest connected component of the foreground, to drop the table, cables and other debris.
+    
+    The foreground is downsampled slab by slab to blocks of `factor`^3 voxels, a block being foreground
+    if more than half of its voxels are, so objects that merely touch are not merged, and labeled with the 
+    given `connectivity` (1: faces, 2: edges, 3: corners). The mask of the largest component is grown by one
+    block to keep the voxels at its border. Components smaller than `min_size` full resolution voxels are ignored.
+    With `within`, e.g. the component found on a coarser pyramid level, only the foreground inside it is labeled.
+    """
+    from scipy.ndimage import label, generate_binary_structure, binary_dilation
+    factor = max(1, factor)
+    low_shape = tuple( -(-n // factor) for n in volume.shape )
+    low_mask = np.zeros(low_shape, dtype=bool)
+    # slabs of whole blocks
+    slab_size = -(-slab_size // factor) * factor
+    for z0, mask in _iter_foreground_slabs(volume, threshold_value, slab_size=slab_size, component=within):
+        blocks = -(-mask.shape[0] // factor)
+        padded = np.zeros( (2, blocks * factor, low_shape[1] * factor, low_shape[2] * factor), dtype=bool )
+        padded[0, :mask.shape[0], :mask.shape[1], :mask.shape[2]] = mask
+        # blocks at the border of the volume are partly padding, only their voxels inside the volume count
+        padded[1, :mask.shape[0], :mask.shape[1], :mask.shape[2]] = True
+        counts = padded.reshape(2, blocks, factor, low_shape[1], factor, low_shape[2], factor).sum(axis=(2, 4, 6), dtype=np.int32)
+        low_mask[z0 // factor:z0 // factor + blocks] = 2 * counts[0] > counts[1]
+    
+    structure = generate_binary_structure(3, connectivity)
+    labels, num_labels = label(low_mask, structure=structure)
+    del low_mask
+    if num_labels == 0:
+        raise ComponentNotFoundError("No foreground voxels found")
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    largest = int(np.argmax(sizes))
+    if sizes[largest] * factor**3 < min_size:
+        raise ComponentNotFoundError(f"No connected component with at least {min_size} voxels found")
+    logging.debug(f'{num_labels} components, largest with about {sizes[largest] * factor**3} voxels')
+    return ComponentMask(binary_dilation(labels == largest, structure=structure), factor)
+
+def otsu_threshold(volume:np.ndarray, slab_size:int=DEFAULT_SLAB_SIZE) -> float:
+    """
+    Otsu's threshold of a volume, computed from a histogram accumulated slab by slab.
+    Uses the same histogram as skimage's threshold_otsu: one bin per value for integer volumes, 256 bins otherwise.
+    """
+    slab_ranges = [ (slab.min(), slab.max()) for _, slab in _iter_slabs(volume, slab_size) ]
+    min_value = min( slab_range[0] for slab_range in slab_ranges )
+    max_value = max( slab_range[1] for slab_range in slab_ranges )
+    if min_value == max_value:
+        return float(min_value)
+    
+    if np.issubdtype(volume.dtype, np.integer):
+        min_value, max_value = int(min_value), int(max_value)
+        counts = np.zeros(max_value - min_value + 1, dtype=np.int64)
+        for _, slab in _iter_slabs(volume, slab_size):
+            counts += np.bincount( (slab.astype(np.int64) - min_value).ravel(), minlength=counts.size )
+        bin_centers = np.arange(min_value, max_value + 1)
+    else:
+        counts = np.zeros(256, dtype=np.int64)
+        for _, slab in _iter_slabs(volume, slab_size):
+            slab_counts, bin_edges = np.histogram(slab, bins=256, range=(min_value, max_value))
+            counts += slab_counts
+        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.
+    from skimage.filters import threshold_otsu
+    threshold_value = threshold_otsu(hist=(counts, bin_centers))
+    logging.debug(f'Otsu threshold:{threshold_value}')
+    return float(threshold_value)
+
+def calculate_principal_axes(volume:np.ndarray, threshold_value:Optional[float]=None, slab_size:int=DEFAULT_SLAB_SIZE, 
+                             component:Optional[ComponentMask]=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Principal axes of the foreground voxel indices and their extents along these axes.
+    
+    Equivalent to a PCA of np.argwhere(foreground) but computed from first and second moments which are
+    accumulated slab by slab from 2D projections of the foreground, so no per-voxel arrays are allocated.
+    The foreground is `volume > threshold_value` or, without a threshold, all non-zero voxels, 
+    restricted to `component` if given.
+    
+    Returns:
+        mean, axes (one axis per row, ordered by decreasing variance), min and max of the
+        foreground projected onto the axes relative to the mean
+    """
+    count = 0
+    sums = np.zeros(3)
+    products = np.zeros((3, 3))
+    for z0, mask in _iter_foreground_slabs(volume, threshold_value, slab_size, component):
+        z = np.arange(z0, z0 + mask.shape[0], dtype=np.float64)
+        y = np.arange(mask.shape[1], dtype=np.float64)
+        x = np.arange(mask.shape[2], dtype=np.float64)
+        zy = mask.sum(axis=2, dtype=np.float64)
+        zx = mask.sum(axis=1, dtype=np.float64)
+        yx = mask.sum(axis=0, dtype=np.float64)
+        pz, py, px = zy.sum(axis=1), zy.sum(axis=0), zx.sum(axis=0)
+        
+        count += pz.sum()
+        sums += [ z @ pz, y @ py, x @ px ]
+        products += [ [ (z*z) @ pz, z @ zy @ y, z @ zx @ x ],
+                      [ 0.,         (y*y) @ py, y @ yx @ x ],
+                      [ 0.,         0.,         (x*x) @ px ] ]
+    if count == 0:
+        raise ValueError("No foreground voxels found")
+    
+    products = np.triu(products) + np.triu(products, 1).T
+    mean = sums / count
+    covariance = products / count - np.outer(mean, mean)
+    _, eigenvectors = np.linalg.eigh(covariance)
+    axes = eigenvectors[:, ::-1].T
+    # deterministic signs like sklearn's PCA: the largest component of every axis is positive
+    axes *= np.sign( axes[np.arange(3), np.argmax(np.abs(axes), axis=1)] )[:, None]
+    
+    min_point = np.full(3, np.inf)
+    max_point = np.full(3, -np.inf)
+    for z0, mask in _iter_foreground_slabs(volume, threshold_value, slab_size, component):
+        # the extreme projections of a row of voxels are at its first or last foreground voxel
+        rows = mask.any(axis=2)
+        if not rows.any():
+            continue
+        x_first = np.argmax(mask, axis=2)[rows]
+        x_last = mask.shape[2] - 1 - np.argmax(mask[:, :, ::-1], axis=2)[rows]
+        z, y = np.nonzero(rows)
+        z = z + z0 - mean[0]
+        y = y - mean[1]
+        for i, axis in enumerate(axes):
+            base = axis[0] * z + axis[1] * y
+            first = base + axis[2] * (x_first - mean[2])
+            last = base + axis[2] * (x_last - mean[2])
+            min_point[i] = min( min_point[i], first.min(), last.min() )
+            max_point[i] = max( max_point[i], first.max(), last.max() )
+            
+    return mean, axes, min_point, max_point
+    
+def calculate_rotated_bounding_box(volume:np.ndarray, threshold_value:Optional[float]=None, slab_size:int=DEFAULT_SLAB_SIZE, scale:int=1, 
+                                   component:Optional[ComponentMask]=None) -> Tuple[np.ndarray, np.ndarray]: 
+    """
+    Rotated bounding box of the foreground of `volume` along its principal axes.
+    
+    If `threshold_value` is given, the foreground is thresholded on the fly, otherwise `volume` is
+    treated as a binary volume. With a `component` (see largest_component), only its voxels are used. 
+    Peak memory is bounded by the size of one slab.
+    
+    If `volume` is a pyramid level holding every `scale`-th voxel (see pyramid_level), the box and 
+    the matrix are returned in the index coordinates of the full resolution volume.
+    """
+    mean, axes, min_point, max_point = calculate_principal_axes(volume, threshold_value, slab_size, component)
+    # sampling every scale-th voxel along all axes keeps the axes and scales positions and extents
+    mean, min_point, max_point = mean * scale, min_point * scale, max_point * scale
 
     # Create 8 corner points of the cuboid in the PCA space
     corners = np.array([[min_point[0], min_point[1], min_point[2]],
@@ -55,7 +317,7 @@ def calculate_rotated_bounding_box(binary_volume:np.ndarray) -> Tuple[np.ndarray
                         [max_point[0], max_point[1], max_point[2]]])
 
     # Transform the cuboid corners back to the original coordinate system
-    cuboid_corners = pca.inverse_transform(corners)
+    cuboid_corners = corners @ axes + mean
     origin = cuboid_corners[0]
     # Ensure cuboid corners are float to avoid integer division issues
     f_cuboid_corners = cuboid_corners.astype(np.float64)
@@ -85,6 +347,44 @@ def calculate_rotated_bounding_box(binary_volume:np.ndarray) -> Tuple[np.ndarray
 
     return cuboid_corners, transformation_matrix
 
+def pyramid_level(volume:np.ndarray, factor:int, slice_step:int=1) -> np.ndarray:
+    """
+    View of every `factor`-th voxel along all axes of a volume of which only every `slice_step`-th slice has been loaded.
+    `factor` has to be a multiple of `slice_step`, load with the greatest common divisor of all levels used.
+    """
+    if factor % slice_step != 0:
+        raise ValueError(f"Pyramid factor {factor} is not a multiple of the slice step {slice_step}")
+    return volume[::factor // slice_step, ::factor, ::factor]
+
+def axis_error_deg(matrix:np.ndarray, reference_matrix:np.ndarray) -> float:
+    """
+    Largest angle in degrees between the corresponding axes of two alignment matrices, ignoring their direction.
+    """
+    cosines = np.abs( np.sum(matrix[:3, :3] * reference_matrix[:3, :3], axis=1) )
+    return float( np.degrees( np.arccos( np.clip(cosines, 0, 1) ) ).max() )
+
+def aligned_slice_geometry(matrix:np.ndarray, spacing:Tuple[float, float, float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Geometry that displays the original slices aligned, as an alternative to resampling them.
+    
+    `matrix` is the world-to-local matrix of calculate_rotated_bounding_box, `spacing` the (slice, row, column) spacing.
+    The rotation is applied to physical coordinates: voxel index p is placed at R @ (spacing * (p - o)), where o is the
+    corner of the box, with (z, y, x) mapped to patient (x, y, z) like the resampled output. For anisotropic voxels this
+    keeps the slices rigid, so the orientation only approximates the one of the resampled output.
+    
+    Returns:
+        ImageOrientationPatient (row and column direction cosines), ImagePositionPatient of the first slice
+        and the position offset from one slice to the next
+    """
+    rotation = matrix[:3, :3]
+    spacing = np.asarray(spacing, dtype=np.float64)
+    box_origin = -rotation.T @ matrix[:3, 3]
+    # columns of the rotation in patient (x, y, z) order
+    directions = rotation[::-1]
+    orientation = np.concatenate( (directions[:, 2], directions[:, 1]) )
+    first_position = directions @ (spacing * -box_origin)
+    slice_offset = directions[:, 0] * spacing[0]
+    return orientation, first_position, slice_offset
 
 def transform_points(points:np.ndarray, matrix:np.ndarray):
     
@@ -100,46 +400,158 @@ def transform_points(points:np.ndarray, matrix:np.ndarray):
     
     return transformed_points
 
-def transform_image(image:np.ndarray, matrix:np.ndarray, interpolation_order=3):
-    
-    bounding_box = np.array([
-        [0, 0, 0],
-        [image.shape[0], 0, 0],
-        [0, image.shape[1], 0],
-        [0, 0, image.shape[2]],
-        [image.shape[0], image.shape[1], 0],
-        [image.shape[0], 0, image.shape[2]],
-        [0, image.shape[1], image.shape[2]],
-        image.shape
-    ])
-    #logging.debug(f'bounding_box: {bounding_box}')
-    
-    transformed_bounding_box = transform_points( bounding_box, matrix )
-    #logging.debug(f'transformed_bounding_box: {transformed_bounding_box}')
-    
-    # Find minimum and maximum values for x, y, z
-    min_coords = transformed_bounding_box.min(axis=0)  # Minimum x, y, z
-    max_coords = transformed_bounding_box.max(axis=0)  # Maximum x, y, z
-
-    #logging.debug(f"Minimum coordinates (x, y, z): {min_coords}")
-    #logging.debug(f"Maximum coordinates (x, y, z): {max_coords}")
-    
-    transformed_image = affine_transform(
-        image, 
-        matrix=np.linalg.inv(matrix),
-        offset=min_coords*-1, 
-        output_shape=( int(max_coords[0])+1, int(max_coords[1])+1, int(max_coords[2])+1 ),
-        order=interpolation_order
-    )
-    return transformed_image
+def spline_prefilter(image:np.ndarray, interpolation_order:int=3, dtype=np.float64, max_workers:Optional[int]=None, 
+                     scratch:Optional[ScratchSpace]=None, memory_budget:Optional[int]=None) -> np.ndarray:
+    """
+    Spline prefilter of `image` as done by scipy's affine_transform, parallelized over chunks.
+    
+    The 1D filter along each axis is applied to chunks taken along another axis on a thread pool.
+    With dtype=np.float32, the coefficients need half the memory at a small loss of precision.
+    With a `scratch` space, the coefficients are kept in a memory-mapped scratch file.
+    With a `memory_budget`, the chunks are small enough for the chunks in flight to stay within it.
+    """
+    from scipy.ndimage import spline_filter1d
+    filtered = allocate(image.shape, dtype, scratch)
+    workers = max_workers or os.cpu_count() or 1
+    num_chunks = 4 * workers
+    if memory_budget is not None:
+        # source and coefficients of every chunk in flight
+        chunk_bytes = max(1, memory_budget // workers)
+        num_chunks = max( num_chunks, -(-image.size * (image.itemsize + filtered.itemsize) // chunk_bytes) )
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for axis in range(image.ndim):
+            source = image if axis == 0 else filtered
+            # split along the largest of the other axes
+            split_axis = max( (a for a in range(image.ndim) if a != axis), key=lambda a: image.shape[a] )
+            bounds = np.linspace(0, image.shape[split_axis], num=min(image.shape[split_axis], num_chunks) + 1, dtype=int)
+            
+            def filter_chunk( chunk:Tuple[int, int] ):
+                index = [slice(None)] * image.ndim
+                index[split_axis] = slice(*chunk)
+                index = tuple(index)
+                spline_filter1d(source[index], interpolation_order, axis=axis, output=filtered[index], mode="constant")
+                
+            list( pool.map(filter_chunk, zip(bounds[:-1], bounds[1:])) )
+    return filtered
+
+def _box_corners(min_coords:np.ndarray, max_coords:np.ndarray) -> np.ndarray:
+    return np.array([ [x, y, z] for x in (min_coords[0], max_coords[0]) 
+                                for y in (min_coords[1], max_coords[1]) 
+                                for z in (min_coords[2], max_coords[2]) ], dtype=np.float64)
+
+def foreground_bounds(cuboid_corners:np.ndarray, matrix:np.ndarray, margin:float=0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Extent of the rotated bounding box returned by calculate_rotated_bounding_box in the aligned frame, 
+    grown by `margin` voxels on each side. Can be passed as `bounds` to transform_image.
+    """
+    local_corners = transform_points(cuboid_corners, matrix)
+    return local_corners.min(axis=0) - margin, local_corners.max(axis=0) + margin
+
+def transform_output_geometry(image_shape:Tuple[int, int, int], matrix:np.ndarray, bounds:Optional[Tuple[np.ndarray, np.ndarray]]=None) -> Tuple[Tuple[int, int, int], np.ndarray]:
+    """
+    Shape of the output of transform_image and the local coordinates of its index 0.
+    """
+    if bounds is None:
+        bounding_box = np.array([
+            [0, 0, 0],
+            [image_shape[0], 0, 0],
+            [0, image_shape[1], 0],
+            [0, 0, image_shape[2]],
+            [image_shape[0], image_shape[1], 0],
+            [image_shape[0], 0, image_shape[2]],
+            [0, image_shape[1], image_shape[2]],
+            image_shape
+        ])
+        #logging.debug(f'bounding_box: {bounding_box}')
+        
+        transformed_bounding_box = transform_points( bounding_box, matrix )
+        #logging.debug(f'transformed_bounding_box: {transformed_bounding_box}')
+        
+        # Find maximum values for x, y, z
+        max_coords = transformed_bounding_box.max(axis=0)  # Maximum x, y, z
+        output_origin = np.zeros(3)
+    else:
+        output_origin = np.floor(bounds[0])
+        max_coords = bounds[1] - output_origin
+    output_shape = ( int(max_coords[0])+1, int(max_coords[1])+1, int(max_coords[2])+1 )
+    return output_shape, output_origin
 
-def trim_image(volume:np.ndarray) -> np.ndarray:
-    # Find the indices of non-zero elements
-    non_zero_indices = np.argwhere(volume != 0)
+def transform_image(image:np.ndarray, matrix:np.ndarray, interpolation_order=3, prefilter_dtype=np.float64, 
+                    max_workers:Optional[int]=None, tile_bytes:int=DEFAULT_TILE_BYTES, 
+                    bounds:Optional[Tuple[np.ndarray, np.ndarray]]=None, output:Optional[np.ndarray]=None, 
+                    scratch:Optional[ScratchSpace]=None, memory_budget:Optional[int]=None):
+    """
+    Resamples `image` into the frame given by the world-to-local `matrix`, i.e. output index = matrix @ input index.
+    
+    The output is split into slabs along axis 0 with at most `tile_bytes` each, which are resampled on a thread pool.
+    For interpolation orders > 1 the spline prefilter is computed once in `prefilter_dtype`.
+    
+    If `bounds` (min and max local coordinates, see foreground_bounds) are given, only that region is resampled
+    and only the part of `image` it maps from is prefiltered. Output index 0 is then at floor(min).
+    Otherwise the output covers local coordinates from 0 to the maximum of the transformed image box.
+    
+    An `output` array with the shape from transform_output_geometry can be passed to resample into it.
+    With a `scratch` space, the prefilter and the output are memory-mapped scratch files, the prefilter is released
+    when done. With a `memory_budget`, it bounds the prefilter chunks and the slabs in flight instead of `tile_bytes`.
+    """
+    from scipy.ndimage import affine_transform
+    output_shape, output_origin = transform_output_geometry(image.shape, matrix, bounds)
+    output_dtype = image.dtype
+    
+    # output index -> input index
+    inverse_matrix = np.linalg.inv(matrix)
+    rotation, translation = inverse_matrix[:3, :3], inverse_matrix[:3, 3] + inverse_matrix[:3, :3] @ output_origin
+    
+    if bounds is not None:
+        # crop the input to the region the output maps from, with room for the spline support and the prefilter boundary
+        padding = 12 if interpolation_order > 1 else interpolation_order + 1
+        input_corners = _box_corners(np.zeros(3), np.array(output_shape) - 1) @ rotation.T + translation
+        input_min = np.clip( np.floor(input_corners.min(axis=0)).astype(int) - padding, 0, image.shape )
+        input_max = np.clip( np.ceil(input_corners.max(axis=0)).astype(int) + padding + 1, 0, image.shape )
+        image = image[ input_min[0]:input_max[0], input_min[1]:input_max[1], input_min[2]:input_max[2] ]
+        translation = translation - input_min
+    
+    if interpolation_order > 1:
+        image = spline_prefilter(image, interpolation_order, dtype=prefilter_dtype, max_workers=max_workers, scratch=scratch, memory_budget=memory_budget)
+    
+    transformed_image = allocate(output_shape, output_dtype, scratch) if output is None else output
+    
+    if memory_budget is not None:
+        tile_bytes = max(1, memory_budget // (max_workers or os.cpu_count() or 1))
+    slab_bytes = output_shape[1] * output_shape[2] * transformed_image.itemsize
+    slab_size = max(1, tile_bytes // max(1, slab_bytes))
+    
+    def transform_slab( z0:int ):
+        z1 = min(z0 + slab_size, output_shape[0])
+        affine_transform(
+            image, 
+            matrix=rotation,
+            offset=translation + rotation @ np.array([z0, 0, 0]), 
+            output_shape=(z1 - z0,) + output_shape[1:],
+            output=transformed_image[z0:z1],
+            order=interpolation_order,
+            prefilter=False
+        )
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list( pool.map(transform_slab, range(0, output_shape[0], slab_size)) )
+    if interpolation_order > 1 and scratch is not None:
+        scratch.release(image)
+    return transformed_image
 
-    # Get the bounding box coordinates
-    min_coords = non_zero_indices.min(axis=0)  # Minimum along each dimension
-    max_coords = non_zero_indices.max(axis=0) + 1  # Maximum along each dimension (inclusive)
+def trim_image(volume:np.ndarray, slab_size:int=DEFAULT_SLAB_SIZE) -> np.ndarray:
+    # Find the bounding box of the non-zero elements from per-slab projections
+    min_coords = np.array(volume.shape)
+    max_coords = np.zeros(3, dtype=int)
+    for z0, mask in _iter_foreground_slabs(volume, slab_size=slab_size):
+        for axis, projection in enumerate( (mask.any(axis=(1, 2)), mask.any(axis=(0, 2)), mask.any(axis=(0, 1))) ):
+            indices = np.flatnonzero(projection)
+            if indices.size > 0:
+                offset = z0 if axis == 0 else 0
+                min_coords[axis] = min( min_coords[axis], indices[0] + offset )
+                max_coords[axis] = max( max_coords[axis], indices[-1] + offset + 1 )  # Maximum along each dimension (inclusive)
+    if np.any(min_coords >= max_coords):
+        raise ValueError("Volume has no non-zero elements")
 
     # Slice the volume to the bounding box
     trimmed_volume = volume[
@@ -150,7 +562,20 @@ def trim_image(volume:np.ndarray) -> np.ndarray:
 
     return trimmed_volume
     
+def warm_up(size:int=24) -> None:
+    """
+    Runs the stages on a small synthetic volume, to import scipy and scikit-image and take
+    their first call overhead before the first request.
+    """
+    volume = np.full((size, size, size), 100, dtype=np.uint16)
+    volume[size // 4:3 * size // 4, size // 3:2 * size // 3, 2:size - 2] = 2000
+    threshold_value = otsu_threshold(volume)
+    component = largest_component(volume, threshold_value)
+    corners, matrix = calculate_rotated_bounding_box(volume, threshold_value, component=component)
+    transform_image(volume, matrix, max_workers=1, bounds=foreground_bounds(corners, matrix, margin=DEFAULT_CROP_MARGIN))
+
 async def save_slices_as_binary_images(volume:np.ndarray, step_size:int=1) -> str:
+    from PIL import Image
     
     folder = await create_temp_folder()
 
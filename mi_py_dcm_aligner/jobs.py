@@ -0,0 +1,109 @@
+# built-in
+from typing import Optional, Callable, Awaitable, Dict, Any
+from collections import OrderedDict
+import logging, asyncio, uuid, time
+
+# pip
+from pydantic import BaseModel
+
+ProgressCallback = Callable[[str, float], None]
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_JOB_QUEUE_SIZE = 16
+DEFAULT_MAX_FINISHED_JOBS = 1000
+
+class JobQueueFullError(Exception):
+    pass
+
+class JobStatus(BaseModel):
+    job_id:str
+    state:str                       = "queued" # queued, running, done, failed
+    progress:Dict[str, float]       = {}
+    error:Optional[str]             = None
+    submitted_at:float              = 0
+    started_at:Optional[float]      = None
+    finished_at:Optional[float]     = None
+
+class _Job:
+    def __init__( self, args:Any, stages:list[str] ):
+        self.status = JobStatus(job_id=uuid.uuid4().hex, progress={ stage: 0. for stage in stages }, submitted_at=time.time())
+        self.args = args
+        self.result:Optional[BaseModel] = None
+        
+    def report( self, stage:str, fraction:float ) -> None:
+        self.status.progress[stage] = min(1., max(0., fraction))
+
+class JobManager:
+    """
+    Runs submitted jobs on a fixed number of asyncio workers.
+    
+    Jobs wait in a queue of at most `max_queue` >= 1 jobs, a submit on a full queue raises JobQueueFullError 
+    so callers can apply backpressure. `run` is called with the job arguments and a progress callback taking the 
+    stage name and the fraction done. Finished jobs are kept until `max_finished` newer ones finished.
+    """
+    def __init__( self, run:Callable[[Any, ProgressCallback], Awaitable[BaseModel]], stages:list[str],
+                 max_workers:int=DEFAULT_JOB_WORKERS, max_queue:int=DEFAULT_JOB_QUEUE_SIZE, max_finished:int=DEFAULT_MAX_FINISHED_JOBS ):
+        if max_queue < 1:
+            # asyncio.Queue treats 0 as unbounded, which would disable the backpressure
+            raise ValueError(f"max_queue must be at least 1, not {max_queue}")
+        self.run = run
+        self.stages = stages
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max_queue
+        self.max_finished = max_finished
+        self._jobs:Dict[str, _Job] = {}
+        self._finished:OrderedDict[str, None] = OrderedDict()
+        self._queue:Optional[asyncio.Queue[_Job]] = None
+        self._workers:list[asyncio.Task] = []
+        
+    def _start( self ) -> None:
+        # the queue and the workers belong to the running event loop, so they are created on first use
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._workers = [ asyncio.create_task(self._work()) for _ in range(self.max_workers) ]
+    
+    async def _work( self ) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status.state = "running"
+            job.status.started_at = time.time()
+            try:
+                job.result = await self.run(job.args, job.report)
+                job.status.state = "done"
+            except Exception as e:
+                logging.exception(f'Job {job.status.job_id} failed')
+                job.status.state = "failed"
+                job.status.error = str(e)
+            except asyncio.CancelledError:
+                job.status.state = "failed"
+                job.status.error = "Job was cancelled"
+                raise
+            finally:
+                job.args = None
+                job.status.finished_at = time.time()
+                self._finish(job)
+                
+    def _finish( self, job:_Job ) -> None:
+        self._finished[job.status.job_id] = None
+        while len(self._finished) > self.max_finished:
+            job_id, _ = self._finished.popitem(last=False)
+            del self._jobs[job_id]
+    
+    def submit( self, args:Any ) -> JobStatus:
+        self._start()
+        job = _Job(args, self.stages)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f'Job queue is full ({self.max_queue} jobs waiting)')
+        self._jobs[job.status.job_id] = job
+        return job.status
+    
+    def status( self, job_id:str ) -> JobStatus:
+        return self._jobs[job_id].status
+    
+    def result( self, job_id:str ) -> Optional[BaseModel]:
+        return self._jobs[job_id].result
+    
+    def queued( self ) -> int:
+        return 0 if self._queue is None else self._queue.qsize()
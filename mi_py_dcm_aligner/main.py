@@ -1,11 +1,14 @@
 # built-in imports
-from typing import Tuple, Optional
-import os, sys
+from typing import Tuple, Optional, AsyncIterator, Callable, Awaitable, Literal
+from contextlib import asynccontextmanager
+import os, sys, copy, asyncio, tempfile, logging, math, threading
 
 # pip
-import aioshutil, pydicom
-from pydantic import BaseModel
-from fastapi import FastAPI
+import pydicom
+import numpy as np
+from pydantic import BaseModel, Field, model_validator
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
 import uvicorn
 
 # append current path to sys.path
@@ -14,67 +17,601 @@ if not parent_path in sys.path:
     sys.path.insert( 0, parent_path )
     
 # local
-from dicom import DcmSeriesDataSet, parse_dir, create_dicom_series, create_dcm_series_from_pngs
+from dicom import DcmSeriesDataSet, DicomSeries, create_dicom_series, create_dcm_series_from_volume, create_dcm_series_with_geometry, output_transfer_syntax, MIN_HEADER_PREFIX_SIZE
+from series_index import parse_dir_indexed, parse_dir_indexed_stream, DEFAULT_CRAWL_CONCURRENCY, DEFAULT_HEADER_PREFIX_SIZE, DEFAULT_WALK_CONCURRENCY
 from aiofiles_ext import find_files_with_ext, create_temp_folder
-from env import get_or_ask_and_wait_for_param
+from env import get_or_ask_and_wait_for_param, get_param
+from dataset_handles import DatasetHandles, UnknownHandleError, SeriesNotFoundError, select_series, DEFAULT_DATASET_TTL_SECONDS, DEFAULT_MAX_DATASETS
+from result_cache import ResultCache, ResultCacheStats, DEFAULT_RESULT_CACHE_FILE, DEFAULT_RESULT_CACHE_MAX_ENTRIES
+from volume_cache import VolumeCache, VolumeCacheStats, DEFAULT_VOLUME_CACHE_BYTES
+from process_pool import CpuStages
+from jobs import JobManager, JobStatus, JobQueueFullError, ProgressCallback, DEFAULT_JOB_WORKERS, DEFAULT_JOB_QUEUE_SIZE
+from metrics import StageMetrics, measure_stage, read_available_memory, registry as metrics_registry
+from coordinator import Coordinator, WorkerHealth, WorkerInfo, NoWorkerAvailableError, WorkerRequestError, register_with_coordinator, DEFAULT_HEALTH_INTERVAL, DEFAULT_RETRIES, DEFAULT_MIN_FREE_MEMORY_BYTES
 import image_3d_tools, log
 
-class Args(DcmSeriesDataSet):    
-    series_index:int
+class AlignOptions(BaseModel):
     series_description_suffix:str
     dcm_output_folder:Optional[str]=None
+    # resample: write the resampled volume; geometry: copy the original slices with an aligned orientation and position
+    output_mode:Literal["resample", "geometry"]="resample"
+    # lossless transfer syntax of resampled series, jpeg-ls and jpeg2000 need their pydicom plugins installed
+    output_transfer_syntax:Literal["explicit", "deflated", "rle", "jpeg-ls", "jpeg2000"]="explicit"
     threshold:Optional[float]=None
+    interpolation_order:int=Field(default=3, ge=0, le=5)
+    prefilter_float32:bool=False
+    crop_margin:Optional[float]=image_3d_tools.DEFAULT_CROP_MARGIN # None: resample the whole rotated volume and trim it
+    # matrix-only requests: estimate the axes on every pyramid_factor-th voxel, optionally refine them on the largest
+    # divisor of that factor (e.g. 8 -> 4, 6 -> 3) and report the error against the full resolution
+    pyramid_factor:Optional[int]=None
+    pyramid_refine:bool=False
+    pyramid_validate:bool=False
+    # keep the volume, the spline coefficients and the resampled volume in memory-mapped scratch files
+    # and process them in slabs sized to MEMORY_BUDGET_BYTES, for series that do not fit into RAM
+    out_of_core:bool=False
+    # add the time, io and memory of every stage to the results
+    include_metrics:bool=False
+    # align the largest connected foreground component only, labeled on a grid downsampled by component_factor;
+    # component_connectivity 1: faces, 2: edges, 3: corners; component_min_size in voxels, 422 if there is no such component
+    largest_component:bool=False
+    component_factor:int=Field(default=image_3d_tools.DEFAULT_COMPONENT_FACTOR, ge=1)
+    component_connectivity:int=Field(default=1, ge=1, le=3)
+    component_min_size:int=Field(default=1, ge=1)
+    # return the results of an identical earlier request, see ResultCache
+    use_result_cache:bool=True
     
+    @model_validator(mode="after")
+    def _check_pyramid_refine( self ) -> "AlignOptions":
+        # the refinement is restricted to the component of the coarse level, which needs a level that divides the factor
+        if self.pyramid_refine and self.pyramid_factor != None and self.pyramid_factor > 1 and _refine_level(self.pyramid_factor) == None:
+            raise ValueError(f"pyramid_refine needs a pyramid_factor with a divisor greater than 1, not {self.pyramid_factor}")
+        return self
+    
+    def needs_resampling( self ) -> bool:
+        return self.dcm_output_folder != None and self.output_mode == "resample"
+    
+    def pyramid_levels( self ) -> list[int]:
+        if self.needs_resampling() or self.pyramid_factor == None or self.pyramid_factor <= 1:
+            return []
+        if self.pyramid_refine and _refine_level(self.pyramid_factor) != None:
+            return [ self.pyramid_factor, _refine_level(self.pyramid_factor) ]
+        return [ self.pyramid_factor ]
+    
+    def slice_step( self ) -> int:
+        # only the slices needed by all pyramid levels are loaded
+        levels = self.pyramid_levels()
+        return math.gcd(*levels) if levels else 1
+
+def _refine_level( factor:int ) -> Optional[int]:
+    # the largest divisor of the pyramid factor except itself, None if there is none greater than 1
+    for level in range(factor // 2, 1, -1):
+        if factor % level == 0:
+            return level
+    return None
+
+class Args(DcmSeriesDataSet, AlignOptions):
+    """
+    The series to align is given by `series_uid` or `series_index` in the data set, which is either sent 
+    in full or referred to by the `handle` returned by /parse_dir.
+    """
+    series_index:Optional[int]=None
+    series_uid:Optional[str]=None
+    
+cpu_stages = CpuStages( get_param("CPU_PROCESSES", default=os.cpu_count() or 1, value_type=int) )
+volume_cache = VolumeCache( get_param("VOLUME_CACHE_BYTES", default=DEFAULT_VOLUME_CACHE_BYTES, value_type=int), memory_space=cpu_stages.memory_space() )
+scratch_dir = get_param("SCRATCH_DIR", default=tempfile.gettempdir())
+memory_budget = get_param("MEMORY_BUDGET_BYTES", default=256 * 1024**2, value_type=int)
+result_cache = ResultCache( get_param("RESULT_CACHE_FILE", default=DEFAULT_RESULT_CACHE_FILE),
+                            max_entries=get_param("RESULT_CACHE_MAX_ENTRIES", default=DEFAULT_RESULT_CACHE_MAX_ENTRIES, value_type=int) )
+dataset_handles = DatasetHandles( ttl=get_param("DATASET_TTL_SECONDS", default=DEFAULT_DATASET_TTL_SECONDS, value_type=float),
+                                  max_entries=get_param("MAX_DATASETS", default=DEFAULT_MAX_DATASETS, value_type=int) )
+# start the CPU workers and import the numeric libraries right after startup instead of in the first request
+warm_up_enabled = get_param("WARM_UP", default=False, value_type=lambda x: str(x).lower() == "true")
+# coordinator mode: /align and the align jobs are routed to the workers in WORKER_URLS and those registered at /workers
+coordinator_enabled = get_param("COORDINATOR", default=False, value_type=lambda x: str(x).lower() == "true")
+coordinator = Coordinator( [ url for url in get_param("WORKER_URLS", default="").split(",") if url ],
+                           health_interval=get_param("WORKER_HEALTH_INTERVAL", default=DEFAULT_HEALTH_INTERVAL, value_type=float),
+                           retries=get_param("WORKER_RETRIES", default=DEFAULT_RETRIES, value_type=int),
+                           min_free_memory=get_param("WORKER_MIN_FREE_MEMORY_BYTES", default=DEFAULT_MIN_FREE_MEMORY_BYTES, value_type=int) )
+# worker mode: register as WORKER_URL at the coordinator at COORDINATOR_URL on startup
+coordinator_url = get_param("COORDINATOR_URL")
+worker_url = get_param("WORKER_URL")
+active_alignments = 0
+
 class Results(BaseModel):
     threshold:Optional[float]           = None
     matrix:list[list[float]]|None       = None
     rot_matrix:list[list[float]]|None   = None
     translation:list[float]|None        = None
     output_folder:Optional[str]         = None
+    pyramid_error_deg:Optional[float]   = None
+    stages:Optional[dict[str, StageMetrics]] = None
+    cached:bool                         = False
     
-async def align(args:Args) -> Results:
+ALIGN_STAGES = ["load", "threshold", "component", "axes", "resample", "write"]
+
+def _no_progress( stage:str, fraction:float ):
+    pass
+
+async def load_stage(series_data_set:DcmSeriesDataSet, series_index:int, report:ProgressCallback=_no_progress, slice_step:int=1, out_of_core:bool=False, 
+                     breakdown:Optional[dict[str, StageMetrics]]=None) -> DicomSeries:
+    with measure_stage("load", breakdown):
+        if out_of_core:
+            # out-of-core volumes live in scratch files and are not kept in the volume cache
+            scratch = image_3d_tools.ScratchSpace(scratch_dir)
+            try:
+                dcm_series = await create_dicom_series( series_data_set, series_index, slice_step=slice_step, scratch=scratch, memory_budget=memory_budget )
+            except BaseException:
+                scratch.close()
+                raise
+        else:
+            dcm_series = await volume_cache.get_or_load( series_data_set, series_index, slice_step=slice_step )
+    report( "load", 1 )
+    return dcm_series
+
+def release_series(dcm_series:Optional[DicomSeries]) -> None:
+    """
+    Removes the scratch files of an out-of-core series, including the resampled volume, once it has been written.
+    """
+    if dcm_series is not None and dcm_series.scratch is not None:
+        dcm_series.scratch.close()
+
+async def _largest_component(options:AlignOptions, shared_volume, threshold_value:float, slab_size:int=image_3d_tools.DEFAULT_SLAB_SIZE, scale:int=1, 
+                             breakdown:Optional[dict[str, StageMetrics]]=None, 
+                             within:Optional[image_3d_tools.ComponentMask]=None) -> Optional[image_3d_tools.ComponentMask]:
+    if not options.largest_component:
+        return None
+    with measure_stage("component", breakdown):
+        return await cpu_stages.largest_component( shared_volume, threshold_value, factor=options.component_factor, connectivity=options.component_connectivity, 
+                                                   min_size=options.component_min_size // scale**3, slab_size=slab_size, within=within )
+
+async def _compute_pyramid(options:AlignOptions, dcm_series:DicomSeries, report:ProgressCallback, 
+                           load_full_resolution:Callable[[], Awaitable[DicomSeries]]|None, breakdown:Optional[dict[str, StageMetrics]]) -> Results:
+    align_results = Results()
+    threshold_value = options.threshold
+    component = None
+    coarse_level = None
+    for level in options.pyramid_levels():
+        with measure_stage("pyramid", breakdown):
+            level_volume = await asyncio.to_thread( np.ascontiguousarray, image_3d_tools.pyramid_level(dcm_series.volume, level, dcm_series.slice_step) )
+        async with cpu_stages.share(level_volume) as shared_volume:
+            if threshold_value == None:
+                with measure_stage("threshold", breakdown):
+                    threshold_value = await cpu_stages.otsu_threshold(shared_volume)
+                report( "threshold", 1 )
+            # the refinement keeps the threshold of the coarse level and labels only the foreground near its component
+            within = component.scaled( coarse_level // level, margin=1 ) if component != None else None
+            component = await _largest_component(options, shared_volume, threshold_value, scale=level, breakdown=breakdown, within=within)
+            coarse_level = level
+            with measure_stage("axes", breakdown):
+                _, transformation_matrix = await cpu_stages.calculate_rotated_bounding_box(shared_volume, threshold_value=threshold_value, scale=level, component=component)
+    align_results.threshold = threshold_value
+    align_results.matrix = transformation_matrix.tolist()
+    align_results.rot_matrix = transformation_matrix[:3, :3].tolist()
+    align_results.translation = transformation_matrix[:3, 3].tolist() 
     
-    # inputs
-    png_folder = None
-    try:        
-        # load series             
-        dcm_series = await create_dicom_series( args, args.series_index )
-        volume = dcm_series.volume
-        
+    if options.pyramid_validate and load_full_resolution != None:
+        full_resolution = await load_full_resolution()
+        try:
+            async with cpu_stages.share(full_resolution.volume) as shared_volume:
+                with measure_stage("validate", breakdown):
+                    component = await _largest_component(options, shared_volume, threshold_value)
+                    _, reference_matrix = await cpu_stages.calculate_rotated_bounding_box(shared_volume, threshold_value=threshold_value, component=component)
+        finally:
+            release_series(full_resolution)
+        align_results.pyramid_error_deg = image_3d_tools.axis_error_deg(transformation_matrix, reference_matrix)
+    report( "threshold", 1 )
+    report( "component", 1 )
+    report( "axes", 1 )
+    report( "resample", 1 )
+    return align_results
+
+async def compute_stage(options:AlignOptions, dcm_series:DicomSeries, report:ProgressCallback=_no_progress, 
+                        load_full_resolution:Callable[[], Awaitable[DicomSeries]]|None=None, 
+                        breakdown:Optional[dict[str, StageMetrics]]=None) -> Tuple[Results, Optional[np.ndarray]]:
+    """
+    Finds the alignment of a loaded series and, if an output folder is requested, resamples the volume.
+    The cpu heavy work runs outside of the event loop.
+    
+    Matrix-only requests with a pyramid_factor are estimated on pyramid levels of the series, which must have been
+    loaded with options.slice_step(). `load_full_resolution` is needed to validate them against the full resolution.
+    
+    The metrics of the stages are recorded and, if given, added to `breakdown`.
+    """
+    if options.pyramid_levels():
+        return await _compute_pyramid(options, dcm_series, report, load_full_resolution, breakdown), None
+    
+    volume = dcm_series.volume
+    slab_size = image_3d_tools.slab_size_for_budget(volume.shape, memory_budget) if options.out_of_core else image_3d_tools.DEFAULT_SLAB_SIZE
+    # the resampled volume of an out-of-core series goes to the scratch space of the series
+    resample_budget = memory_budget if options.out_of_core else None
+    align_results = Results()      
+    async with cpu_stages.share(volume) as shared_volume:
         # threshold to get foreground object
-        align_results = Results()      
-        binary_volume, align_results.threshold = image_3d_tools.threshold(volume, binary_value=255, threshold_value=args.threshold)  
+        with measure_stage("threshold", breakdown):
+            align_results.threshold = options.threshold if options.threshold != None else await cpu_stages.otsu_threshold(shared_volume, slab_size=slab_size)
+        report( "threshold", 1 )
         
-        # find rotated box around that object
-        _, transformation_matrix = image_3d_tools.calculate_rotated_bounding_box(binary_volume)
-        binary_volume = None
+        # keep the biggest object only
+        component = await _largest_component(options, shared_volume, align_results.threshold, slab_size=slab_size, breakdown=breakdown)
+        report( "component", 1 )
+        
+        # find rotated box around that object, thresholding on the fly
+        with measure_stage("axes", breakdown):
+            cuboid_corners, transformation_matrix = await cpu_stages.calculate_rotated_bounding_box(shared_volume, threshold_value=align_results.threshold, slab_size=slab_size, 
+                                                                                                     component=component)
         align_results.matrix = transformation_matrix.tolist()
         align_results.rot_matrix = transformation_matrix[:3, :3].tolist()
         align_results.translation = transformation_matrix[:3, 3].tolist() 
+        report( "axes", 1 )
                 
-        # transform image and write pngs        
-        if args.dcm_output_folder != None:            
-            volume = image_3d_tools.transform_image( volume, transformation_matrix )
-            volume = image_3d_tools.trim_image( volume )
-            png_folder = await image_3d_tools.save_slices_as_binary_images( volume)
-            
-            # TODO: write dcms
-            template = dcm_series.datasets[ 0 ]
-
-            series_desc = template.get("SeriesDescription", "")
-            template.SeriesDescription = series_desc + args.series_description_suffix
-            
-            slice_thickness = dcm_series.slice_thickness or 0
-            
-            def per_instance_cb( idx:int, ds:pydicom.Dataset ):
-                ds.ImagePositionPatient = [0, 0, idx * slice_thickness ]
-                
-            align_results.output_folder = await create_dcm_series_from_pngs( template, png_folder, args.dcm_output_folder, per_instance_cb=per_instance_cb )
-            
+        # transform image
+        if not options.needs_resampling():
+            report( "resample", 1 )
+            return align_results, None
+        
+        prefilter_dtype = np.float32 if options.prefilter_float32 else np.float64
+        if options.crop_margin != None:
+            # only resample the region of the object
+            bounds = image_3d_tools.foreground_bounds( cuboid_corners, transformation_matrix, margin=options.crop_margin )
+            with measure_stage("resample", breakdown):
+                volume = await cpu_stages.transform_image( shared_volume, transformation_matrix, interpolation_order=options.interpolation_order, prefilter_dtype=prefilter_dtype, 
+                                                           bounds=bounds, scratch=dcm_series.scratch, memory_budget=resample_budget )
+        else:
+            with measure_stage("resample", breakdown):
+                volume = await cpu_stages.transform_image( shared_volume, transformation_matrix, interpolation_order=options.interpolation_order, prefilter_dtype=prefilter_dtype, 
+                                                           scratch=dcm_series.scratch, memory_budget=resample_budget )
+            with measure_stage("trim", breakdown):
+                volume = await asyncio.to_thread( image_3d_tools.trim_image, volume, slab_size )
+        report( "resample", 1 )
+        return align_results, volume
+    
+def _write_progress(report:ProgressCallback, total:int) -> Callable[[], None]:
+    # per_instance_cb runs on the writer threads, the count and the reports are serialized so progress only increases
+    lock = threading.Lock()
+    written = 0
+    def advance():
+        nonlocal written
+        with lock:
+            written += 1
+            report( "write", written / total )
+    return advance
+
+async def _write_geometry(options:AlignOptions, dcm_series:DicomSeries, align_results:Results, files:list[str], report:ProgressCallback) -> str:
+    row_spacing, column_spacing = dcm_series.pixel_spacing or (1., 1.)
+    spacing = ( dcm_series.slice_thickness or 1., row_spacing, column_spacing )
+    orientation, first_position, slice_offset = image_3d_tools.aligned_slice_geometry( np.array(align_results.matrix), spacing )
+    
+    advance = _write_progress( report, len(files) )
+    def per_instance_cb( idx:int, ds:pydicom.Dataset ):
+        ds.SeriesDescription = ds.get("SeriesDescription", "") + options.series_description_suffix
+        advance()
+    
+    return await create_dcm_series_with_geometry( files, orientation, first_position, slice_offset, options.dcm_output_folder, per_instance_cb=per_instance_cb )
+
+async def write_stage(options:AlignOptions, dcm_series:DicomSeries, align_results:Results, volume:Optional[np.ndarray], report:ProgressCallback=_no_progress, 
+                      breakdown:Optional[dict[str, StageMetrics]]=None, files:Optional[list[str]]=None) -> Results:
+    """
+    Writes the output series: the resampled `volume` or, in geometry output mode, a copy of all `files` of the series
+    (default: the loaded files) with aligned geometry.
+    """
+    if options.dcm_output_folder != None and options.output_mode == "geometry":
+        with measure_stage("write", breakdown):
+            align_results.output_folder = await _write_geometry( options, dcm_series, align_results, files or dcm_series.files, report )
+        return align_results
+    
+    if volume is None:
+        report( "write", 1 )
         return align_results
+    
+    # the datasets may be shared with other requests through the volume cache
+    template = copy.deepcopy( dcm_series.datasets[ 0 ] )
+
+    series_desc = template.get("SeriesDescription", "")
+    template.SeriesDescription = series_desc + options.series_description_suffix
+    
+    slice_thickness = dcm_series.slice_thickness or 0
+    
+    num_slices = volume.shape[0]
+    advance = _write_progress( report, num_slices )
+    def per_instance_cb( idx:int, ds:pydicom.Dataset ):
+        ds.ImagePositionPatient = [0, 0, idx * slice_thickness ]
+        advance()
+        
+    with measure_stage("write", breakdown):
+        align_results.output_folder = await create_dcm_series_from_volume( template, volume, options.dcm_output_folder, per_instance_cb=per_instance_cb,
+                                                                           transfer_syntax_uid=output_transfer_syntax(options.output_transfer_syntax) )
+    return align_results
+
+# options which do not change the results
+_UNCACHED_OPTIONS = { "include_metrics", "out_of_core", "use_result_cache" }
+
+async def _cached_results(options:AlignOptions, series_data_set:DcmSeriesDataSet, series_index:int, 
+                          breakdown:Optional[dict[str, StageMetrics]]=None) -> Tuple[Optional[str], Optional[Results]]:
+    """
+    The result cache key of a request, None if it is not to be cached, and the cached results if there are any.
+    """
+    if not options.use_result_cache or not result_cache.enabled:
+        return None, None
+    with measure_stage("result_cache", breakdown):
+        cache_options = options.model_dump( include=set(AlignOptions.model_fields) - _UNCACHED_OPTIONS )
+        key = await result_cache.key( series_data_set, series_index, cache_options )
+        cached = await result_cache.get( key )
+    if cached is None:
+        return key, None
+    align_results = Results.model_validate_json( cached )
+    align_results.cached = True
+    return key, align_results
+
+async def _cache_results(key:Optional[str], align_results:Results) -> None:
+    if key != None:
+        await result_cache.put( key, align_results.model_dump_json(exclude={"stages", "cached"}), align_results.output_folder )
+
+async def run_align(args:Args, progress:ProgressCallback|None=None) -> Results:
+    """
+    Runs an alignment and reports the fraction done of each of the ALIGN_STAGES to `progress`.
+    """
+    global active_alignments
+    active_alignments += 1
+    try:
+        return await _run_align( args, progress )
+    finally:
+        active_alignments -= 1
+
+async def _run_align(args:Args, progress:ProgressCallback|None=None) -> Results:
+    report = progress or _no_progress
+    breakdown = {} if args.include_metrics else None
+    series_data_set, series_index = dataset_handles.resolve( args, args.series_index, args.series_uid )
+    key, align_results = await _cached_results( args, series_data_set, series_index, breakdown )
+    if align_results != None:
+        for stage in ALIGN_STAGES:
+            report( stage, 1 )
+        align_results.stages = breakdown
+        return align_results
+    
+    dcm_series = await load_stage( series_data_set, series_index, report, slice_step=args.slice_step(), out_of_core=args.out_of_core, breakdown=breakdown )
+    try:
+        align_results, volume = await compute_stage( args, dcm_series, report, lambda: load_stage(series_data_set, series_index, out_of_core=args.out_of_core, breakdown=breakdown), breakdown )
+        align_results = await write_stage( args, dcm_series, align_results, volume, report, breakdown, files=series_data_set.files[series_index] )
+    finally:
+        release_series( dcm_series )
+    await _cache_results( key, align_results )
+    align_results.stages = breakdown
+    return align_results
+
+async def dispatch_align(args:Args, progress:ProgressCallback|None=None) -> Results:
+    """
+    Runs an alignment, in coordinator mode on one of the workers.
+    """
+    if not coordinator_enabled:
+        return await run_align( args, progress )
+    series_data_set, series_index = dataset_handles.resolve( args, args.series_index, args.series_uid )
+    # the workers do not know the handles of the coordinator, so the files of the series are sent along
+    payload = args.model_dump(mode="json")
+    payload.update( series_data_set.single_series(series_index).model_dump(mode="json"), series_index=0, series_uid=None )
+    align_results = Results.model_validate( await coordinator.post("/align", payload, series_data_set.uids[series_index]) )
+    for stage in ALIGN_STAGES:
+        (progress or _no_progress)( stage, 1 )
+    return align_results
+
+def _resolve_or_404(series_data_set:DcmSeriesDataSet, series_index:Optional[int]=None, series_uid:Optional[str]=None) -> Tuple[DcmSeriesDataSet, int]:
+    try:
+        return dataset_handles.resolve( series_data_set, series_index, series_uid )
+    except (UnknownHandleError, SeriesNotFoundError) as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+
+def _check_output_or_400(options:AlignOptions) -> None:
+    try:
+        output_transfer_syntax( options.output_transfer_syntax )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _check_crawl_or_422(concurrency:int, prefix_size:int, walk_concurrency:int) -> None:
+    if concurrency < 1 or walk_concurrency < 1:
+        raise HTTPException(status_code=422, detail="concurrency and walk_concurrency must be at least 1")
+    if prefix_size < MIN_HEADER_PREFIX_SIZE:
+        raise HTTPException(status_code=422, detail=f"prefix_size must be at least {MIN_HEADER_PREFIX_SIZE}")
+
+async def parse_dir(directory:str, concurrency:int=DEFAULT_CRAWL_CONCURRENCY, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE, 
+                    full_rescan:bool=False, walk_concurrency:int=DEFAULT_WALK_CONCURRENCY) -> DcmSeriesDataSet:
+    """
+    Parses `directory` and registers the data set, requests can refer to it by the returned handle.
+    `walk_concurrency` directories are listed at a time and `concurrency` headers read at a time.
+    """
+    _check_crawl_or_422( concurrency, prefix_size, walk_concurrency )
+    series_data_set = await parse_dir_indexed(directory, concurrency=concurrency, prefix_size=prefix_size, full_rescan=full_rescan, 
+                                              walk_concurrency=walk_concurrency)
+    dataset_handles.register(series_data_set)
+    return series_data_set
+
+async def align(args:Args) -> Results:
+    _resolve_or_404( args, args.series_index, args.series_uid )
+    _check_output_or_400( args )
+    try:
+        return await dispatch_align(args)
+    except NoWorkerAvailableError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+    except WorkerRequestError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except image_3d_tools.ComponentNotFoundError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+async def parse_dir_stream(directory:str, concurrency:int=DEFAULT_CRAWL_CONCURRENCY, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE, 
+                           full_rescan:bool=False, walk_concurrency:int=DEFAULT_WALK_CONCURRENCY) -> StreamingResponse:
+    """
+    Like /parse_dir but streams NDJSON records while crawling: one per series when it is first seen, 
+    then the files found since the last record of a series, and a final "done" record.
+    """
+    _check_crawl_or_422( concurrency, prefix_size, walk_concurrency )
+    async def ndjson():
+        async for event in parse_dir_indexed_stream(directory, concurrency=concurrency, prefix_size=prefix_size, full_rescan=full_rescan, 
+                                                    register=dataset_handles.register, walk_concurrency=walk_concurrency):
+            yield event.model_dump_json() + "\n"
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+class BatchItem(AlignOptions):
+    series_index:Optional[int]=None
+    series_uid:Optional[str]=None
+
+class BatchArgs(DcmSeriesDataSet):
+    items:list[BatchItem]
+    
+class BatchResult(BaseModel):
+    item_index:int
+    series_index:Optional[int]  = None
+    series_uid:Optional[str]    = None
+    results:Optional[Results]   = None
+    error:Optional[str]         = None
+    
+async def _run_batch(series_data_set:DcmSeriesDataSet, items:list[BatchItem]) -> AsyncIterator[BatchResult]:
+    """
+    Aligns the series of a batch in a pipeline: series k+1 is loaded while series k is computed 
+    and series k-1 is written. Yields the results in the order of the items as they finish.
+    """
+    loaded:asyncio.Queue = asyncio.Queue(maxsize=1)
+    computed:asyncio.Queue = asyncio.Queue(maxsize=1)
+    finished:asyncio.Queue = asyncio.Queue()
+    
+    async def load():
+        for item_index, item in enumerate(items):
+            result = BatchResult(item_index=item_index, series_index=item.series_index, series_uid=item.series_uid)
+            dcm_series = None
+            key = None
+            breakdown = {} if item.include_metrics else None
+            try:
+                result.series_index = select_series(series_data_set, item.series_index, item.series_uid)
+                result.series_uid = series_data_set.uids[result.series_index]
+                key, result.results = await _cached_results(item, series_data_set, result.series_index, breakdown)
+                if result.results is None:
+                    dcm_series = await load_stage(series_data_set, result.series_index, slice_step=item.slice_step(), out_of_core=item.out_of_core, breakdown=breakdown)
+            except Exception as e:
+                result.error = str(e)
+            await loaded.put( (item, result, dcm_series, key, breakdown) )
+        await loaded.put(None)
+    
+    async def compute():
+        while (entry := await loaded.get()) is not None:
+            item, result, dcm_series, key, breakdown = entry
+            volume = None
+            if result.error is None and result.results is None:
+                try:
+                    series_index = result.series_index
+                    result.results, volume = await compute_stage(item, dcm_series, 
+                                                                 load_full_resolution=lambda: load_stage(series_data_set, series_index, out_of_core=item.out_of_core, breakdown=breakdown), 
+                                                                 breakdown=breakdown)
+                except Exception as e:
+                    result.error = str(e)
+            await computed.put( (item, result, dcm_series, volume, key, breakdown) )
+        await computed.put(None)
+        
+    async def write():
+        while (entry := await computed.get()) is not None:
+            item, result, dcm_series, volume, key, breakdown = entry
+            if result.error is None:
+                try:
+                    if not result.results.cached:
+                        result.results = await write_stage(item, dcm_series, result.results, volume, breakdown=breakdown, 
+                                                           files=series_data_set.files[result.series_index])
+                        await _cache_results(key, result.results)
+                    result.results.stages = breakdown
+                except Exception as e:
+                    result.error = str(e)
+            release_series(dcm_series)
+            await finished.put(result)
+        await finished.put(None)
+    
+    tasks = [ asyncio.create_task(stage()) for stage in (load, compute, write) ]
+    try:
+        while (result := await finished.get()) is not None:
+            yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def align_batch(batch:BatchArgs) -> StreamingResponse:
+    try:
+        series_data_set = dataset_handles.get(batch.handle) if batch.handle != None else batch
+    except UnknownHandleError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    for item in batch.items:
+        _check_output_or_400( item )
+    async def ndjson():
+        async for result in _run_batch(series_data_set, batch.items):
+            yield result.model_dump_json() + "\n"
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+align_jobs = JobManager( dispatch_align, ALIGN_STAGES,
+                         max_workers=get_param("JOB_WORKERS", default=DEFAULT_JOB_WORKERS, value_type=int), 
+                         max_queue=get_param("JOB_QUEUE_SIZE", default=DEFAULT_JOB_QUEUE_SIZE, value_type=int) )
+
+async def submit_align_job(args:Args) -> JobStatus:
+    _resolve_or_404( args, args.series_index, args.series_uid )
+    _check_output_or_400( args )
+    try:
+        return align_jobs.submit(args)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+
+async def get_align_job(job_id:str) -> JobStatus:
+    try:
+        return align_jobs.status(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+
+async def get_align_job_result(job_id:str) -> Results:
+    status = await get_align_job(job_id)
+    if status.state == "failed":
+        raise HTTPException(status_code=500, detail=status.error)
+    if status.state != "done":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {status.state}")
+    return align_jobs.result(job_id)
+
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+async def health() -> WorkerHealth:
+    """
+    Load and memory headroom of this instance and the series it has cached, polled by the coordinator.
+    """
+    return WorkerHealth( active_requests=active_alignments, cpu_count=os.cpu_count() or 1, memory_available_bytes=read_available_memory(),
+                         cached_series=[ uid for uid in volume_cache.series_uids() if uid ],
+                         workers=coordinator.healthy_workers() if coordinator_enabled else None )
+
+async def list_workers() -> list[WorkerInfo]:
+    return coordinator.workers()
+
+async def register_worker(url:str) -> WorkerInfo:
+    return coordinator.register(url)
+
+async def unregister_worker(url:str) -> None:
+    coordinator.unregister(url)
+
+async def warm_up() -> None:
+    try:
+        with measure_stage("warm_up") as metrics:
+            await cpu_stages.warm_up()
+        logging.info(f'Warm-up done in {metrics.wall_seconds:.2f}s')
+    except Exception as e:
+        logging.warning(f'Warm-up failed: {e}')
+
+@asynccontextmanager
+async def _lifespan( app:FastAPI ) -> AsyncIterator[None]:
+    # the warm-up runs in the background, requests are accepted as soon as the port is open
+    tasks = []
+    if warm_up_enabled:
+        tasks.append( asyncio.create_task(warm_up()) )
+    if coordinator_url and worker_url:
+        tasks.append( asyncio.create_task(register_with_coordinator(coordinator_url, worker_url)) )
+    if coordinator_enabled:
+        await coordinator.start()
+    try:
+        yield
     finally:
-        if png_folder != None:
-            await aioshutil.rmtree( png_folder )
+        for task in tasks:
+            task.cancel()
+        await coordinator.stop()
+        # releases the shared memory of the cached volumes
+        volume_cache.clear()
         
 
 def start_web_service():    
@@ -90,9 +627,22 @@ def start_web_service():
 
 def create_webservice( dev:bool=False ) -> FastAPI:
     # define the apps    
-    web_service = FastAPI()
+    web_service = FastAPI(lifespan=_lifespan)
     web_service.get("/parse_dir", response_model=DcmSeriesDataSet)(parse_dir)
+    web_service.get("/parse_dir_stream")(parse_dir_stream)
     web_service.post("/align", response_model=Results)(align)
+    web_service.post("/align_batch")(align_batch)
+    web_service.get("/volume_cache", response_model=VolumeCacheStats)(volume_cache.stats)
+    web_service.get("/result_cache", response_model=ResultCacheStats)(result_cache.stats)
+    web_service.post("/jobs/align", response_model=JobStatus, status_code=202)(submit_align_job)
+    web_service.get("/jobs/{job_id}", response_model=JobStatus)(get_align_job)
+    web_service.get("/jobs/{job_id}/result", response_model=Results)(get_align_job_result)
+    web_service.get("/metrics", response_class=PlainTextResponse)(get_metrics)
+    web_service.get("/health", response_model=WorkerHealth)(health)
+    if coordinator_enabled:
+        web_service.get("/workers", response_model=list[WorkerInfo])(list_workers)
+        web_service.post("/workers", response_model=WorkerInfo)(register_worker)
+        web_service.delete("/workers", status_code=204)(unregister_worker)
 
     if dev:
         web_service.get("/find_files_with_ext", response_model=list[str])(find_files_with_ext)
@@ -0,0 +1,197 @@
+# built-in
+from typing import Optional, Iterator, Tuple
+from contextlib import contextmanager
+import time, threading, logging, math
+
+# pip
+from pydantic import BaseModel
+
+# seconds
+DEFAULT_TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 1 MiB to 64 GiB
+DEFAULT_BYTES_BUCKETS = tuple( float(1024**2 * 4**i) for i in range(9) )
+
+class StageMetrics(BaseModel):
+    """
+    Resources used by one stage of a request.
+
+    CPU time, bytes and peak memory are taken from process wide counters of the server process, so they include
+    concurrent requests and do not include the work done in the CPU_PROCESSES worker processes.
+    The peak memory is a process level value: the peak of the server process since the earliest of the stages 
+    running concurrently started, as the peak is only reset while no stage is measured.
+    Bytes and peak memory are only available on Linux.
+    """
+    wall_seconds:float              = 0.
+    cpu_seconds:float               = 0.
+    bytes_read:int                  = 0
+    bytes_written:int               = 0
+    peak_rss_bytes:Optional[int]    = None
+
+    def add( self, other:"StageMetrics" ) -> None:
+        self.wall_seconds += other.wall_seconds
+        self.cpu_seconds += other.cpu_seconds
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        if other.peak_rss_bytes is not None:
+            self.peak_rss_bytes = max( self.peak_rss_bytes or 0, other.peak_rss_bytes )
+
+class Histogram:
+    def __init__( self, buckets:Tuple[float, ...] ):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe( self, value:float ) -> None:
+        idx = next( (i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets) )
+        self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    Aggregates the StageMetrics of all requests per stage and renders them in the Prometheus text format.
+    """
+    def __init__( self, prefix:str="dcm_aligner" ):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._wall:dict[str, Histogram] = {}
+        self._cpu:dict[str, Histogram] = {}
+        self._peak:dict[str, Histogram] = {}
+        self._bytes_read:dict[str, int] = {}
+        self._bytes_written:dict[str, int] = {}
+
+    def observe( self, stage:str, metrics:StageMetrics ) -> None:
+        with self._lock:
+            self._wall.setdefault( stage, Histogram(DEFAULT_TIME_BUCKETS) ).observe( metrics.wall_seconds )
+            self._cpu.setdefault( stage, Histogram(DEFAULT_TIME_BUCKETS) ).observe( metrics.cpu_seconds )
+            if metrics.peak_rss_bytes is not None:
+                self._peak.setdefault( stage, Histogram(DEFAULT_BYTES_BUCKETS) ).observe( metrics.peak_rss_bytes )
+            self._bytes_read[stage] = self._bytes_read.get(stage, 0) + metrics.bytes_read
+            self._bytes_written[stage] = self._bytes_written.get(stage, 0) + metrics.bytes_written
+
+    def render( self ) -> str:
+        lines = []
+        with self._lock:
+            self._render_histograms( lines, "stage_wall_seconds", "Wall time of the stages.", self._wall )
+            self._render_histograms( lines, "stage_cpu_seconds", "CPU time of the server process during the stages.", self._cpu )
+            self._render_histograms( lines, "stage_peak_rss_bytes", "Peak resident memory of the server process, including concurrent requests, during the stages.", self._peak )
+            self._render_counters( lines, "stage_read_bytes_total", "Bytes read by the server process during the stages.", self._bytes_read )
+            self._render_counters( lines, "stage_written_bytes_total", "Bytes written by the server process during the stages.", self._bytes_written )
+        return "\n".join(lines) + "\n"
+
+    def _render_histograms( self, lines:list[str], name:str, help:str, histograms:dict[str, Histogram] ) -> None:
+        name = f"{self.prefix}_{name}"
+        lines += [ f"# HELP {name} {help}", f"# TYPE {name} histogram" ]
+        for stage, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip( histogram.buckets + (math.inf,), histogram.counts ):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                lines.append( f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}' )
+            lines.append( f'{name}_sum{{stage="{stage}"}} {histogram.sum:g}' )
+            lines.append( f'{name}_count{{stage="{stage}"}} {histogram.count}' )
+
+    def _render_counters( self, lines:list[str], name:str, help:str, counters:dict[str, int] ) -> None:
+        name = f"{self.prefix}_{name}"
+        lines += [ f"# HELP {name} {help}", f"# TYPE {name} counter" ]
+        for stage, value in sorted(counters.items()):
+            lines.append( f'{name}{{stage="{stage}"}} {value}' )
+
+registry = MetricsRegistry()
+
+@contextmanager
+def measure_stage( stage:str, breakdown:Optional[dict[str, StageMetrics]]=None ) -> Iterator[StageMetrics]:
+    """
+    Measures the enclosed stage, records it in the registry and, if given, adds it to the per request `breakdown`.
+
+    Usage:
+        with measure_stage("load", breakdown):
+            dcm_series = await ...
+    """
+    metrics = StageMetrics()
+    _start_peak_rss()
+    io_start = _read_io()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield metrics
+    finally:
+        metrics.wall_seconds = time.perf_counter() - wall_start
+        metrics.cpu_seconds = time.process_time() - cpu_start
+        io_end = _read_io()
+        if io_start is not None and io_end is not None:
+            metrics.bytes_read = io_end[0] - io_start[0]
+            metrics.bytes_written = io_end[1] - io_start[1]
+        metrics.peak_rss_bytes = _read_peak_rss()
+        _stop_peak_rss()
+        registry.observe( stage, metrics )
+        if breakdown is not None:
+            breakdown.setdefault( stage, StageMetrics() ).add( metrics )
+
+def read_available_memory() -> Optional[int]:
+    """
+    Memory available for new allocations without swapping, system wide. Only available on Linux.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError) as e:
+        logging.debug(f"Available memory not available: {e}")
+    return None
+
+# private
+
+_proc_available = True
+# stages being measured, the peak resident memory is reset only when none is, so they do not reset each other's peak
+_active_stages = 0
+_active_stages_lock = threading.Lock()
+
+def _read_io() -> Optional[Tuple[int, int]]:
+    # characters read and written by the process, including the page cache and sockets
+    global _proc_available
+    if not _proc_available:
+        return None
+    try:
+        with open("/proc/self/io") as f:
+            values = dict( line.split(":", 1) for line in f )
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError) as e:
+        logging.debug(f"Process io counters not available: {e}")
+        _proc_available = False
+        return None
+
+def _start_peak_rss() -> None:
+    global _active_stages
+    with _active_stages_lock:
+        if _active_stages == 0:
+            _reset_peak_rss()
+        _active_stages += 1
+
+def _stop_peak_rss() -> None:
+    global _active_stages
+    with _active_stages_lock:
+        _active_stages -= 1
+
+def _reset_peak_rss() -> None:
+    if not _proc_available:
+        return
+    try:
+        # resets VmHWM to the current resident set size
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError as e:
+        logging.debug(f"Could not reset the peak resident memory: {e}")
+
+def _read_peak_rss() -> Optional[int]:
+    if not _proc_available:
+        return None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError) as e:
+        logging.debug(f"Peak resident memory not available: {e}")
+    return None
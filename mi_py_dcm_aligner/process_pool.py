@@ -0,0 +1,243 @@
+# built-in
+from typing import Optional, Tuple, Callable, Any, Iterator, Union
+from dataclasses import dataclass
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import multiprocessing, logging, os, asyncio, mmap
+
+# pip
+import numpy as np
+
+# local
+import image_3d_tools
+
+class _SharedBlock:
+    """
+    Base object of an array allocated in a shared memory block. The block is closed and unlinked when
+    the array and all its views are gone, so a shared array can be passed around like any other array.
+    """
+    def __init__( self, shape:Tuple[int, ...], dtype:np.dtype ):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        # the address is taken from a temporary buffer export, so the block holds no export itself and can be closed
+        address = np.frombuffer(self.shm.buf, dtype=np.uint8).ctypes.data
+        self.__array_interface__ = { "version": 3, "shape": tuple(shape), "typestr": dtype.str, "data": (address, False) }
+    
+    def __del__( self ) -> None:
+        self.shm.close()
+        self.shm.unlink()
+
+@dataclass
+class SharedArray:
+    """
+    Picklable handle of a numpy array in shared memory. Only the name, shape and dtype are sent to the workers.
+    """
+    name:str
+    shape:Tuple[int, ...]
+    dtype:str
+    
+    @staticmethod
+    def allocate( shape:Tuple[int, ...], dtype ) -> np.ndarray:
+        """
+        Allocates an uninitialized array in a new shared memory block that is released with the array.
+        """
+        return np.asarray( _SharedBlock(tuple(shape), np.dtype(dtype)) )
+    
+    @staticmethod
+    def of( array:np.ndarray ) -> Optional["SharedArray"]:
+        """
+        Handle of `array` if it has been allocated in shared memory as a whole (not a view into it), else None.
+        """
+        if not isinstance(array.base, _SharedBlock):
+            return None
+        return SharedArray(array.base.shm.name, array.shape, array.dtype.str)
+    
+    def attach( self ) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+        # the spawned workers share the resource tracker of the server, so attaching does not take over the block
+        shm = shared_memory.SharedMemory(name=self.name)
+        return shm, np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=shm.buf)
+    
+    @contextmanager
+    def open( self ) -> Iterator[np.ndarray]:
+        shm, array = self.attach()
+        try:
+            yield array
+        finally:
+            del array
+            shm.close()
+
+@dataclass
+class MappedArray:
+    """
+    Picklable handle of a numpy array memory-mapped from a file, used for out-of-core volumes.
+    The workers map the same file, so nothing is copied.
+    """
+    path:str
+    shape:Tuple[int, ...]
+    dtype:str
+    offset:int = 0
+    
+    @staticmethod
+    def of( array:np.ndarray ) -> Optional["MappedArray"]:
+        """
+        Handle of `array` if it is a whole np.memmap (not a view into one), else None.
+        """
+        if not isinstance(array, np.memmap) or not isinstance(array.base, mmap.mmap) or array.filename is None:
+            return None
+        array.flush()
+        return MappedArray(array.filename, array.shape, array.dtype.str, array.offset)
+    
+    @contextmanager
+    def open( self ) -> Iterator[np.ndarray]:
+        array = np.memmap(self.path, dtype=np.dtype(self.dtype), mode="r+", shape=self.shape, offset=self.offset)
+        try:
+            yield array
+        finally:
+            array.flush()
+            del array
+
+ArrayHandle = Union[SharedArray, MappedArray]
+
+class SharedMemorySpace(image_3d_tools.ScratchSpace):
+    """
+    Allocates arrays in shared memory instead of scratch files, so volumes loaded into it are handed to the 
+    workers without a copy. The blocks are released with their arrays, release() and close() do nothing.
+    """
+    def allocate( self, shape:Tuple[int, ...], dtype ) -> np.ndarray:
+        return SharedArray.allocate(shape, dtype)
+    
+    def release( self, array:np.ndarray ) -> None:
+        pass
+    
+    def close( self ) -> None:
+        pass
+
+# worker functions, executed in the pool processes
+
+def _otsu_threshold( volume:ArrayHandle, slab_size:int ) -> float:
+    with volume.open() as array:
+        return image_3d_tools.otsu_threshold(array, slab_size=slab_size)
+
+def _largest_component( volume:ArrayHandle, threshold_value:Optional[float], kwargs:dict ) -> image_3d_tools.ComponentMask:
+    with volume.open() as array:
+        return image_3d_tools.largest_component(array, threshold_value=threshold_value, **kwargs)
+
+def _calculate_rotated_bounding_box( volume:ArrayHandle, threshold_value:Optional[float], slab_size:int, scale:int, 
+                                    component:Optional[image_3d_tools.ComponentMask] ) -> Tuple[np.ndarray, np.ndarray]:
+    with volume.open() as array:
+        return image_3d_tools.calculate_rotated_bounding_box(array, threshold_value=threshold_value, slab_size=slab_size, scale=scale, component=component)
+
+def _transform_image( volume:ArrayHandle, output:ArrayHandle, matrix:np.ndarray, kwargs:dict ) -> None:
+    with volume.open() as array, output.open() as output_array:
+        image_3d_tools.transform_image(array, matrix, output=output_array, **kwargs)
+
+class CpuStages:
+    """
+    Runs the CPU heavy stages of an alignment outside of the event loop.
+    
+    With `processes` > 0 the stages run in a process pool and volumes are handed over in shared memory,
+    so concurrent alignments use separate cores. With `processes` == 0 they run in the default thread pool.
+    Volumes loaded into the `memory_space()` and memory-mapped (out-of-core) volumes are not copied, 
+    the workers attach the same shared memory block or map the same scratch file.
+    
+    Usage:
+        async with cpu_stages.share(volume) as shared:
+            threshold = await cpu_stages.otsu_threshold(shared)
+    """
+    def __init__( self, processes:int=0 ):
+        self.processes = processes
+        self._pool:Optional[ProcessPoolExecutor] = None
+        
+    def _executor( self ) -> Optional[ProcessPoolExecutor]:
+        if self.processes <= 0:
+            return None
+        if self._pool is None:
+            # spawn behaves the same on all platforms and does not fork the threads of the server
+            self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+    
+    def memory_space( self ) -> Optional[image_3d_tools.ScratchSpace]:
+        """
+        Where to load volumes that are shared with the workers, e.g. those of the volume cache. None to load into RAM.
+        """
+        return SharedMemorySpace() if self.processes > 0 else None
+    
+    def shutdown( self ) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+    
+    async def warm_up( self ) -> None:
+        """
+        Starts the worker processes and runs image_3d_tools.warm_up in them, or once in a thread without processes.
+        The pool starts a new process for a task while no worker is idle, so all of them are usually started.
+        """
+        runs = max(1, self.processes)
+        await asyncio.gather( *( self._run(image_3d_tools.warm_up) for _ in range(runs) ) )
+
+    async def _run( self, fn:Callable, *args ) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor(), fn, *args)
+    
+    def share( self, volume:np.ndarray ) -> "_SharedVolume":
+        return _SharedVolume(self, volume)
+    
+    async def otsu_threshold( self, shared:"_SharedVolume", slab_size:int=image_3d_tools.DEFAULT_SLAB_SIZE ) -> float:
+        if shared.handle is None:
+            return await self._run(image_3d_tools.otsu_threshold, shared.volume, slab_size)
+        return await self._run(_otsu_threshold, shared.handle, slab_size)
+    
+    async def largest_component( self, shared:"_SharedVolume", threshold_value:Optional[float], **kwargs ) -> image_3d_tools.ComponentMask:
+        if shared.handle is None:
+            return await self._run(lambda: image_3d_tools.largest_component(shared.volume, threshold_value=threshold_value, **kwargs))
+        return await self._run(_largest_component, shared.handle, threshold_value, kwargs)
+    
+    async def calculate_rotated_bounding_box( self, shared:"_SharedVolume", threshold_value:Optional[float], scale:int=1, 
+                                             slab_size:int=image_3d_tools.DEFAULT_SLAB_SIZE, 
+                                             component:Optional[image_3d_tools.ComponentMask]=None ) -> Tuple[np.ndarray, np.ndarray]:
+        if shared.handle is None:
+            return await self._run(lambda: image_3d_tools.calculate_rotated_bounding_box(shared.volume, threshold_value=threshold_value, slab_size=slab_size, 
+                                                                                         scale=scale, component=component))
+        return await self._run(_calculate_rotated_bounding_box, shared.handle, threshold_value, slab_size, scale, component)
+    
+    async def transform_image( self, shared:"_SharedVolume", matrix:np.ndarray, **kwargs ) -> np.ndarray:
+        """
+        Resamples the shared volume, see image_3d_tools.transform_image. With a `scratch` space in `kwargs`, 
+        the result is allocated there, e.g. as a memory-mapped scratch file, otherwise it is held in shared memory.
+        The workers resample into it directly.
+        """
+        if shared.handle is None:
+            return await self._run(lambda: image_3d_tools.transform_image(shared.volume, matrix, **kwargs))
+        output_shape, _ = image_3d_tools.transform_output_geometry(shared.volume.shape, matrix, kwargs.get("bounds"))
+        scratch = kwargs.get("scratch")
+        # allocated here, so the scratch space that owns it releases it; the workers release their prefilter themselves
+        output = image_3d_tools.allocate(output_shape, shared.volume.dtype, scratch) if scratch is not None else None
+        output_handle = MappedArray.of(output) if output is not None else None
+        if output_handle is None:
+            if output is None or SharedArray.of(output) is None:
+                output = SharedArray.allocate(output_shape, shared.volume.dtype)
+            output_handle = SharedArray.of(output)
+            # the prefilter of a worker is held in its RAM
+            kwargs = { **kwargs, "scratch": None }
+        await self._run(_transform_image, shared.handle, output_handle, matrix, kwargs)
+        return output
+
+class _SharedVolume:
+    def __init__( self, cpu_stages:CpuStages, volume:np.ndarray ):
+        self.cpu_stages = cpu_stages
+        self.volume = volume
+        self.handle:Optional[ArrayHandle] = None
+        self._copy:Optional[np.ndarray] = None
+    
+    async def __aenter__( self ) -> "_SharedVolume":
+        if self.cpu_stages.processes > 0:
+            self.handle = SharedArray.of(self.volume) or MappedArray.of(self.volume)
+        if self.cpu_stages.processes > 0 and self.handle is None:
+            # volumes that are not in shared memory yet are copied for the duration of the request
+            self._copy = SharedArray.allocate(self.volume.shape, self.volume.dtype)
+            await asyncio.to_thread(np.copyto, self._copy, self.volume)
+            self.handle = SharedArray.of(self._copy)
+        return self
+    
+    async def __aexit__( self, *exc_info ) -> None:
+        # releases the shared memory block of a copy
+        self._copy = None
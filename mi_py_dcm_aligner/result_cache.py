@@ -0,0 +1,114 @@
+# built-in
+from typing import Optional
+import logging, os, asyncio, json, sqlite3, time
+
+# pip
+from pydantic import BaseModel
+
+# local
+from dicom import DcmSeriesDataSet
+from aiofiles_ext import async_hash_array
+
+DEFAULT_RESULT_CACHE_FILE = "result_cache.sqlite"
+DEFAULT_RESULT_CACHE_MAX_ENTRIES = 10000
+# part of every key, increase it when a change of the alignment changes its results
+RESULT_CACHE_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    results TEXT NOT NULL,
+    output_folder TEXT,
+    last_used REAL NOT NULL
+)
+"""
+
+class ResultCacheStats(BaseModel):
+    hits:int        = 0
+    misses:int      = 0
+    entries:int     = 0
+    max_entries:int = 0
+
+def _series_fingerprint( series_uid:Optional[str], files:list[str] ) -> bytes:
+    fingerprint = [ series_uid ]
+    for file in sorted(files):
+        stat = os.stat(file)
+        fingerprint.append( (file, stat.st_size, stat.st_mtime_ns) )
+    return json.dumps(fingerprint).encode()
+
+class ResultCache:
+    """
+    Persistent cache of alignment results in a SQLite file.
+
+    Entries are keyed by a digest of the series (uid plus path, size and mtime of every file), of the
+    alignment options and of RESULT_CACHE_VERSION, so a changed file, option or version misses. The path of a written output series is kept
+    with the results; an entry whose output folder has been removed is dropped on lookup.
+    At most `max_entries` are kept, the least recently used are evicted first. With `max_entries` 0 the cache is off.
+    """
+    def __init__( self, cache_file:str=DEFAULT_RESULT_CACHE_FILE, max_entries:int=DEFAULT_RESULT_CACHE_MAX_ENTRIES ):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled( self ) -> bool:
+        return self.max_entries > 0
+
+    def _connect( self ) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.cache_file)
+        connection.execute(_SCHEMA)
+        return connection
+
+    async def key( self, series_data_set:DcmSeriesDataSet, series_index:int, options:dict ) -> str:
+        """
+        Digest of the series `series_index` of `series_data_set`, the result relevant `options` and the cache version.
+        """
+        fingerprint = await asyncio.to_thread(_series_fingerprint, series_data_set.uids[series_index], series_data_set.files[series_index])
+        return await async_hash_array( fingerprint + json.dumps([RESULT_CACHE_VERSION, options], sort_keys=True).encode() )
+
+    def _get( self, key:str ) -> Optional[str]:
+        with self._connect() as connection:
+            row = connection.execute("SELECT results, output_folder FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            results, output_folder = row
+            if output_folder is not None and not os.path.isdir(output_folder):
+                logging.info(f'Dropping cached result, output series {output_folder} does not exist anymore')
+                connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            return results
+
+    def _put( self, key:str, results:str, output_folder:Optional[str] ) -> None:
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, results, output_folder, time.time()))
+            connection.execute("DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+
+    async def get( self, key:str ) -> Optional[str]:
+        """
+        The cached results as JSON or None.
+        """
+        if not self.enabled:
+            return None
+        results = await asyncio.to_thread(self._get, key)
+        if results is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return results
+
+    async def put( self, key:str, results:str, output_folder:Optional[str]=None ) -> None:
+        if self.enabled:
+            await asyncio.to_thread(self._put, key, results, output_folder)
+
+    def stats( self ) -> ResultCacheStats:
+        entries = 0
+        if self.enabled:
+            with self._connect() as connection:
+                entries = connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return ResultCacheStats(hits=self.hits, misses=self.misses, entries=entries, max_entries=self.max_entries)
+
+    def clear( self ) -> None:
+        with self._connect() as connection:
+            connection.execute("DELETE FROM results")
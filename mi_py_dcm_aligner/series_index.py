@@ -0,0 +1,212 @@
+# built-in
+from typing import Optional, Dict, Tuple, Iterable, AsyncIterator, Callable
+import logging, os, asyncio, json, sqlite3, time
+
+# pip
+from pydantic import BaseModel
+
+# local
+from dicom import DcmSeriesDataSet, CrawledFile, crawl_dcm_headers, get_series_info, DEFAULT_CRAWL_CONCURRENCY, DEFAULT_HEADER_PREFIX_SIZE
+from aiofiles_ext import DEFAULT_WALK_CONCURRENCY
+from env import get_param
+from metrics import measure_stage
+
+DEFAULT_INDEX_FILE = "dcm_index.sqlite"
+DEFAULT_STREAM_UPDATE_INTERVAL = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    is_dicom INTEGER NOT NULL,
+    series_uid TEXT,
+    description TEXT,
+    pixel_spacing TEXT,
+    slice_thickness REAL
+)
+"""
+
+class ParseDirEvent(BaseModel):
+    """
+    Record of a streamed scan. 
+    
+    "series": a series has been seen for the first time, with its first files.
+    "files": more files of a known series, `num_files` is the number of files of the series so far.
+    "done": the scan is complete, `num_files` is the number of DICOM files of all series and `handle`
+            the handle of the registered data set, if any.
+    """
+    event:str
+    series_uid:Optional[str]                    = None
+    description:Optional[str]                   = None
+    pixel_spacing:Optional[Tuple[float, float]] = None
+    slice_thickness:Optional[float]             = None
+    files:list[str]                             = []
+    num_files:int                               = 0
+    num_series:Optional[int]                    = None
+    handle:Optional[str]                        = None
+
+def _is_deleted( path:str ) -> bool:
+    # only a file that is gone is dropped, other errors (permissions, a network share hiccup) keep its row
+    try:
+        os.stat(path)
+        return False
+    except FileNotFoundError:
+        return True
+    except OSError as e:
+        logging.warning(f'Could not check indexed file {path}, keeping it: {e}')
+        return False
+
+class SeriesIndex:
+    """
+    Persistent index of the DICOM headers below a directory, stored in a SQLite file.
+    
+    Files are keyed by path and fingerprinted by size and mtime. A scan only reads the headers of
+    new or changed files and drops files that have been deleted. Non-DICOM files are indexed as 
+    well so they are not probed again.
+    """
+    def __init__( self, index_file:str=DEFAULT_INDEX_FILE ):
+        self.index_file = index_file
+        
+    def _connect( self ) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.index_file)
+        connection.execute(_SCHEMA)
+        return connection
+    
+    @staticmethod
+    def _dir_prefix( directory:str ) -> str:
+        return os.path.join(directory, "")
+    
+    def _load_rows( self, directory:str ) -> Dict[str, tuple]:
+        prefix = self._dir_prefix(directory)
+        with self._connect() as connection:
+            rows = connection.execute("SELECT * FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+            return { row[0]: row for row in rows }
+        
+    def _write( self, changed:Iterable[tuple], deleted:Iterable[str] ) -> None:
+        with self._connect() as connection:
+            connection.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in deleted))
+            connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", changed)
+        
+    def _update( self, directory:str, changed:Iterable[tuple], deleted:Iterable[str] ) -> DcmSeriesDataSet:
+        self._write(changed, deleted)
+        prefix = self._dir_prefix(directory)
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT path, series_uid, description, pixel_spacing, slice_thickness FROM files WHERE is_dicom = 1 AND substr(path, 1, ?) = ? ORDER BY path",
+                (len(prefix), prefix)
+            )
+            series_data_set = DcmSeriesDataSet()
+            for path, series_uid, description, pixel_spacing, slice_thickness in rows:
+                if pixel_spacing is not None:
+                    pixel_spacing = tuple(json.loads(pixel_spacing))
+                series_data_set.add_file(path, series_uid, description, pixel_spacing, slice_thickness)
+            return series_data_set
+    
+    @staticmethod
+    def _to_row( crawled_file:CrawledFile ) -> tuple:
+        if crawled_file.dataset is None:
+            return (crawled_file.file_path, crawled_file.size, crawled_file.mtime_ns, 0, None, None, None, None)
+        series_uid, description, pixel_spacing, slice_thickness = get_series_info(crawled_file.dataset)
+        if pixel_spacing is not None:
+            pixel_spacing = json.dumps(pixel_spacing)
+        return (crawled_file.file_path, crawled_file.size, crawled_file.mtime_ns, 1, series_uid, description, pixel_spacing, slice_thickness)
+        
+    async def _crawl( self, directory:str, concurrency:int, prefix_size:int, full_rescan:bool, 
+                     changed:list[tuple], deleted:list[str], walk_concurrency:int=DEFAULT_WALK_CONCURRENCY ) -> AsyncIterator[tuple]:
+        """
+        Crawls `directory` and yields the index row of every file, read from the index if the file did not change.
+        The rows to write are collected in `changed` and, when the crawl is done, the deleted paths in `deleted`.
+        Indexed files the crawl did not reach or could not read are only deleted if they do not exist anymore, 
+        otherwise their old rows are yielded at the end.
+        """
+        known_rows = {} if full_rescan else await asyncio.to_thread(self._load_rows, directory)
+        known = { path: (row[1], row[2]) for path, row in known_rows.items() }
+        logging.info(f'Starting indexed parsing of dicoms in {directory} ({len(known)} files known)')
+        
+        seen = set()
+        async for crawled_file in crawl_dcm_headers(directory, concurrency=concurrency, prefix_size=prefix_size, known=known, 
+                                                    walk_concurrency=walk_concurrency):
+            seen.add(crawled_file.file_path)
+            if crawled_file.changed:
+                row = self._to_row(crawled_file)
+                changed.append(row)
+            else:
+                row = known_rows[crawled_file.file_path]
+            yield row
+        missing = [ path for path in known if path not in seen ]
+        if missing:
+            is_deleted = await asyncio.to_thread(lambda: [ _is_deleted(path) for path in missing ])
+            for path, gone in zip(missing, is_deleted):
+                if gone:
+                    deleted.append(path)
+                else:
+                    yield known_rows[path]
+        logging.info(f'Indexed {directory}: {len(seen)} files, {len(changed)} new or changed, {len(deleted)} deleted')
+        
+    async def scan( self, directory:str, concurrency:int=DEFAULT_CRAWL_CONCURRENCY, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE, 
+                   full_rescan:bool=False, walk_concurrency:int=DEFAULT_WALK_CONCURRENCY ) -> DcmSeriesDataSet:
+        changed, deleted = [], []
+        async for _ in self._crawl(directory, concurrency, prefix_size, full_rescan, changed, deleted, walk_concurrency):
+            pass
+        return await asyncio.to_thread(self._update, directory, changed, deleted)
+    
+    async def scan_stream( self, directory:str, concurrency:int=DEFAULT_CRAWL_CONCURRENCY, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE, 
+                          full_rescan:bool=False, update_interval:float=DEFAULT_STREAM_UPDATE_INTERVAL, 
+                          register:Optional[Callable[[DcmSeriesDataSet], str]]=None, 
+                          walk_concurrency:int=DEFAULT_WALK_CONCURRENCY ) -> AsyncIterator[ParseDirEvent]:
+        """
+        Scans like scan() but yields a "series" event as soon as a series is first seen and "files" events
+        with the files found since the last event of a series at most every `update_interval` seconds.
+        The index is written when the crawl is done, followed by a "done" event. The complete data set
+        is passed to `register` whose result is sent as handle in the "done" event.
+        """
+        changed, deleted = [], []
+        series_data_set = DcmSeriesDataSet()
+        pending:Dict[str, list[str]] = {}
+        last_update = time.monotonic()
+        
+        def files_events() -> list[ParseDirEvent]:
+            events = [ ParseDirEvent(event="files", series_uid=uid, files=files, num_files=len(series_data_set.files[series_data_set.get_series_index(uid)]))
+                       for uid, files in pending.items() if files ]
+            pending.clear()
+            return events
+        
+        async for path, _, _, is_dicom, series_uid, description, pixel_spacing, slice_thickness in self._crawl(directory, concurrency, prefix_size, full_rescan, changed, deleted, 
+                                                                                                                    walk_concurrency):
+            if not is_dicom:
+                continue
+            if pixel_spacing is not None:
+                pixel_spacing = tuple(json.loads(pixel_spacing))
+            is_new = series_data_set.get_series_index(series_uid) is None
+            series_data_set.add_file(path, series_uid, description, pixel_spacing, slice_thickness)
+            if is_new:
+                yield ParseDirEvent(event="series", series_uid=series_uid, description=description, pixel_spacing=pixel_spacing, 
+                                    slice_thickness=slice_thickness, files=[path], num_files=1)
+            else:
+                pending.setdefault(series_uid, []).append(path)
+            if time.monotonic() - last_update >= update_interval:
+                for event in files_events():
+                    yield event
+                last_update = time.monotonic()
+        for event in files_events():
+            yield event
+        
+        await asyncio.to_thread(self._write, changed, deleted)
+        handle = register(series_data_set) if register is not None else None
+        yield ParseDirEvent(event="done", num_files=sum(len(files) for files in series_data_set.files), num_series=len(series_data_set.uids), handle=handle)
+    
+async def parse_dir_indexed( directory:str, concurrency:int=DEFAULT_CRAWL_CONCURRENCY, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE, 
+                            full_rescan:bool=False, walk_concurrency:int=DEFAULT_WALK_CONCURRENCY ) -> DcmSeriesDataSet:
+    index = SeriesIndex( get_param("DCM_INDEX_FILE", default=DEFAULT_INDEX_FILE) )
+    with measure_stage("parse_dir"):
+        return await index.scan(directory, concurrency=concurrency, prefix_size=prefix_size, full_rescan=full_rescan, walk_concurrency=walk_concurrency)
+
+async def parse_dir_indexed_stream( directory:str, concurrency:int=DEFAULT_CRAWL_CONCURRENCY, prefix_size:int=DEFAULT_HEADER_PREFIX_SIZE, 
+                                   full_rescan:bool=False, register:Optional[Callable[[DcmSeriesDataSet], str]]=None, 
+                                   walk_concurrency:int=DEFAULT_WALK_CONCURRENCY ) -> AsyncIterator[ParseDirEvent]:
+    index = SeriesIndex( get_param("DCM_INDEX_FILE", default=DEFAULT_INDEX_FILE) )
+    with measure_stage("parse_dir"):
+        async for event in index.scan_stream(directory, concurrency=concurrency, prefix_size=prefix_size, full_rescan=full_rescan, register=register, 
+                                             walk_concurrency=walk_concurrency):
+            yield event
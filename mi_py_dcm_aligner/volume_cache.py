@@ -0,0 +1,109 @@
+# built-in
+from typing import Optional, Tuple, Dict
+from collections import OrderedDict
+import logging, os, asyncio
+
+# pip
+from pydantic import BaseModel
+
+# local
+from dicom import DcmSeriesDataSet, DicomSeries, create_dicom_series
+from image_3d_tools import ScratchSpace
+
+DEFAULT_VOLUME_CACHE_BYTES = 2 * 1024**3
+
+VolumeKey = Tuple[str|None, Tuple[Tuple[str, int, int], ...], int]
+
+class VolumeCacheStats(BaseModel):
+    hits:int                = 0
+    misses:int              = 0
+    evictions:int           = 0
+    entries:int             = 0
+    bytes:int               = 0
+    max_bytes:int           = 0
+
+def _fingerprint( files:list[str] ) -> Tuple[Tuple[str, int, int], ...]:
+    fingerprint = []
+    for file in sorted(files):
+        stat = os.stat(file)
+        fingerprint.append( (file, stat.st_size, stat.st_mtime_ns) )
+    return tuple(fingerprint)
+
+class VolumeCache:
+    """
+    In-process LRU cache of loaded series, keyed by series uid plus (path, size, mtime) of every file and the slice step.
+    
+    The cache holds at most `max_bytes` of volume data, the least recently used series are evicted first.
+    Cached volumes are shared between requests and therefore set to read-only. Concurrent requests for 
+    the same series wait for a single load. With a `memory_space`, e.g. CpuStages.memory_space(), the volumes
+    are loaded into it, so the CPU workers use them without a copy.
+    """
+    def __init__( self, max_bytes:int=DEFAULT_VOLUME_CACHE_BYTES, memory_space:Optional[ScratchSpace]=None ):
+        self.max_bytes = max_bytes
+        self.memory_space = memory_space
+        self._entries:OrderedDict[VolumeKey, DicomSeries] = OrderedDict()
+        self._loading:Dict[VolumeKey, asyncio.Future] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    @staticmethod
+    def _size( dcm_series:DicomSeries ) -> int:
+        return 0 if dcm_series.volume is None else dcm_series.volume.nbytes
+    
+    def stats( self ) -> VolumeCacheStats:
+        return VolumeCacheStats(hits=self.hits, misses=self.misses, evictions=self.evictions, 
+                                entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+    
+    def series_uids( self ) -> list[str|None]:
+        return [ series_uid for series_uid, _, _ in self._entries.keys() ]
+    
+    def clear( self ) -> None:
+        self._entries.clear()
+        self._bytes = 0
+    
+    def _put( self, key:VolumeKey, dcm_series:DicomSeries ) -> None:
+        size = self._size(dcm_series)
+        if size > self.max_bytes:
+            logging.debug(f'Series {key[0]} with {size} bytes exceeds the volume cache budget')
+            return
+        while self._entries and self._bytes + size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._size(evicted)
+            self.evictions += 1
+        self._entries[key] = dcm_series
+        self._bytes += size
+        
+    async def get_or_load( self, series_data_set:DcmSeriesDataSet, idx:int, slice_step:int=1 ) -> DicomSeries:
+        files = series_data_set.files[idx]
+        key = (series_data_set.uids[idx], await asyncio.to_thread(_fingerprint, files), slice_step)
+        
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if key in self._loading:
+            self.hits += 1
+            return await asyncio.shield(self._loading[key])
+        
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            dcm_series = await create_dicom_series(series_data_set, idx, slice_step=slice_step, scratch=self.memory_space)
+            if dcm_series.volume is not None:
+                dcm_series.volume.flags.writeable = False
+            self._put(key, dcm_series)
+            future.set_result(dcm_series)
+            return dcm_series
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # retrieve the exception so it is not reported as unhandled if nobody waits
+            future.exception()
+            raise
+        finally:
+            del self._loading[key]
@@ -0,0 +1,11 @@
+# built-in
+import os, sys
+
+# the modules of the service import each other by name
+package_path = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ), "mi_py_dcm_aligner" )
+if not package_path in sys.path:
+    sys.path.insert( 0, package_path )
+
+# run the CPU stages in threads and never ask for missing parameters
+os.environ.setdefault( "CPU_PROCESSES", "0" )
+os.environ.setdefault( "NON_INTERACTIVE", "true" )
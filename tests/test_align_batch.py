@@ -0,0 +1,41 @@
+# built-in
+import json, asyncio
+
+# pip
+import pytest
+from fastapi import HTTPException
+
+# local
+import main
+from dicom import parse_dir
+from benchmark import PhantomSpec, write_phantom_series
+
+def _batch( batch:main.BatchArgs ) -> list[dict]:
+    async def run():
+        response = await main.align_batch(batch)
+        return [ json.loads(line) async for line in response.body_iterator ]
+    return asyncio.run(run())
+
+def test_batch_yields_every_item_in_order_with_the_results_of_single_alignments(tmp_path):
+    write_phantom_series(PhantomSpec("first", shape=(12, 32, 32), angles_deg=(10., 0., 0.)), str(tmp_path / "first"))
+    write_phantom_series(PhantomSpec("second", shape=(12, 32, 32), angles_deg=(0., 15., 5.)), str(tmp_path / "second"))
+    series_data_set = asyncio.run( parse_dir(str(tmp_path)) )
+    options = { "series_description_suffix": "_aligned", "use_result_cache": False }
+    items = [ main.BatchItem(series_index=0, **options), main.BatchItem(series_uid="unknown", **options), 
+              main.BatchItem(series_uid=series_data_set.uids[1], **options) ]
+
+    results = _batch( main.BatchArgs(**series_data_set.model_dump(), items=items) )
+
+    assert [ result["item_index"] for result in results ] == [0, 1, 2]
+    assert results[1]["error"] is not None and results[1]["results"] is None
+    assert results[2]["series_index"] == 1
+    for result in (results[0], results[2]):
+        assert result["error"] is None
+        args = main.Args(**series_data_set.model_dump(), series_index=result["series_index"], **options)
+        single = asyncio.run( main.align(args) )
+        assert result["results"]["matrix"] == single.matrix
+
+def test_batch_with_an_unknown_handle_is_rejected():
+    with pytest.raises(HTTPException) as e:
+        _batch( main.BatchArgs(handle="unknown", items=[ main.BatchItem(series_index=0, series_description_suffix="_aligned") ]) )
+    assert e.value.status_code == 404
@@ -0,0 +1,60 @@
+# built-in
+import asyncio
+
+# pip
+import pytest
+from pydantic import ValidationError
+
+# local
+import main
+from main import AlignOptions
+from dicom import parse_dir
+from benchmark import PhantomSpec, write_phantom_series
+
+def _options( **kwargs ) -> AlignOptions:
+    return AlignOptions(series_description_suffix="_aligned", **kwargs)
+
+@pytest.mark.parametrize("pyramid_factor, pyramid_refine, levels, slice_step", [
+    (None, False, [], 1),
+    (1, True, [], 1),
+    (2, False, [2], 2),
+    (5, False, [5], 5),
+    (4, True, [4, 2], 2),
+    (6, True, [6, 3], 3),
+    (8, True, [8, 4], 4),
+    (9, True, [9, 3], 3),
+])
+def test_pyramid_levels_and_slice_step(pyramid_factor, pyramid_refine, levels, slice_step):
+    options = _options(pyramid_factor=pyramid_factor, pyramid_refine=pyramid_refine)
+    assert options.pyramid_levels() == levels
+    assert options.slice_step() == slice_step
+    # every level can be sampled from the loaded slices
+    assert all( level % slice_step == 0 for level in levels )
+
+@pytest.mark.parametrize("pyramid_factor", [2, 3, 5, 7])
+def test_refine_without_divisor_is_rejected(pyramid_factor):
+    with pytest.raises(ValidationError):
+        _options(pyramid_factor=pyramid_factor, pyramid_refine=True)
+
+def test_resampling_requests_load_all_slices(tmp_path):
+    options = _options(pyramid_factor=4, pyramid_refine=True, dcm_output_folder=str(tmp_path))
+    assert options.pyramid_levels() == []
+    assert options.slice_step() == 1
+
+def test_refined_pyramid_alignment_is_close_to_the_full_resolution(tmp_path):
+    write_phantom_series(PhantomSpec("phantom", shape=(36, 72, 72)), str(tmp_path))
+    series_data_set = asyncio.run( parse_dir(str(tmp_path)) )
+    args = main.Args(**series_data_set.model_dump(), series_index=0, series_description_suffix="_aligned", 
+                     pyramid_factor=6, pyramid_refine=True, pyramid_validate=True, use_result_cache=False)
+    results = asyncio.run( main.align(args) )
+    assert results.pyramid_error_deg < 2.
+
+@pytest.mark.parametrize("interpolation_order", [-1, 6])
+def test_interpolation_order_outside_the_spline_orders_is_rejected(interpolation_order):
+    with pytest.raises(ValidationError):
+        _options(interpolation_order=interpolation_order)
+
+@pytest.mark.parametrize("kwargs", [ { "component_factor": 0 }, { "component_connectivity": 0 }, { "component_connectivity": 4 }, { "component_min_size": 0 } ])
+def test_invalid_component_options_are_rejected(kwargs):
+    with pytest.raises(ValidationError):
+        _options(largest_component=True, **kwargs)
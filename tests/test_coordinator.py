@@ -0,0 +1,124 @@
+# built-in
+import asyncio
+
+# pip
+import httpx
+import pytest
+
+# local
+from coordinator import Coordinator, NoWorkerAvailableError, WorkerRequestError
+
+def _run( handlers:dict[str, callable], series_uid:str|None=None ):
+    """
+    Posts /align through a coordinator with the workers in `handlers`, which answer the requests to them.
+    Every worker is healthy. Returns the result or the raised exception, the posts per worker and the workers.
+    """
+    posts = { url: 0 for url in handlers }
+    def handle( request:httpx.Request ) -> httpx.Response:
+        url = f"http://{request.url.host}"
+        if request.url.path == "/health":
+            return httpx.Response(200, json={ "status": "ok", "cpu_count": 1 })
+        posts[url] += 1
+        return handlers[url](request)
+
+    async def post():
+        coordinator = Coordinator(list(handlers), retries=len(handlers))
+        coordinator._client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        try:
+            await coordinator.refresh()
+            try:
+                result = await coordinator.post("/align", {}, series_uid)
+            except Exception as e:
+                result = e
+            return result, coordinator.workers()
+        finally:
+            await coordinator.stop()
+    result, workers = asyncio.run(post())
+    return result, posts, { worker.url: worker for worker in workers }
+
+def _ok( request:httpx.Request ) -> httpx.Response:
+    return httpx.Response(200, json={ "threshold": 1. })
+
+def _status( status_code:int ):
+    return lambda request: httpx.Response(status_code, json={ "detail": f"failed with {status_code}" })
+
+def _raise( error:type[httpx.HTTPError] ):
+    def handle( request:httpx.Request ) -> httpx.Response:
+        raise error("failed", request=request)
+    return handle
+
+@pytest.mark.parametrize("failure", [ _raise(httpx.ConnectError), _raise(httpx.ConnectTimeout), _status(502), _status(503), _status(504) ])
+def test_fails_over_when_a_worker_is_down(failure):
+    # equally loaded workers are tried in the order they were registered
+    result, posts, workers = _run({ "http://a": failure, "http://b": _ok })
+    assert result == { "threshold": 1. }
+    assert posts == { "http://a": 1, "http://b": 1 }
+    assert not workers["http://a"].healthy
+    assert workers["http://a"].failures == 1
+    assert workers["http://b"].healthy
+
+@pytest.mark.parametrize("status_code", [400, 404, 422, 500])
+def test_passes_errors_of_the_request_through(status_code):
+    result, posts, workers = _run({ "http://a": _status(status_code), "http://b": _status(status_code) })
+    assert isinstance(result, WorkerRequestError)
+    assert result.status_code == status_code
+    assert result.detail == f"failed with {status_code}"
+    # sent once, the worker stays healthy
+    assert sum(posts.values()) == 1
+    assert all( worker.healthy for worker in workers.values() )
+
+@pytest.mark.parametrize("error, status_code", [ (httpx.ReadTimeout, 504), (httpx.RemoteProtocolError, 502) ])
+def test_does_not_retry_requests_a_worker_may_have_started(error, status_code):
+    result, posts, workers = _run({ "http://a": _raise(error), "http://b": _raise(error) })
+    assert isinstance(result, WorkerRequestError)
+    assert result.status_code == status_code
+    assert sum(posts.values()) == 1
+    assert all( worker.healthy for worker in workers.values() )
+
+def test_no_worker_left():
+    result, posts, workers = _run({ "http://a": _status(503), "http://b": _status(503) })
+    assert isinstance(result, NoWorkerAvailableError)
+    assert posts == { "http://a": 1, "http://b": 1 }
+    assert not any( worker.healthy for worker in workers.values() )
+
+def test_prefers_the_worker_with_the_series_cached():
+    async def post():
+        def handle( request:httpx.Request ) -> httpx.Response:
+            if request.url.path == "/health":
+                cached = [ "1.2.3" ] if request.url.host == "b" else []
+                return httpx.Response(200, json={ "status": "ok", "cached_series": cached })
+            return httpx.Response(200, json={ "worker": request.url.host })
+        coordinator = Coordinator([ "http://a", "http://b" ])
+        coordinator._client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        try:
+            await coordinator.refresh()
+            return await coordinator.post("/align", {}, "1.2.3")
+        finally:
+            await coordinator.stop()
+    assert asyncio.run(post()) == { "worker": "b" }
+
+def test_dispatch_sends_only_the_selected_series(monkeypatch):
+    import main
+    from dicom import DcmSeriesDataSet
+    series_data_set = DcmSeriesDataSet( uids=["1", "2", "3"], files=[["a1"], ["b1", "b2"], ["c1"]], descriptions=["a", "b", "c"],
+                                        slice_thicknesses=[1., 2., 3.], pixel_spacings=[(1., 1.), (2., 2.), (3., 3.)] )
+    handle = main.dataset_handles.register(series_data_set)
+    args = main.Args(handle=handle, series_uid="2", series_description_suffix="_aligned")
+
+    sent = {}
+    class Sent(Exception):
+        pass
+    async def post( path:str, payload:dict, series_uid:str|None=None ):
+        sent.update(payload=payload, series_uid=series_uid)
+        raise Sent()
+    monkeypatch.setattr(main, "coordinator_enabled", True)
+    monkeypatch.setattr(main.coordinator, "post", post)
+    with pytest.raises(Sent):
+        asyncio.run( main.dispatch_align(args) )
+
+    payload = sent["payload"]
+    assert sent["series_uid"] == "2"
+    assert payload["uids"] == ["2"] and payload["files"] == [["b1", "b2"]] and payload["descriptions"] == ["b"]
+    assert payload["slice_thicknesses"] == [2.] and payload["pixel_spacings"] == [[2., 2.]]
+    assert payload["series_index"] == 0 and payload["series_uid"] is None and payload["handle"] is None
+    assert payload["series_description_suffix"] == "_aligned"
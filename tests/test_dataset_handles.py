@@ -0,0 +1,58 @@
+# pip
+import pytest
+
+# local
+import dataset_handles
+from dataset_handles import DatasetHandles, UnknownHandleError, SeriesNotFoundError
+from dicom import DcmSeriesDataSet
+
+def _data_set() -> DcmSeriesDataSet:
+    return DcmSeriesDataSet( uids=["1", "2"], files=[["a1"], ["b1", "b2"]], descriptions=["a", "b"],
+                             slice_thicknesses=[1., 2.], pixel_spacings=[(1., 1.), (2., 2.)] )
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(dataset_handles.time, "monotonic", lambda: now[0])
+    return now
+
+def test_resolve_by_handle_index_and_uid():
+    handles = DatasetHandles()
+    series_data_set = _data_set()
+    handle = handles.register(series_data_set)
+    assert series_data_set.handle == handle
+
+    request = DcmSeriesDataSet(handle=handle)
+    assert handles.resolve(request, series_index=1) == (series_data_set, 1)
+    assert handles.resolve(request, series_uid="1") == (series_data_set, 0)
+    # without handle the data set of the request is used
+    assert handles.resolve(_data_set(), series_uid="2")[1] == 1
+
+@pytest.mark.parametrize("series_index, series_uid", [ (None, None), (2, None), (-1, None), (0, "unknown") ])
+def test_invalid_series_is_not_found(series_index, series_uid):
+    with pytest.raises(SeriesNotFoundError):
+        DatasetHandles().resolve(_data_set(), series_index, series_uid)
+
+def test_unknown_handle_raises():
+    with pytest.raises(UnknownHandleError):
+        DatasetHandles().get("unknown")
+
+def test_handle_expires_ttl_after_its_last_use(clock):
+    handles = DatasetHandles(ttl=10.)
+    handle = handles.register(_data_set())
+    clock[0] += 9.
+    handles.get(handle)
+    clock[0] += 9.
+    handles.get(handle)
+    clock[0] += 10.
+    with pytest.raises(UnknownHandleError):
+        handles.get(handle)
+
+def test_least_recently_used_handle_is_dropped(clock):
+    handles = DatasetHandles(max_entries=2)
+    first, second = handles.register(_data_set()), handles.register(_data_set())
+    handles.get(first)
+    handles.register(_data_set())
+    handles.get(first)
+    with pytest.raises(UnknownHandleError):
+        handles.get(second)
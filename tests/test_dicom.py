@@ -0,0 +1,155 @@
+# built-in
+import os, asyncio
+
+# pip
+import numpy as np
+import pydicom
+import pytest
+from fastapi import HTTPException
+
+# local
+import dicom
+from benchmark import PhantomSpec, write_phantom_series
+
+def _read_series( folder:str ) -> list[pydicom.Dataset]:
+    datasets = [ pydicom.dcmread(os.path.join(folder, name)) for name in os.listdir(folder) ]
+    return sorted(datasets, key=lambda ds: int(ds.InstanceNumber))
+
+def test_geometry_series_has_the_aligned_orientation_and_positions(tmp_path):
+    spec = PhantomSpec("phantom", shape=(5, 16, 16))
+    write_phantom_series(spec, str(tmp_path / "input"))
+    files = sorted( str(tmp_path / "input" / name) for name in os.listdir(tmp_path / "input") )
+
+    orientation = np.array([0., 1., 0., 0., 0., 1.])
+    first_position = np.array([10., -20., 30.5])
+    slice_offset = np.array([2.5, 0., 0.])
+    # the files are sorted by their position, not by the order they are passed in
+    output_folder = asyncio.run( dicom.create_dcm_series_with_geometry(files[::-1], orientation, first_position, slice_offset, str(tmp_path / "output")) )
+
+    originals = [ pydicom.dcmread(file) for file in files ]
+    datasets = _read_series(output_folder)
+    assert len(datasets) == len(files)
+    assert len({ ds.SeriesInstanceUID for ds in datasets }) == 1
+    assert datasets[0].SeriesInstanceUID != originals[0].SeriesInstanceUID
+    for i, (ds, original) in enumerate(zip(datasets, originals)):
+        np.testing.assert_allclose([ float(value) for value in ds.ImageOrientationPatient ], orientation)
+        np.testing.assert_allclose([ float(value) for value in ds.ImagePositionPatient ], first_position + i * slice_offset)
+        assert ds.PixelData == original.PixelData
+
+@pytest.mark.parametrize("prefix_size", [0, 16, 132, 200])
+def test_header_read_grows_a_short_prefix(tmp_path, prefix_size):
+    write_phantom_series(PhantomSpec("phantom", shape=(1, 16, 16)), str(tmp_path))
+    file = str(tmp_path / "00000.dcm")
+    # a header that is longer than the smaller prefixes
+    ds = pydicom.dcmread(file)
+    ds.ImageComments = "x" * 1000
+    ds.save_as(file, enforce_file_format=True)
+
+    header, stat = dicom.read_dcm_header(file, prefix_size)
+    assert stat.st_size == os.path.getsize(file)
+    assert header.ImageComments == ds.ImageComments
+    assert header.SeriesDescription == "phantom"
+    assert "PixelData" not in header
+
+def test_parse_dir_with_a_short_prefix_finds_all_files(tmp_path):
+    write_phantom_series(PhantomSpec("phantom", shape=(3, 16, 16)), str(tmp_path))
+    series_data_set = asyncio.run( dicom.parse_dir(str(tmp_path), prefix_size=16) )
+    assert [ len(files) for files in series_data_set.files ] == [3]
+
+@pytest.mark.parametrize("kwargs", [ { "prefix_size": 131 }, { "concurrency": 0 }, { "walk_concurrency": 0 } ])
+def test_parse_dir_rejects_invalid_crawl_parameters(tmp_path, kwargs):
+    import main
+    with pytest.raises(HTTPException) as e:
+        asyncio.run( main.parse_dir(str(tmp_path), **kwargs) )
+    assert e.value.status_code == 422
+    with pytest.raises(HTTPException) as e:
+        asyncio.run( main.parse_dir_stream(str(tmp_path), **kwargs) )
+    assert e.value.status_code == 422
+
+def _template( tmp_path, rescale:tuple[float, float]|None=None ) -> pydicom.Dataset:
+    write_phantom_series(PhantomSpec("phantom", shape=(1, 16, 16)), str(tmp_path / "template"))
+    template = pydicom.dcmread(str(tmp_path / "template" / "00000.dcm"), stop_before_pixels=True)
+    if rescale != None:
+        template.RescaleSlope, template.RescaleIntercept = rescale
+    return template
+
+def _modality_values( ds:pydicom.Dataset ) -> np.ndarray:
+    return ds.pixel_array * float(ds.get("RescaleSlope", 1.)) + float(ds.get("RescaleIntercept", 0.))
+
+@pytest.mark.parametrize("dtype, template_rescale, stored_dtype, exact", [
+    (np.uint16, None, np.uint16, True),
+    (np.int16, None, np.int16, True),
+    (np.uint8, None, np.uint8, True),
+    # values that fit into 16 bit with the template's rescale keep it
+    (np.int16, (1., -1024.), np.uint16, True),
+    # other types are rounded with the template's rescale if the values fit, else rescaled onto uint16
+    (np.float32, None, np.int16, False),
+    (np.int32, None, np.uint16, False),
+])
+def test_volume_is_written_with_its_values(tmp_path, dtype, template_rescale, stored_dtype, exact):
+    rng = np.random.default_rng(0)
+    info = np.iinfo(dtype) if np.issubdtype(dtype, np.integer) else None
+    low, high = (max(info.min, -1000), min(info.max, 3000)) if info is not None else (-1000.5, 3000.25)
+    if dtype == np.int32:
+        low, high = -100000, 100000
+    volume = rng.uniform(low, high, size=(4, 16, 16)).astype(dtype)
+    output_folder = asyncio.run( dicom.create_dcm_series_from_volume(_template(tmp_path, template_rescale), volume, str(tmp_path / "output")) )
+
+    datasets = _read_series(output_folder)
+    assert [ ds.InstanceNumber for ds in datasets ] == [1, 2, 3, 4]
+    assert datasets[0].pixel_array.dtype == stored_dtype
+    values = np.stack([ _modality_values(ds) for ds in datasets ])
+    if exact:
+        np.testing.assert_array_equal(values, volume)
+    else:
+        slope = float(datasets[0].RescaleSlope)
+        np.testing.assert_allclose(values, volume, atol=slope / 2 + 1e-6 * (high - low))
+
+def test_concurrent_instances_do_not_share_their_elements(tmp_path):
+    volume = np.arange(8 * 16 * 16, dtype=np.uint16).reshape(8, 16, 16)
+    def per_instance_cb( i:int, ds:pydicom.Dataset ):
+        ds.ImagePositionPatient = [0, 0, i * 2.]
+    output_folder = asyncio.run( dicom.create_dcm_series_from_volume(_template(tmp_path), volume, str(tmp_path / "output"), 
+                                                                     per_instance_cb=per_instance_cb, max_workers=4) )
+
+    datasets = _read_series(output_folder)
+    assert [ ds.InstanceNumber for ds in datasets ] == list(range(1, 9))
+    assert len({ ds.SOPInstanceUID for ds in datasets }) == 8
+    assert all( ds.SOPInstanceUID == ds.file_meta.MediaStorageSOPInstanceUID for ds in datasets )
+    for i, ds in enumerate(datasets):
+        assert float(ds.ImagePositionPatient[2]) == i * 2.
+        np.testing.assert_array_equal(ds.pixel_array, volume[i])
+
+@pytest.mark.parametrize("name", list(dicom.OUTPUT_TRANSFER_SYNTAXES))
+def test_transfer_syntaxes_are_lossless(tmp_path, name):
+    try:
+        transfer_syntax_uid = dicom.output_transfer_syntax(name)
+    except ValueError as e:
+        pytest.skip(str(e))
+    volume = np.random.default_rng(0).integers(-1000, 3000, size=(3, 16, 16)).astype(np.int16)
+    output_folder = asyncio.run( dicom.create_dcm_series_from_volume(_template(tmp_path), volume, str(tmp_path / "output"), 
+                                                                     transfer_syntax_uid=transfer_syntax_uid) )
+
+    datasets = _read_series(output_folder)
+    assert all( ds.file_meta.TransferSyntaxUID == transfer_syntax_uid for ds in datasets )
+    np.testing.assert_array_equal(np.stack([ ds.pixel_array for ds in datasets ]), volume)
+
+def test_unknown_transfer_syntax_is_rejected():
+    with pytest.raises(ValueError):
+        dicom.output_transfer_syntax("jpeg")
+
+def test_align_rejects_a_transfer_syntax_without_encoder():
+    import main
+    missing = []
+    for name in dicom.OUTPUT_TRANSFER_SYNTAXES:
+        try:
+            dicom.output_transfer_syntax(name)
+        except ValueError:
+            missing.append(name)
+    if not missing:
+        pytest.skip("all encoders are installed")
+    args = main.Args(uids=["1"], files=[["a"]], descriptions=["a"], slice_thicknesses=[1.], pixel_spacings=[(1., 1.)], series_index=0, 
+                     series_description_suffix="_aligned", output_transfer_syntax=missing[0])
+    with pytest.raises(HTTPException) as e:
+        asyncio.run( main.align(args) )
+    assert e.value.status_code == 400
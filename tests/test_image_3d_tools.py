@@ -0,0 +1,103 @@
+# built-in
+import os
+
+# pip
+import numpy as np
+import pytest
+
+# local
+import image_3d_tools
+from benchmark import PhantomSpec, phantom_slice
+
+def _phantom( shape=(24, 40, 48), angles_deg=(20., 10., 5.) ) -> np.ndarray:
+    spec = PhantomSpec("test", shape=shape, angles_deg=angles_deg, half_extents=(0.45, 0.3, 0.15))
+    return np.stack( [ phantom_slice(spec, index) for index in range(shape[0]) ] )
+
+def test_principal_axes_match_pca_of_the_foreground_indices():
+    volume = _phantom()
+    mean, axes, min_point, max_point = image_3d_tools.calculate_principal_axes(volume, threshold_value=1000, slab_size=5)
+
+    points = np.argwhere(volume > 1000).astype(np.float64)
+    centered = points - points.mean(axis=0)
+    _, _, pca_axes = np.linalg.svd(centered, full_matrices=False)
+    projections = centered @ axes.T
+
+    np.testing.assert_allclose(mean, points.mean(axis=0))
+    np.testing.assert_allclose(np.abs(np.sum(axes * pca_axes, axis=1)), 1., atol=1e-9)
+    np.testing.assert_allclose(min_point, projections.min(axis=0), atol=1e-9)
+    np.testing.assert_allclose(max_point, projections.max(axis=0), atol=1e-9)
+
+def test_principal_axes_without_foreground_raise():
+    with pytest.raises(ValueError):
+        image_3d_tools.calculate_principal_axes(np.zeros((4, 4, 4)), threshold_value=0)
+
+@pytest.mark.parametrize("interpolation_order", [1, 3])
+@pytest.mark.parametrize("prefilter_dtype", [np.float64, np.float32])
+def test_tiled_transform_matches_single_shot(interpolation_order, prefilter_dtype):
+    volume = _phantom()
+    _, matrix = image_3d_tools.calculate_rotated_bounding_box(volume, threshold_value=1000)
+
+    single = image_3d_tools.transform_image(volume, matrix, interpolation_order, prefilter_dtype=prefilter_dtype, max_workers=1, tile_bytes=2**40)
+    tiled = image_3d_tools.transform_image(volume, matrix, interpolation_order, prefilter_dtype=prefilter_dtype, max_workers=3, tile_bytes=1)
+
+    np.testing.assert_array_equal(tiled, single)
+
+def test_spline_prefilter_matches_scipy():
+    from scipy.ndimage import spline_filter
+    volume = _phantom().astype(np.float64)
+    filtered = image_3d_tools.spline_prefilter(volume, max_workers=3)
+    np.testing.assert_allclose(filtered, spline_filter(volume, order=3, mode="mirror"), atol=1e-9)
+
+def test_transform_tiled_by_memory_budget_matches_single_shot():
+    volume = _phantom()
+    _, matrix = image_3d_tools.calculate_rotated_bounding_box(volume, threshold_value=1000)
+
+    single = image_3d_tools.transform_image(volume, matrix, max_workers=1, tile_bytes=2**40)
+    budget = image_3d_tools.transform_image(volume, matrix, max_workers=2, memory_budget=4096)
+
+    np.testing.assert_array_equal(budget, single)
+
+def test_out_of_core_transform_matches_in_memory_and_removes_its_files(tmp_path):
+    volume = _phantom()
+    _, matrix = image_3d_tools.calculate_rotated_bounding_box(volume, threshold_value=1000)
+    in_memory = image_3d_tools.transform_image(volume, matrix)
+
+    with image_3d_tools.ScratchSpace(str(tmp_path)) as scratch:
+        out_of_core = image_3d_tools.transform_image(volume, matrix, scratch=scratch, memory_budget=64 * 1024)
+        assert isinstance(out_of_core, np.memmap)
+        # the prefilter has been released, only the output is left
+        assert len(os.listdir(scratch.path)) == 1
+        np.testing.assert_array_equal(out_of_core, in_memory)
+    assert os.listdir(tmp_path) == []
+
+def test_spline_prefilter_chunked_by_budget_matches_scipy():
+    from scipy.ndimage import spline_filter
+    volume = _phantom().astype(np.float64)
+    filtered = image_3d_tools.spline_prefilter(volume, max_workers=2, memory_budget=8192)
+    np.testing.assert_allclose(filtered, spline_filter(volume, order=3, mode="mirror"), atol=1e-9)
+
+def test_pyramid_level_needs_a_multiple_of_the_slice_step():
+    volume = np.arange(12 * 8 * 8).reshape(12, 8, 8)
+    loaded = volume[::2]
+    np.testing.assert_array_equal(image_3d_tools.pyramid_level(loaded, 4, slice_step=2), volume[::4, ::4, ::4])
+    with pytest.raises(ValueError):
+        image_3d_tools.pyramid_level(loaded, 5, slice_step=2)
+
+def test_largest_component_does_not_merge_a_table_one_voxel_away():
+    volume = np.zeros((40, 60, 60), dtype=np.int16)
+    z, y, x = np.ogrid[:40, :60, :60]
+    volume[ (z - 20)**2 + (y - 25)**2 + (x - 30)**2 < 15**2 ] = 100
+    volume[:, 41:43, :] = 100
+
+    component = image_3d_tools.largest_component(volume, threshold_value=50, factor=2)
+    foreground = volume > 50
+    mask = foreground & component.slab(0, foreground.shape)
+
+    assert mask[:, :40].sum() == foreground[:, :40].sum()
+    assert mask[:, 40:].sum() < 0.05 * foreground[:, 40:].sum()
+
+def test_largest_component_below_min_size_raises():
+    volume = np.zeros((8, 8, 8))
+    volume[2:4, 2:4, 2:4] = 1
+    with pytest.raises(image_3d_tools.ComponentNotFoundError):
+        image_3d_tools.largest_component(volume, threshold_value=0.5, factor=1, min_size=9)
@@ -0,0 +1,85 @@
+# built-in
+import asyncio
+
+# pip
+import pytest
+from pydantic import BaseModel
+
+# local
+from jobs import JobManager, JobQueueFullError
+
+class _Result(BaseModel):
+    value:int
+
+async def _wait_until_finished( jobs:JobManager, job_id:str ) -> None:
+    while jobs.status(job_id).state in ("queued", "running"):
+        await asyncio.sleep(0.001)
+
+def test_job_reports_progress_and_keeps_its_result():
+    async def run( args:int, report ) -> _Result:
+        report("load", 0.5)
+        report("compute", 2.)
+        return _Result(value=args * 2)
+
+    async def main():
+        jobs = JobManager(run, ["load", "compute", "write"])
+        status = jobs.submit(21)
+        assert status.state == "queued"
+        await _wait_until_finished(jobs, status.job_id)
+        return jobs.status(status.job_id), jobs.result(status.job_id)
+    status, result = asyncio.run(main())
+    assert status.state == "done"
+    assert status.progress == { "load": 0.5, "compute": 1., "write": 0. }
+    assert status.started_at >= status.submitted_at and status.finished_at >= status.started_at
+    assert result == _Result(value=42)
+
+def test_failed_job_keeps_its_error():
+    async def run( args, report ):
+        raise ValueError("no foreground")
+
+    async def main():
+        jobs = JobManager(run, [])
+        status = jobs.submit(None)
+        await _wait_until_finished(jobs, status.job_id)
+        return jobs.status(status.job_id), jobs.result(status.job_id)
+    status, result = asyncio.run(main())
+    assert status.state == "failed"
+    assert status.error == "no foreground"
+    assert result is None
+
+def test_submit_on_a_full_queue_raises():
+    async def main():
+        release = asyncio.Event()
+        async def run( args, report ):
+            await release.wait()
+            return _Result(value=args)
+        jobs = JobManager(run, [], max_workers=1, max_queue=1)
+        running = jobs.submit(1)
+        # let the worker take the first job, the second one waits in the queue
+        await asyncio.sleep(0)
+        queued = jobs.submit(2)
+        with pytest.raises(JobQueueFullError):
+            jobs.submit(3)
+        assert jobs.queued() == 1
+        release.set()
+        await _wait_until_finished(jobs, queued.job_id)
+        return [ jobs.result(job_id) for job_id in (running.job_id, queued.job_id) ]
+    assert asyncio.run(main()) == [ _Result(value=1), _Result(value=2) ]
+
+def test_queue_size_below_one_is_rejected():
+    with pytest.raises(ValueError):
+        JobManager(lambda args, report: None, [], max_queue=0)
+
+def test_only_the_newest_finished_jobs_are_kept():
+    async def run( args, report ):
+        return _Result(value=args)
+
+    async def main():
+        jobs = JobManager(run, [], max_workers=1, max_finished=2)
+        job_ids = [ jobs.submit(value).job_id for value in range(3) ]
+        await _wait_until_finished(jobs, job_ids[-1])
+        return jobs, job_ids
+    jobs, job_ids = asyncio.run(main())
+    with pytest.raises(KeyError):
+        jobs.status(job_ids[0])
+    assert [ jobs.result(job_id) for job_id in job_ids[1:] ] == [ _Result(value=1), _Result(value=2) ]
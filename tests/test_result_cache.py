@@ -0,0 +1,59 @@
+# built-in
+import os, asyncio
+
+# pip
+import pytest
+
+# local
+import result_cache
+from result_cache import ResultCache
+from dicom import DcmSeriesDataSet
+
+@pytest.fixture
+def series_data_set(tmp_path):
+    files = []
+    for index in range(3):
+        file = tmp_path / f"{index:05d}.dcm"
+        file.write_bytes(b"slice")
+        files.append(str(file))
+    return DcmSeriesDataSet(uids=["1.2.3"], files=[files], descriptions=["series"], slice_thicknesses=[1.], pixel_spacings=[(1., 1.)])
+
+def test_hit_and_misses_on_changed_options_files_and_version(series_data_set, tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    key = asyncio.run( cache.key(series_data_set, 0, { "threshold": 100 }) )
+    asyncio.run( cache.put(key, '{"angle": 1}') )
+
+    assert asyncio.run( cache.get(key) ) == '{"angle": 1}'
+    assert asyncio.run( cache.key(series_data_set, 0, { "threshold": 100 }) ) == key
+    assert asyncio.run( cache.key(series_data_set, 0, { "threshold": 200 }) ) != key
+
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_VERSION", result_cache.RESULT_CACHE_VERSION + 1)
+    assert asyncio.run( cache.key(series_data_set, 0, { "threshold": 100 }) ) != key
+    monkeypatch.undo()
+
+    with open(series_data_set.files[0][1], "ab") as f:
+        f.write(b"modified")
+    assert asyncio.run( cache.key(series_data_set, 0, { "threshold": 100 }) ) != key
+
+    assert cache.stats().hits == 1 and cache.stats().entries == 1
+
+def test_entry_without_its_output_folder_is_dropped(series_data_set, tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    output_folder = tmp_path / "output"
+    output_folder.mkdir()
+    key = asyncio.run( cache.key(series_data_set, 0, {}) )
+    asyncio.run( cache.put(key, "{}", str(output_folder)) )
+    assert asyncio.run( cache.get(key) ) == "{}"
+
+    os.rmdir(output_folder)
+    assert asyncio.run( cache.get(key) ) is None
+    assert cache.stats().entries == 0
+
+def test_least_recently_used_entries_are_evicted(series_data_set, tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    keys = [ asyncio.run( cache.key(series_data_set, 0, { "threshold": threshold }) ) for threshold in range(3) ]
+    for key in keys:
+        asyncio.run( cache.put(key, "{}") )
+    assert asyncio.run( cache.get(keys[0]) ) is None
+    assert asyncio.run( cache.get(keys[2]) ) == "{}"
+    assert cache.stats().entries == 2
@@ -0,0 +1,52 @@
+# built-in
+import os, asyncio, shutil
+
+# pip
+import pytest
+
+# local
+from series_index import SeriesIndex
+from benchmark import PhantomSpec, write_phantom_series
+
+@pytest.fixture
+def series_dir(tmp_path):
+    directory = tmp_path / "series"
+    write_phantom_series(PhantomSpec("first", shape=(6, 16, 16)), str(directory / "first"))
+    write_phantom_series(PhantomSpec("second", shape=(4, 16, 16)), str(directory / "second"))
+    return str(directory)
+
+def _scan( index:SeriesIndex, directory:str ) -> dict[str, int]:
+    series_data_set = asyncio.run( index.scan(directory) )
+    return { description: len(files) for description, files in zip(series_data_set.descriptions, series_data_set.files) }
+
+def test_rescan_picks_up_added_modified_and_deleted_files(series_dir, tmp_path):
+    index = SeriesIndex(str(tmp_path / "index.sqlite"))
+    assert _scan(index, series_dir) == { "first": 6, "second": 4 }
+
+    # added: a third series
+    write_phantom_series(PhantomSpec("third", shape=(3, 16, 16)), os.path.join(series_dir, "third"))
+    assert _scan(index, series_dir) == { "first": 6, "second": 4, "third": 3 }
+
+    # modified: a file of the second series now belongs to the first one
+    shutil.copyfile(os.path.join(series_dir, "first", "00000.dcm"), os.path.join(series_dir, "second", "00000.dcm"))
+    assert _scan(index, series_dir) == { "first": 7, "second": 3, "third": 3 }
+
+    # deleted
+    os.remove(os.path.join(series_dir, "first", "00001.dcm"))
+    shutil.rmtree(os.path.join(series_dir, "third"))
+    assert _scan(index, series_dir) == { "first": 6, "second": 3 }
+
+def test_rescan_keeps_files_that_could_not_be_read(series_dir, tmp_path, monkeypatch):
+    import series_index
+    index = SeriesIndex(str(tmp_path / "index.sqlite"))
+    assert _scan(index, series_dir) == { "first": 6, "second": 4 }
+
+    # a file that the crawl does not reach, e.g. on a transient error, is kept as long as it exists
+    unreadable = os.path.join(series_dir, "first", "00002.dcm")
+    crawl = series_index.crawl_dcm_headers
+    async def crawl_without_unreadable( *args, **kwargs ):
+        async for crawled_file in crawl(*args, **kwargs):
+            if crawled_file.file_path != unreadable:
+                yield crawled_file
+    monkeypatch.setattr(series_index, "crawl_dcm_headers", crawl_without_unreadable)
+    assert _scan(index, series_dir) == { "first": 6, "second": 4 }